@@ -0,0 +1,355 @@
+"""Benchmarks of the operations that walk or link entire workspace trees.
+
+Each operation is timed on synthetic workspaces (see workspace.py) of several sizes, in one or
+more directories, typically one on tmpfs and one on disk. The results are written as JSON and
+two result files can be compared with the compare command, e.g.:
+
+    python benchmarks/tree_operations.py run --files 1000 10000 --output base.json
+    python benchmarks/tree_operations.py run --files 1000 10000 --output new.json
+    python benchmarks/tree_operations.py compare base.json new.json
+
+The operations are run through the plugin code, which is loaded using the Girder test
+harness, like the plugin tests. The root of the Girder checkout must be in PYTHONPATH, the
+plugin installed and a MongoDB server available. Only the filesystem part of each operation is
+timed: the database is not used while timing.
+
+With --syscalls, every measurement is repeated in a subprocess under strace -c, once with the
+setup only and once with the operation, and the difference of the number of system calls is
+reported.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from workspace import Scenario, generateWorkspace, mutateWorkspace  # noqa: E402
+
+KEY_FIELDS = ("op", "fs", "files", "depth", "fanout", "changed", "dirShare", "size")
+
+
+def _bootstrap() -> None:
+    if "girder.plugins.wt_versioning" in sys.modules:
+        return
+    from tests import base
+
+    base.enabledPlugins.append("wt_versioning")
+    base.startServer(mock=True)
+
+
+def _prepareSnapshot(work: Path, scenario: Scenario) -> Callable[[], None]:
+    from girder.plugins.wt_versioning.lib.version_hierarchy import VersionHierarchyModel
+
+    files = generateWorkspace(work / "version", scenario)
+    mutateWorkspace(work / "version", work / "current", files, scenario.changed)
+    stats = {"fileCount": 0, "dirCount": 0, "size": 0, "newSize": 0, "reused": 0}
+
+    def run():
+        (work / "new").mkdir()
+        VersionHierarchyModel().snapshotRecursive(
+            work / "version", work / "current", work / "new", stats=stats
+        )
+
+    return run
+
+
+def _prepareSameTree(work: Path, scenario: Scenario) -> Callable[[], None]:
+    from girder.plugins.wt_versioning.lib.version_hierarchy import VersionHierarchyModel
+
+    # Identical trees are the worst case, the whole tree is compared
+    files = generateWorkspace(work / "version", scenario)
+    mutateWorkspace(work / "version", work / "current", files, 0)
+
+    def run():
+        assert VersionHierarchyModel().sameTree(work / "version", work / "current")
+
+    return run
+
+
+def _prepareRestore(work: Path, scenario: Scenario) -> Callable[[], None]:
+    from girder.plugins.wt_versioning.lib.version_hierarchy import VersionHierarchyModel
+
+    files = generateWorkspace(work / "version", scenario)
+    mutateWorkspace(work / "version", work / "current", files, scenario.changed)
+
+    def run():
+        # as in VersionHierarchyModel.restore
+        shutil.rmtree(work / "current")
+        (work / "current").mkdir()
+        VersionHierarchyModel().snapshotRecursive(None, work / "version", work / "current")
+
+    return run
+
+
+def _prepareRunCreate(work: Path, scenario: Scenario) -> Callable[[], None]:
+    from girder.plugins.wt_versioning.lib.run_hierarchy import RunHierarchyModel
+
+    generateWorkspace(work / "version", scenario)
+
+    def run():
+        # as in RunHierarchyModel.create, with an eagerly populated workspace
+        (work / "run").mkdir()
+        RunHierarchyModel().snapshotRecursive(None, work / "version", work / "run")
+
+    return run
+
+
+def _prepareCopy(work: Path, scenario: Scenario) -> Callable[[], None]:
+    from girder.plugins.wt_versioning import _meteredCopy
+
+    generateWorkspace(work / "version", scenario)
+
+    def run():
+        # as in copyVersionsAndRuns
+        shutil.copytree(
+            work / "version", work / "copy", symlinks=True, copy_function=_meteredCopy
+        )
+
+    return run
+
+
+def _prepareIndex(work: Path, scenario: Scenario) -> Callable[[], None]:
+    from girder.plugins.wt_versioning.lib.index import VersionIndex
+
+    generateWorkspace(work / "workspace", scenario)
+
+    def run():
+        VersionIndex({"fsPath": work.as_posix()}).build()
+
+    return run
+
+
+OPERATIONS = {
+    "snapshot": _prepareSnapshot,
+    "sameTree": _prepareSameTree,
+    "restore": _prepareRestore,
+    "runCreate": _prepareRunCreate,
+    "copy": _prepareCopy,
+    "index": _prepareIndex,
+}
+
+
+def fsType(path: Path) -> str:
+    """Returns the type of the filesystem path is on, from /proc/mounts."""
+    path = os.path.realpath(path)
+    best, kind = "", "unknown"
+    try:
+        with open("/proc/mounts") as fp:
+            for line in fp:
+                fields = line.split()
+                mount = fields[1]
+                inside = path == mount or path.startswith(mount.rstrip("/") + "/")
+                if inside and len(mount) > len(best):
+                    best, kind = mount, fields[2]
+    except OSError:
+        pass
+    return kind
+
+
+def measure(op: str, scenario: Scenario, baseDir: Path, setupOnly: bool = False) -> float:
+    work = Path(tempfile.mkdtemp(prefix="wt_bench_", dir=baseDir))
+    try:
+        run = OPERATIONS[op](work, scenario)
+        if setupOnly:
+            return 0.0
+        start = time.perf_counter()
+        run()
+        return time.perf_counter() - start
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def countSyscalls(op: str, scenario: Scenario, baseDir: Path) -> Optional[int]:
+    """Returns the number of system calls made by an operation, or None if strace failed."""
+    counts = []
+    for setupOnly in (True, False):
+        with tempfile.NamedTemporaryFile(suffix=".strace") as out:
+            cmd = [
+                "strace", "-f", "-c", "-o", out.name,
+                sys.executable, os.path.abspath(__file__), "single",
+                "--op", op, "--dir", baseDir.as_posix(),
+            ] + _scenarioArgs(scenario)
+            if setupOnly:
+                cmd.append("--setup-only")
+            if subprocess.run(cmd, stdout=subprocess.DEVNULL).returncode != 0:
+                return None
+            counts.append(_parseStrace(Path(out.name).read_text()))
+    if None in counts:
+        return None
+    return counts[1] - counts[0]
+
+
+def _parseStrace(summary: str) -> Optional[int]:
+    for line in summary.splitlines():
+        fields = line.split()
+        if fields and fields[-1] == "total":
+            return int(fields[2])
+    return None
+
+
+def _scenarioArgs(scenario: Scenario) -> List[str]:
+    return [
+        "--files", str(scenario.files), "--depth", str(scenario.depth),
+        "--fanout", str(scenario.fanout), "--changed", str(scenario.changed),
+        "--dir-share", str(scenario.dirShare), "--size", str(scenario.size),
+    ]
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def runBenchmarks(args: argparse.Namespace) -> dict:
+    _bootstrap()
+    results = []
+    for baseDir in args.dir:
+        baseDir = Path(baseDir)
+        for files in args.files:
+            scenario = Scenario(
+                files, args.depth, args.fanout, args.changed, args.dir_share, args.size
+            )
+            for op in args.op:
+                timings = [measure(op, scenario, baseDir) for _ in range(args.repeat)]
+                result = dict(scenario._asdict(), op=op, fs=fsType(baseDir))
+                result.update(
+                    dir=baseDir.as_posix(),
+                    seconds={"min": min(timings), "median": statistics.median(timings)},
+                    syscalls=countSyscalls(op, scenario, baseDir) if args.syscalls else None,
+                )
+                results.append(result)
+                print(
+                    f"{op:>10} {result['fs']:>8} {files:>8} files: "
+                    f"{result['seconds']['min']:.4f}s",
+                    file=sys.stderr,
+                )
+    return {
+        "commit": _commit(),
+        "date": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+
+def compareResults(base: dict, new: dict, threshold: float) -> List[dict]:
+    """Returns the results of new that are slower than the same results of base by more than
+    threshold (a fraction of the base time), comparing the minimum times.
+    """
+    def key(result):
+        return tuple(result[_] for _ in KEY_FIELDS)
+
+    baseResults = {key(_): _ for _ in base["results"]}
+    regressions = []
+    for result in new["results"]:
+        old = baseResults.get(key(result))
+        if old is None:
+            continue
+        ratio = result["seconds"]["min"] / max(old["seconds"]["min"], 1e-9)
+        print(
+            " ".join(f"{_}={result[_]}" for _ in KEY_FIELDS)
+            + f" {old['seconds']['min']:.4f}s -> {result['seconds']['min']:.4f}s"
+            + f" ({ratio:.2f}x)"
+        )
+        if ratio > 1 + threshold:
+            regressions.append(dict(result, ratio=ratio))
+    return regressions
+
+
+def _defaultDirs() -> List[str]:
+    dirs = ["/dev/shm"] if os.path.isdir("/dev/shm") else []
+    return dirs + [tempfile.gettempdir()]
+
+
+def _addScenarioArgs(parser: argparse.ArgumentParser, multiple: bool) -> None:
+    if multiple:
+        parser.add_argument(
+            "--files", type=int, nargs="+", default=[1000, 10000],
+            help="Numbers of entries in the workspace, one run per number"
+        )
+    else:
+        parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--depth", type=int, default=4, help="Maximum directory depth")
+    parser.add_argument("--fanout", type=int, default=8, help="Subdirectories per directory")
+    parser.add_argument(
+        "--changed", type=float, default=0.1, help="Share of files changed between versions"
+    )
+    parser.add_argument(
+        "--dir-share", type=float, default=0.1, help="Share of the entries that are directories"
+    )
+    parser.add_argument("--size", type=int, default=1024, help="File size in bytes")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks of the versioning tree operations")
+    commands = parser.add_subparsers(dest="command")
+
+    run = commands.add_parser("run", help="Run the benchmarks")
+    _addScenarioArgs(run, multiple=True)
+    run.add_argument("--op", nargs="+", choices=sorted(OPERATIONS), default=sorted(OPERATIONS))
+    run.add_argument(
+        "--dir", nargs="+", default=_defaultDirs(),
+        help="Directories to run in, e.g. on tmpfs and on disk"
+    )
+    run.add_argument("--repeat", type=int, default=3)
+    run.add_argument("--syscalls", action="store_true", help="Count system calls with strace")
+    run.add_argument("--output", help="Output file, defaults to the standard output")
+
+    single = commands.add_parser("single", help="Run a single measurement (used with strace)")
+    _addScenarioArgs(single, multiple=False)
+    single.add_argument("--op", choices=sorted(OPERATIONS), required=True)
+    single.add_argument("--dir", required=True)
+    single.add_argument("--setup-only", action="store_true")
+
+    compare = commands.add_parser("compare", help="Compare two result files")
+    compare.add_argument("base")
+    compare.add_argument("new")
+    compare.add_argument(
+        "--threshold", type=float, default=0.1,
+        help="Slowdown reported as a regression, as a fraction of the base time"
+    )
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        report = json.dumps(runBenchmarks(args), indent=2)
+        if args.output:
+            Path(args.output).write_text(report)
+        else:
+            print(report)
+    elif args.command == "single":
+        _bootstrap()
+        scenario = Scenario(
+            args.files, args.depth, args.fanout, args.changed, args.dir_share, args.size
+        )
+        measure(args.op, scenario, Path(args.dir), setupOnly=args.setup_only)
+    elif args.command == "compare":
+        with open(args.base) as fp:
+            base = json.load(fp)
+        with open(args.new) as fp:
+            new = json.load(fp)
+        regressions = compareResults(base, new, args.threshold)
+        for result in regressions:
+            print(f"Regression: {result['op']} ({result['ratio']:.2f}x)", file=sys.stderr)
+        return 1 if regressions else 0
+    else:
+        parser.print_help()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
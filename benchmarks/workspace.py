@@ -0,0 +1,62 @@
+"""Synthetic tale workspaces for the benchmarks."""
+import os
+import random
+from collections import namedtuple
+from pathlib import Path
+from typing import List
+
+Scenario = namedtuple("Scenario", ["files", "depth", "fanout", "changed", "dirShare", "size"])
+
+
+def _content(rng: random.Random, size: int) -> bytes:
+    return rng.getrandbits(8 * size).to_bytes(size, "big") if size else b""
+
+
+def generateWorkspace(root: Path, scenario: Scenario, seed: int = 0) -> List[Path]:
+    """Creates a tree of scenario.files entries under root, of which a scenario.dirShare share
+    are directories. Directories are nested at most scenario.depth levels deep, with at most
+    scenario.fanout subdirectories each, and files are spread evenly across all directories.
+    Returns the paths of the files, relative to root.
+    """
+    rng = random.Random(seed)
+    root.mkdir(parents=True, exist_ok=True)
+    ndirs = int(scenario.files * scenario.dirShare)
+    dirs = [Path()]
+    level = [Path()]
+    for depth in range(scenario.depth):
+        nextLevel = []
+        for parent in level:
+            for i in range(scenario.fanout):
+                if len(dirs) > ndirs:
+                    break
+                path = parent / f"d{depth}_{i}"
+                (root / path).mkdir()
+                dirs.append(path)
+                nextLevel.append(path)
+        level = nextLevel
+    files = []
+    for i in range(scenario.files - len(dirs) + 1):
+        path = dirs[i % len(dirs)] / f"f{i}.dat"
+        (root / path).write_bytes(_content(rng, scenario.size))
+        files.append(path)
+    return files
+
+
+def mutateWorkspace(
+    src: Path, dst: Path, files: List[Path], changed: float, seed: int = 0
+) -> None:
+    """Creates dst as a tree of hard links to the files of src, in which a changed share of
+    the files are replaced with new content. Files are replaced, not modified in place, like
+    the WebDAV filesystem mounted in tale containers does.
+    """
+    rng = random.Random(seed + 1)
+    for dirpath, dirnames, filenames in os.walk(src):
+        target = dst / os.path.relpath(dirpath, src)
+        target.mkdir(parents=True, exist_ok=True)
+        for name in filenames:
+            os.link(os.path.join(dirpath, name), target / name)
+    for path in rng.sample(files, int(len(files) * changed)):
+        target = dst / path
+        size = target.stat().st_size
+        target.unlink()
+        target.write_bytes(_content(rng, size))
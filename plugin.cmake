@@ -23,3 +23,7 @@ add_python_style_test(
   python_static_analysis_${PLUGIN}_tests
   "${PROJECT_SOURCE_DIR}/plugins/${PLUGIN}/plugin_tests"
 )
+add_python_style_test(
+  python_static_analysis_${PLUGIN}_benchmarks
+  "${PROJECT_SOURCE_DIR}/plugins/${PLUGIN}/benchmarks"
+)
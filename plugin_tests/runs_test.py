@@ -4,6 +4,7 @@ import time
 from datetime import datetime, timedelta
 
 import mock
+from girder import events
 from girder.models.folder import Folder
 from girder.models.token import Token
 from tests import base
@@ -185,6 +186,214 @@ class RunsTestCase(BaseTestCase):
         )
         self.assertStatusOk(resp)
 
+    @mock.patch("girder.plugins.wholetale.lib.manifest.ImageBuilder")
+    def testDeferredRunWorkspace(self, mock_builder):
+        from girder.plugins.wt_versioning.constants import FIELD_WORKSPACE_MATERIALIZED
+        from girder.plugins.wt_versioning.lib.run_hierarchy import RunHierarchyModel
+
+        mock_builder.return_value.container_config.repo2docker_version = (
+            "craigwillis/repo2docker:latest"
+        )
+        mock_builder.return_value.get_tag.return_value = "some_image_digest"
+
+        tale = self._create_example_tale(self.get_dataset([0]))
+        workspace = Folder().load(tale["workspaceId"], force=True)
+        os.mkdir(os.path.join(workspace["fsPath"], "data"))
+        for fname in ("test_file.txt", "data/input.csv"):
+            with open(os.path.join(workspace["fsPath"], fname), "wb") as f:
+                f.write(b"Hello World!")
+
+        resp = self.request(
+            path="/version",
+            method="POST",
+            user=self.user_one,
+            params={"name": "v1", "taleId": tale["_id"]},
+        )
+        self.assertStatusOk(resp)
+        version = Folder().load(resp.json["_id"], force=True)
+        version_workspace = os.path.join(version["fsPath"], "workspace")
+
+        resp = self.request(
+            path="/run",
+            method="POST",
+            user=self.user_one,
+            params={"versionId": version["_id"], "name": "deferred run", "deferred": True},
+        )
+        self.assertStatusOk(resp)
+        self.assertFalse(resp.json[FIELD_WORKSPACE_MATERIALIZED])
+
+        # Until the run is started, the files of the version are read from version/ and the
+        # workspace is an empty placeholder
+        run = Folder().load(resp.json["_id"], force=True)
+        run_workspace = os.path.join(run["fsPath"], "workspace")
+        self.assertEqual(os.listdir(run_workspace), [])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(run["fsPath"], "version", "workspace"))),
+            ["data", "test_file.txt"],
+        )
+
+        # Writing through the deferred workspace cannot reach the version
+        with self.assertRaises(OSError):
+            with open(os.path.join(run_workspace, "test_file.txt"), "r+b") as f:
+                f.write(b"Changed!")
+        with self.assertRaises(OSError):
+            with open(os.path.join(run_workspace, "data", "input.csv"), "wb") as f:
+                f.write(b"Changed!")
+        for fname in ("test_file.txt", "data/input.csv"):
+            with open(os.path.join(version_workspace, fname), "rb") as f:
+                self.assertEqual(f.read(), b"Hello World!")
+        self.assertEqual(sorted(os.listdir(version_workspace)), ["data", "test_file.txt"])
+
+        run = RunHierarchyModel().materializeWorkspace(run)
+        self.assertTrue(run[FIELD_WORKSPACE_MATERIALIZED])
+        self.assertTrue(Folder().load(run["_id"], force=True)[FIELD_WORKSPACE_MATERIALIZED])
+        self.assertFalse(os.path.islink(run_workspace))
+        self.assertTrue(os.path.isdir(run_workspace))
+        for fname in ("test_file.txt", "data/input.csv"):
+            self.assertTrue(
+                os.path.samefile(
+                    os.path.join(run_workspace, fname), os.path.join(version_workspace, fname)
+                )
+            )
+        self.assertEqual(
+            [_ for _ in os.listdir(run["fsPath"]) if _.startswith(".workspace")], []
+        )
+
+        self._remove_example_tale(tale)
+
+    @mock.patch("girder.plugins.wholetale.lib.manifest.ImageBuilder")
+    def testRunCreateWrites(self, mock_builder):
+        from girder.constants import AccessType
+
+        mock_builder.return_value.container_config.repo2docker_version = (
+            "craigwillis/repo2docker:latest"
+        )
+        mock_builder.return_value.get_tag.return_value = "some_image_digest"
+
+        tale = self._create_example_tale(self.get_dataset([0]))
+        resp = self.request(
+            path="/version",
+            method="POST",
+            user=self.user_one,
+            params={"name": "First Version", "taleId": tale["_id"]},
+        )
+        self.assertStatusOk(resp)
+        version = resp.json
+        root = Folder().load(tale["runsRootId"], force=True)
+
+        created = []
+        with mock.patch.object(Folder, "save", wraps=Folder().save) as save, \
+                events.bound("model.folder.save.created", "test", lambda e: created.append(e.info)):
+            resp = self.request(
+                path="/run",
+                method="POST",
+                user=self.user_one,
+                params={"versionId": version["_id"], "name": "test run"},
+            )
+            self.assertStatusOk(resp)
+        # The run, the reference count and the root are written by a single bulk write, but the
+        # events of a save are still triggered
+        save.assert_not_called()
+        self.assertEqual([str(_["_id"]) for _ in created], [resp.json["_id"]])
+
+        run = Folder().load(resp.json["_id"], force=True)
+        self.assertEqual(str(run["runVersionId"]), version["_id"])
+        self.assertEqual(run["runStatus"], 0)
+        self.assertTrue(run["isMapping"])
+        self.assertTrue(os.path.isdir(run["fsPath"]))
+        self.assertTrue(Folder().hasAccess(run, user=self.user_one, level=AccessType.ADMIN))
+        self.assertGreater(Folder().load(root["_id"], force=True)["updated"], root["updated"])
+        version = Folder().load(version["_id"], force=True)
+        self.assertEqual(version["versionsRefCount"], 1)
+        self._remove_example_tale(tale)
+
+    @mock.patch("girder.plugins.wholetale.lib.manifest.ImageBuilder")
+    def testBulkDelete(self, mock_builder):
+        mock_builder.return_value.container_config.repo2docker_version = (
+            "craigwillis/repo2docker:latest"
+        )
+        mock_builder.return_value.get_tag.return_value = "some_image_digest"
+
+        tale = self._create_example_tale(self.get_dataset([0]))
+        versions = []
+        for i in range(3):
+            resp = self.request(
+                path="/version",
+                method="POST",
+                user=self.user_one,
+                params={"name": f"v{i}", "taleId": tale["_id"], "force": True},
+            )
+            self.assertStatusOk(resp)
+            versions.append(resp.json)
+
+        runs = []
+        for i in range(2):
+            resp = self.request(
+                path="/run",
+                method="POST",
+                user=self.user_one,
+                params={"versionId": versions[0]["_id"], "name": f"r{i}"},
+            )
+            self.assertStatusOk(resp)
+            runs.append(resp.json)
+
+        resp = self.request(path="/version", method="DELETE", user=self.user_one)
+        self.assertStatus(resp, 400)
+
+        resp = self.request(
+            path="/version",
+            method="DELETE",
+            user=self.user_two,
+            params={"ids": json.dumps([versions[1]["_id"]])},
+        )
+        self.assertStatus(resp, 403)
+
+        # Runs are not versions
+        resp = self.request(
+            path="/version",
+            method="DELETE",
+            user=self.user_one,
+            params={"ids": json.dumps([runs[0]["_id"]])},
+        )
+        self.assertStatus(resp, 400)
+
+        resp = self.request(
+            path="/version",
+            method="DELETE",
+            user=self.user_one,
+            params={"ids": json.dumps([versions[0]["_id"], versions[1]["_id"]])},
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json["deleted"], [versions[1]["_id"]])
+        self.assertEqual(resp.json["skipped"], [versions[0]["_id"]])
+
+        resp = self.request(
+            path="/run",
+            method="DELETE",
+            user=self.user_one,
+            params={"taleId": tale["_id"]},
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(sorted(resp.json["deleted"]), sorted(_["_id"] for _ in runs))
+        version = Folder().load(versions[0]["_id"], force=True)
+        self.assertEqual(version["versionsRefCount"], 0)
+
+        resp = self.request(
+            path="/version",
+            method="DELETE",
+            user=self.user_one,
+            params={"taleId": tale["_id"]},
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(
+            sorted(resp.json["deleted"]), sorted([versions[0]["_id"], versions[2]["_id"]])
+        )
+        self.assertEqual(resp.json["skipped"], [])
+        for version in versions:
+            self.assertIsNone(Folder().load(version["_id"], force=True))
+
+        self._remove_example_tale(tale)
+
     @mock.patch("gwvolman.tasks.recorded_run")
     @mock.patch("girder.plugins.wholetale.lib.manifest.ImageBuilder")
     def testRecordedRun(self, rr, mock_builder):
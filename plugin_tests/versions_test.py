@@ -4,6 +4,7 @@ import json
 import mock
 import os
 import pathlib
+import shutil
 import time
 
 from girder import events
@@ -363,6 +364,20 @@ class VersionTestCase(BaseTestCase):
         )
         self.assertStatusOk(resp)
         self.assertTrue(len(resp.json), 2)
+        copied_versions = resp.json
+
+        # The fields updated while copying are not undone by a save of the root
+        root = Folder().load(copied_tale["versionsRootId"], force=True)
+        self.assertEqual(root["searchSeq"], len(copied_versions))
+        self.assertEqual(root["versionCount"], len(copied_versions))
+        self.assertEqual(str(root["latestVersionId"]), copied_versions[-1]["_id"])
+        # ...and the storage used by the copy is accounted for
+        from girder.plugins.wt_versioning.lib import util
+        from girder.plugins.wt_versioning.lib.accounting import scanTale
+
+        size, _ = scanTale("versions", util.getTaleVersionsDirPath(copied_tale))
+        self.assertGreater(size, 0)
+        self.assertEqual(root["storageUsage"], {"kind": "versions", "size": size, "trashSize": 0})
 
         # Clean up
         self._remove_example_tale(tale)
@@ -391,6 +406,17 @@ class VersionTestCase(BaseTestCase):
         self.assertTrue(len(resp.json), 1)
         self.assertEqual(resp.json[0]["itemId"], self.get_dataset([0])[0]["itemId"])
 
+        # The resolved dataset is cached, the manifest is not parsed again
+        with mock.patch(
+            "girder.plugins.wt_versioning.lib.dataset.ManifestParser"
+        ) as mock_parser:
+            resp2 = self.request(
+                path=f"/version/{version['_id']}/dataSet", method="GET", user=self.user_one
+            )
+            self.assertStatusOk(resp2)
+            mock_parser.assert_not_called()
+        self.assertEqual(resp.json, resp2.json)
+
         self._remove_example_tale(tale)
 
     @mock.patch("girder.plugins.wholetale.lib.manifest.ImageBuilder")
@@ -433,3 +459,1368 @@ class VersionTestCase(BaseTestCase):
             self.assertStatusOk(resp)
             self.assertTrue(len(resp.json), 1)
         self._remove_example_tale(tale)
+
+    @mock.patch("girder.plugins.wholetale.lib.manifest.ImageBuilder")
+    def testAsyncVersion(self, mock_builder):
+        from girder.plugins.jobs.constants import JobStatus
+        from girder.plugins.jobs.models.job import Job
+
+        mock_builder.return_value.container_config.repo2docker_version = \
+            "craigwillis/repo2docker:latest"
+        mock_builder.return_value.get_tag.return_value = \
+            "some_image_digest"
+        tale = self._create_example_tale(self.get_dataset([0]))
+        workspace = Folder().load(tale["workspaceId"], force=True)
+        with open(os.path.join(workspace["fsPath"], "file.txt"), "wb") as f:
+            f.write(b"Hello World!")
+
+        resp = self.request(
+            path="/version",
+            method="POST",
+            user=self.user_one,
+            params={"taleId": tale["_id"], "async": True},
+        )
+        self.assertStatusOk(resp)
+        version = resp.json
+        self.assertEqual(version["versionStatus"], 1)  # PENDING
+
+        for _ in range(20):
+            resp = self.request(
+                path=f"/version/{version['_id']}/status", method="GET", user=self.user_one
+            )
+            self.assertStatusOk(resp)
+            if resp.json["statusString"] != "PENDING":
+                break
+            time.sleep(0.5)
+        self.assertEqual(resp.json, {"status": 0, "statusString": "READY"})
+        version = Folder().load(version["_id"], force=True)
+        self.assertTrue(
+            os.path.isfile(os.path.join(version["fsPath"], "workspace", "file.txt"))
+        )
+
+        # Pending versions can be neither renamed nor deleted
+        Folder().update({"_id": version["_id"]}, {"$set": {"versionStatus": 1}})
+        resp = self.request(
+            path=f"/version/{version['_id']}", method="DELETE", user=self.user_one
+        )
+        self.assertStatus(resp, 409)
+        resp = self.request(
+            path=f"/version/{version['_id']}",
+            method="PUT",
+            user=self.user_one,
+            params={"name": "renamed"},
+        )
+        self.assertStatus(resp, 409)
+        resp = self.request(
+            path="/version",
+            method="DELETE",
+            user=self.user_one,
+            params={"ids": json.dumps([str(version["_id"])])},
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json["deleted"], [])
+        self.assertTrue(os.path.isdir(version["fsPath"]))
+        Folder().update({"_id": version["_id"]}, {"$set": {"versionStatus": 0}})
+
+        # Nothing changed, the reserved version is dropped by the job
+        resp = self.request(
+            path="/version",
+            method="POST",
+            user=self.user_one,
+            params={"taleId": tale["_id"], "async": True},
+        )
+        self.assertStatusOk(resp)
+        job_id = resp.json["meta"]["jobId"]
+        for _ in range(20):
+            job = Job().load(job_id, force=True)
+            if job["status"] == JobStatus.SUCCESS:
+                break
+            time.sleep(0.5)
+        self.assertEqual(job["status"], JobStatus.SUCCESS)
+        self.assertEqual(job["versionId"], str(version["_id"]))
+        self.assertIsNone(Folder().load(resp.json["_id"], force=True))
+
+        self._remove_example_tale(tale)
+
+    @mock.patch("girder.plugins.wholetale.lib.manifest.ImageBuilder")
+    def testVersionStats(self, mock_builder):
+        mock_builder.return_value.container_config.repo2docker_version = \
+            "craigwillis/repo2docker:latest"
+        mock_builder.return_value.get_tag.return_value = \
+            "some_image_digest"
+        tale = self._create_example_tale(self.get_dataset([0]))
+        workspace = Folder().load(tale["workspaceId"], force=True)
+        workspace_path = pathlib.Path(workspace["fsPath"])
+        (workspace_path / "file1.txt").write_bytes(b"Hello World!")
+
+        resp = self.request(
+            path="/version",
+            method="POST",
+            user=self.user_one,
+            params={"taleId": tale["_id"], "name": "v1"},
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(
+            resp.json["versionStats"],
+            {"fileCount": 1, "dirCount": 0, "size": 12, "newSize": 12},
+        )
+        first_version = resp.json
+
+        (workspace_path / "subdir").mkdir()
+        (workspace_path / "subdir" / "file2.txt").write_bytes(b"I'm in a directory!")
+        resp = self.request(
+            path="/version",
+            method="POST",
+            user=self.user_one,
+            params={"taleId": tale["_id"], "name": "v2"},
+        )
+        self.assertStatusOk(resp)
+
+        resp = self.request(
+            path="/version",
+            method="GET",
+            user=self.user_one,
+            params={"taleId": tale["_id"]},
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(
+            [_["versionStats"] for _ in resp.json],
+            [
+                {"fileCount": 1, "dirCount": 0, "size": 12, "newSize": 12},
+                {"fileCount": 2, "dirCount": 1, "size": 31, "newSize": 19},
+            ],
+        )
+
+        resp = self.request(
+            path="/wt_versioning/usage",
+            method="GET",
+            user=self.user_one,
+            params={"taleId": tale["_id"]},
+        )
+        self.assertStatus(resp, 403)
+        resp = self.request(
+            path="/wt_versioning/usage",
+            method="GET",
+            user=self.admin,
+            params={"taleId": tale["_id"]},
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json["versions"], {"size": 31, "trashSize": 0})
+        resp = self.request(
+            path="/wt_versioning/usage",
+            method="GET",
+            user=self.admin,
+            params={"limit": -1},
+        )
+        self.assertStatus(resp, 400)
+
+        # file1.txt comes back from v1 after it was removed in v3, it is not counted again
+        (workspace_path / "file1.txt").unlink()
+        resp = self.request(
+            path="/version",
+            method="POST",
+            user=self.user_one,
+            params={"taleId": tale["_id"], "name": "v3"},
+        )
+        self.assertStatusOk(resp)
+        resp = self.request(
+            method="PUT",
+            user=self.user_one,
+            path=f"/tale/{tale['_id']}/restore",
+            params={"versionId": first_version["_id"]},
+        )
+        self.assertStatusOk(resp)
+        resp = self.request(
+            path="/version",
+            method="POST",
+            user=self.user_one,
+            params={"taleId": tale["_id"], "name": "v4"},
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(
+            resp.json["versionStats"],
+            {"fileCount": 1, "dirCount": 0, "size": 12, "newSize": 0},
+        )
+        resp = self.request(
+            path="/wt_versioning/usage",
+            method="GET",
+            user=self.admin,
+            params={"taleId": tale["_id"]},
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json["versions"], {"size": 31, "trashSize": 0})
+
+        # A file moved since the previous version is neither new nor worth a rescan
+        from girder.plugins.wt_versioning.lib.accounting import StorageAccounting
+
+        (workspace_path / "file1.txt").rename(workspace_path / "moved.txt")
+        with mock.patch.object(
+            StorageAccounting, "rescanTale", wraps=StorageAccounting().rescanTale
+        ) as rescan:
+            resp = self.request(
+                path="/version",
+                method="POST",
+                user=self.user_one,
+                params={"taleId": tale["_id"], "name": "v5"},
+            )
+            self.assertStatusOk(resp)
+        rescan.assert_not_called()
+        self.assertEqual(resp.json["versionStats"]["newSize"], 0)
+        self._remove_example_tale(tale)
+
+    @mock.patch("girder.plugins.wholetale.lib.manifest.ImageBuilder")
+    def testRetention(self, mock_builder):
+        from girder.plugins.wt_versioning.lib.retention import RetentionPolicy
+        from girder.plugins.wt_versioning.lib.version_hierarchy import VersionHierarchyModel
+
+        mock_builder.return_value.container_config.repo2docker_version = \
+            "craigwillis/repo2docker:latest"
+        mock_builder.return_value.get_tag.return_value = \
+            "some_image_digest"
+        tale = self._create_example_tale(self.get_dataset([0]))
+        workspace = Folder().load(tale["workspaceId"], force=True)
+        workspace_path = pathlib.Path(workspace["fsPath"])
+
+        versions = []
+        for i in range(4):
+            (workspace_path / f"file{i}.txt").write_text(f"File {i}")
+            resp = self.request(
+                path="/version",
+                method="POST",
+                user=self.user_one,
+                params={"taleId": tale["_id"], "name": f"v{i}"},
+            )
+            self.assertStatusOk(resp)
+            versions.append(Folder().load(resp.json["_id"], force=True))
+
+        model = VersionHierarchyModel()
+        model.incrementReferenceCount(versions[0])
+        tale = Tale().load(tale["_id"], force=True)
+        tale["restoredFrom"] = versions[1]["_id"]
+        tale = Tale().save(tale)
+
+        self.assertEqual(model.prune(tale, RetentionPolicy()), [])
+        removed = model.prune(tale, RetentionPolicy(keepLast=1))
+        self.assertEqual([_["_id"] for _ in removed], [versions[2]["_id"]])
+        trash = pathlib.Path(versions[2]["fsPath"]).parent / ".trash"
+        self.assertTrue((trash / str(versions[2]["_id"])).is_dir())
+
+        resp = self.request(
+            path="/version",
+            method="GET",
+            user=self.user_one,
+            params={"taleId": tale["_id"]},
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(
+            [_["name"] for _ in resp.json], ["v0", "v1", "v3"]
+        )
+
+        # Daily retention keeps the newest version of each day
+        removed = model.prune(tale, RetentionPolicy(keepDaily=1))
+        self.assertEqual(removed, [])
+        model.decrementReferenceCount(Folder().load(versions[0]["_id"], force=True))
+        removed = model.prune(tale, RetentionPolicy(keepDaily=1))
+        self.assertEqual([_["_id"] for _ in removed], [versions[0]["_id"]])
+
+        # A failed newest version neither expires nor takes the place of the last ready one
+        tale["restoredFrom"] = None
+        tale = Tale().save(tale)
+        Folder().update({"_id": versions[3]["_id"]}, {"$set": {"versionStatus": 2}})
+        self.assertEqual(model.prune(tale, RetentionPolicy(keepLast=1)), [])
+        self.assertIsNotNone(Folder().load(versions[1]["_id"], force=True))
+        self.assertIsNotNone(Folder().load(versions[3]["_id"], force=True))
+        self._remove_example_tale(tale)
+
+    @mock.patch("girder.plugins.wholetale.lib.manifest.ImageBuilder")
+    def testArchive(self, mock_builder):
+        import io
+        import tarfile
+        import zipfile
+        from girder.plugins.wt_versioning.lib import util
+        from girder.plugins.wt_versioning.lib.importer import VersionImporter
+
+        mock_builder.return_value.container_config.repo2docker_version = \
+            "craigwillis/repo2docker:latest"
+        mock_builder.return_value.get_tag.return_value = \
+            "some_image_digest"
+        tale = self._create_example_tale(self.get_dataset([0]))
+        workspace = Folder().load(tale["workspaceId"], force=True)
+        workspace_path = pathlib.Path(workspace["fsPath"])
+        (workspace_path / "file1.txt").write_bytes(b"Hello World!")
+        os.link(workspace_path / "file1.txt", workspace_path / "file2.txt")
+
+        resp = self.request(
+            path="/version",
+            method="POST",
+            user=self.user_one,
+            params={"taleId": tale["_id"], "name": "v1"},
+        )
+        self.assertStatusOk(resp)
+        version = resp.json
+
+        resp = self.request(
+            path=f"/version/{version['_id']}/archive",
+            method="GET",
+            user=self.user_one,
+            isJson=False,
+        )
+        self.assertStatusOk(resp)
+        with zipfile.ZipFile(io.BytesIO(self.getBody(resp, text=False))) as zf:
+            self.assertEqual(zf.read("v1/workspace/file2.txt"), b"Hello World!")
+            self.assertIn("v1/manifest.json", zf.namelist())
+            self.assertIn("v1/version.json", zf.namelist())
+
+        resp = self.request(
+            path=f"/version/{version['_id']}/archive",
+            method="GET",
+            user=self.user_one,
+            params={"format": "tar"},
+            isJson=False,
+        )
+        self.assertStatusOk(resp)
+        data = self.getBody(resp, text=False)
+        self.assertEqual(int(resp.headers["Content-Length"]), len(data))
+        with tarfile.open(fileobj=io.BytesIO(data)) as tf:
+            self.assertTrue(tf.getmember("v1/workspace/file1.txt").isfile())
+            self.assertTrue(tf.getmember("v1/workspace/file2.txt").islnk())
+
+        resp = self.request(
+            path=f"/version/{version['_id']}/archive",
+            method="GET",
+            user=self.user_one,
+            params={"format": "tar"},
+            additionalHeaders=[("Range", "bytes=1000-")],
+            isJson=False,
+        )
+        self.assertStatus(resp, 206)
+        self.assertEqual(self.getBody(resp, text=False), data[1000:])
+        self.assertEqual(
+            resp.headers["Content-Range"], f"bytes 1000-{len(data) - 1}/{len(data)}"
+        )
+        etag = resp.headers["ETag"]
+
+        # The download is resumed only if the archive did not change
+        for if_range, status in ((etag, 206), ('"stale"', 200)):
+            resp = self.request(
+                path=f"/version/{version['_id']}/archive",
+                method="GET",
+                user=self.user_one,
+                params={"format": "tar"},
+                additionalHeaders=[("Range", "bytes=1000-"), ("If-Range", if_range)],
+                isJson=False,
+            )
+            self.assertStatus(resp, status)
+            self.assertEqual(resp.headers["ETag"], etag)
+
+        # The creation time is stored in the archive, not taken from the directory
+        version = Folder().load(version["_id"], force=True)
+        os.utime(version["fsPath"], (0, 0))
+        resp = self.request(
+            path=f"/version/{version['_id']}/archive",
+            method="GET",
+            user=self.user_one,
+            params={"format": "tar"},
+            isJson=False,
+        )
+        self.assertStatusOk(resp)
+        # ...and the archive is the same, since the mtime of the root is the creation time
+        self.assertEqual(self.getBody(resp, text=False), data)
+        with tarfile.open(fileobj=io.BytesIO(data)) as tf:
+            self.assertEqual(
+                json.load(tf.extractfile("v1/version.json")),
+                {"name": "v1", "created": version["created"].isoformat()},
+            )
+        importer = VersionImporter(
+            tale, Folder().load(tale["versionsRootId"], force=True),
+            util.getTaleVersionsDirPath(tale), self.user_one,
+        )
+        imported = importer.run(io.BytesIO(data))
+        self.assertEqual([_["name"] for _ in imported], ["v1 (1)"])
+        self.assertEqual(imported[0]["created"], version["created"])
+        self._remove_example_tale(tale)
+
+    @mock.patch("girder.plugins.wholetale.lib.manifest.ImageBuilder")
+    def testImportVersions(self, mock_builder):
+        import io
+        import stat
+        import tarfile
+        from girder.plugins.jobs.constants import JobStatus
+        from girder.plugins.jobs.models.job import Job
+        from girder.plugins.wt_versioning.lib import util
+        from girder.plugins.wt_versioning.lib.importer import VersionImporter
+        from girder.plugins.wt_versioning.lib.search import VersionFile
+
+        mock_builder.return_value.container_config.repo2docker_version = \
+            "craigwillis/repo2docker:latest"
+        mock_builder.return_value.get_tag.return_value = \
+            "some_image_digest"
+        tale = self._create_example_tale(self.get_dataset([0]))
+        workspace = Folder().load(tale["workspaceId"], force=True)
+        workspace_path = pathlib.Path(workspace["fsPath"])
+        (workspace_path / "file1.txt").write_bytes(b"Hello World!")
+        resp = self.request(
+            path="/version",
+            method="POST",
+            user=self.user_one,
+            params={"taleId": tale["_id"], "name": "v1"},
+        )
+        self.assertStatusOk(resp)
+        version_path = pathlib.Path(Folder().load(resp.json["_id"], force=True)["fsPath"])
+
+        # Two versions sharing file1.txt, the second one with an extra file
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w:gz") as tf:
+            tf.add(version_path, arcname="imported 1")
+            tf.add(version_path, arcname="imported 2")
+            info = tarfile.TarInfo("imported 2/workspace/file2.txt")
+            info.size = 5
+            info.mode = 0o4755
+            tf.addfile(info, io.BytesIO(b"Extra"))
+        private = Folder().findOne({"parentId": self.user_one["_id"], "name": "Private"})
+        archive = self.uploadFile("versions.tgz", buf.getvalue(), self.user_one, private)
+
+        resp = self.request(
+            path="/version/import",
+            method="POST",
+            user=self.user_one,
+            params={"taleId": tale["_id"], "fileId": archive["_id"]},
+        )
+        self.assertStatusOk(resp)
+        for _ in range(20):
+            job = Job().load(resp.json["_id"], force=True)
+            if job["status"] in (JobStatus.SUCCESS, JobStatus.ERROR):
+                break
+            time.sleep(0.5)
+        self.assertEqual(job["status"], JobStatus.SUCCESS)
+        self.assertEqual(len(job["versionIds"]), 2)
+
+        imported = [Folder().load(_, force=True) for _ in job["versionIds"]]
+        self.assertEqual([_["name"] for _ in imported], ["imported 1", "imported 2"])
+        paths = [pathlib.Path(_["fsPath"]) / "workspace" for _ in imported]
+        self.assertTrue((paths[0] / "file1.txt").samefile(paths[1] / "file1.txt"))
+        self.assertEqual((paths[1] / "file2.txt").read_bytes(), b"Extra")
+        # No setuid bit from the archive
+        self.assertEqual(stat.S_IMODE((paths[1] / "file2.txt").stat().st_mode), 0o755)
+        self.assertEqual(imported[1]["versionStats"]["newSize"], 5)
+        with open(pathlib.Path(imported[1]["fsPath"]) / "manifest.json") as fp:
+            self.assertIn(str(imported[1]["_id"]), fp.read())
+
+        root = Folder().load(tale["versionsRootId"], force=True)
+        self.assertFalse(root["versionsCriticalSectionFlag"])
+        # Not undone by a save of the root loaded before the import
+        self.assertEqual(root["searchSeq"], 3)
+        self.assertEqual(root["versionCount"], 3)
+        self.assertEqual(
+            root["storageUsage"]["size"],
+            12 + sum(_["versionStats"]["newSize"] for _ in imported),
+        )
+
+        # A failed import leaves no folders behind and is not found by searches
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w") as tf:
+            tf.add(version_path, arcname="good")
+            info = tarfile.TarInfo("bad/workspace/file.txt")
+            info.size = 3
+            tf.addfile(info, io.BytesIO(b"Bad"))
+        buf.seek(0)
+        found = VersionFile().search(root, limit=0)
+        before = sorted(os.listdir(util.getTaleVersionsDirPath(tale)))
+        importer = VersionImporter(tale, root, util.getTaleVersionsDirPath(tale), self.user_one)
+        with self.assertRaises(ValueError):
+            importer.run(buf)
+        self.assertEqual(Folder().find({"parentId": root["_id"]}).count(), 3)
+        self.assertEqual(VersionFile().search(root, limit=0), found)
+        self.assertEqual(sorted(os.listdir(util.getTaleVersionsDirPath(tale))), before)
+        self._remove_example_tale(tale)
+
+    @mock.patch("girder.plugins.wholetale.lib.manifest.ImageBuilder")
+    def testImportHostileArchives(self, mock_builder):
+        import io
+        import tarfile
+        import tempfile
+        from girder.plugins.wt_versioning.lib import util
+        from girder.plugins.wt_versioning.lib.importer import VersionImporter
+
+        mock_builder.return_value.container_config.repo2docker_version = \
+            "craigwillis/repo2docker:latest"
+        mock_builder.return_value.get_tag.return_value = \
+            "some_image_digest"
+        tale = self._create_example_tale(self.get_dataset([0]))
+        root = Folder().load(tale["versionsRootId"], force=True)
+        root_dir = util.getTaleVersionsDirPath(tale)
+        outside = pathlib.Path(tempfile.mkdtemp())
+
+        def archive(*members):
+            buf = io.BytesIO()
+            with tarfile.open(fileobj=buf, mode="w") as tf:
+                for name, kind, arg in members:
+                    info = tarfile.TarInfo(name)
+                    if kind == "file":
+                        info.size = len(arg)
+                        tf.addfile(info, io.BytesIO(arg))
+                        continue
+                    info.type = {"dir": tarfile.DIRTYPE, "sym": tarfile.SYMTYPE,
+                                 "lnk": tarfile.LNKTYPE}[kind]
+                    info.linkname = arg or ""
+                    tf.addfile(info)
+            buf.seek(0)
+            return buf
+
+        before = sorted(os.listdir(root_dir)) if root_dir.is_dir() else []
+        hostile = [
+            # Links leading outside of the version
+            archive(("v/workspace/evil", "sym", outside.as_posix())),
+            archive(("v/workspace/evil", "sym", "../../../escaped")),
+            archive(("v/workspace/evil", "sym", "a/../../../escaped")),
+            # Writing through a link, even one within the version
+            archive(
+                ("v/workspace/sub", "dir", None),
+                ("v/workspace/link", "sym", "sub"),
+                ("v/workspace/link/file.txt", "file", b"through"),
+            ),
+            archive(
+                ("v/workspace/link", "sym", "."),
+                ("v/workspace/link", "file", b"replaced"),
+            ),
+            # Hard links to files that are not in the archive
+            archive(("v/workspace/passwd", "lnk", "/etc/passwd")),
+            archive(("v/workspace/other", "lnk", "other version/workspace/file.txt")),
+            archive(("../escaped", "file", b"Escaped")),
+        ]
+        for buf in hostile:
+            importer = VersionImporter(tale, root, root_dir, self.user_one)
+            with self.assertRaises(ValueError):
+                importer.run(buf)
+            self.assertEqual(sorted(os.listdir(root_dir)) if root_dir.is_dir() else [], before)
+        self.assertEqual(os.listdir(outside), [])
+        self.assertFalse((root_dir.parent / "escaped").exists())
+        shutil.rmtree(outside)
+        self._remove_example_tale(tale)
+
+    @mock.patch("girder.plugins.wholetale.lib.manifest.ImageBuilder")
+    def testDiff(self, mock_builder):
+        mock_builder.return_value.container_config.repo2docker_version = \
+            "craigwillis/repo2docker:latest"
+        mock_builder.return_value.get_tag.return_value = \
+            "some_image_digest"
+        tale = self._create_example_tale(self.get_dataset([0]))
+        workspace = Folder().load(tale["workspaceId"], force=True)
+        workspace_path = pathlib.Path(workspace["fsPath"])
+        (workspace_path / "file1.txt").write_bytes(b"Hello World!")
+        (workspace_path / "file2.txt").write_bytes(b"Bye")
+
+        versions = []
+        resp = self.request(
+            path="/version",
+            method="POST",
+            user=self.user_one,
+            params={"taleId": tale["_id"], "name": "v1"},
+        )
+        self.assertStatusOk(resp)
+        versions.append(resp.json)
+
+        # Files are replaced, not modified in place, as done by the WebDAV FS
+        (workspace_path / "file1.txt").unlink()
+        (workspace_path / "file1.txt").write_bytes(b"Hello World!!")
+        (workspace_path / "file2.txt").unlink()
+        (workspace_path / "dir").mkdir()
+        (workspace_path / "dir" / "file3.txt").write_bytes(b"New")
+        tale = Tale().load(tale["_id"], force=True)
+        tale["title"] = "A better title"
+        tale = Tale().save(tale)
+
+        resp = self.request(
+            path="/version",
+            method="POST",
+            user=self.user_one,
+            params={"taleId": tale["_id"], "name": "v2"},
+        )
+        self.assertStatusOk(resp)
+        versions.append(resp.json)
+
+        for _ in range(2):  # second request is served from the cache
+            resp = self.request(
+                path=f"/version/{versions[1]['_id']}/diff",
+                method="GET",
+                user=self.user_one,
+                params={"against": versions[0]["_id"]},
+                isJson=False,
+            )
+            self.assertStatusOk(resp)
+            diff = json.loads(self.getBody(resp))
+            self.assertEqual(diff["metadata"]["title"]["new"], "A better title")
+            self.assertEqual(
+                diff["changes"],
+                [
+                    {"path": "dir", "change": "added", "type": "directory"},
+                    {
+                        "path": "file1.txt",
+                        "change": "modified",
+                        "type": "file",
+                        "size": 13,
+                        "oldSize": 12,
+                    },
+                    {"path": "file2.txt", "change": "removed", "type": "file", "size": 3},
+                ],
+            )
+        version_path = pathlib.Path(Folder().load(versions[1]["_id"], force=True)["fsPath"])
+        cached = list((version_path.parent / ".cache" / "diff").iterdir())
+        self.assertEqual(len(cached), 1)
+
+        # Only versions of the same tale are compared
+        other_tale = self._create_example_tale(self.get_dataset([0]))
+        resp = self.request(
+            path="/version",
+            method="POST",
+            user=self.user_one,
+            params={"taleId": other_tale["_id"], "name": "other"},
+        )
+        self.assertStatusOk(resp)
+        for against in (tale["workspaceId"], resp.json["_id"]):
+            for vid, aid in ((versions[1]["_id"], against), (against, versions[1]["_id"])):
+                resp = self.request(
+                    path=f"/version/{vid}/diff",
+                    method="GET",
+                    user=self.user_one,
+                    params={"against": aid},
+                    isJson=False,
+                )
+                self.assertStatus(resp, 400)
+        self._remove_example_tale(other_tale)
+
+        resp = self.request(
+            path=f"/version/{versions[0]['_id']}", method="DELETE", user=self.user_one
+        )
+        self.assertStatusOk(resp)
+        self.assertFalse(cached[0].exists())
+        self._remove_example_tale(tale)
+
+    @mock.patch("girder.plugins.wholetale.lib.manifest.ImageBuilder")
+    def testListFiles(self, mock_builder):
+        mock_builder.return_value.container_config.repo2docker_version = \
+            "craigwillis/repo2docker:latest"
+        mock_builder.return_value.get_tag.return_value = \
+            "some_image_digest"
+        tale = self._create_example_tale(self.get_dataset([0]))
+        workspace = Folder().load(tale["workspaceId"], force=True)
+        workspace_path = pathlib.Path(workspace["fsPath"])
+        for i in range(5):
+            (workspace_path / f"file{i}.txt").write_bytes(b"x" * i)
+        (workspace_path / "dir").mkdir()
+        (workspace_path / "dir" / "nested.txt").write_bytes(b"Nested")
+
+        resp = self.request(
+            path="/version",
+            method="POST",
+            user=self.user_one,
+            params={"taleId": tale["_id"], "name": "v1"},
+        )
+        self.assertStatusOk(resp)
+        version = resp.json
+        version_path = pathlib.Path(Folder().load(version["_id"], force=True)["fsPath"])
+        self.assertTrue((version_path / ".index").is_file())
+
+        def list_all(path):
+            names, cursor = [], None
+            while True:
+                params = {"path": path, "limit": 2}
+                if cursor:
+                    params["cursor"] = cursor
+                resp = self.request(
+                    path=f"/version/{version['_id']}/files",
+                    method="GET",
+                    user=self.user_one,
+                    params=params,
+                )
+                self.assertStatusOk(resp)
+                self.assertLessEqual(len(resp.json["items"]), 2)
+                names += [_["name"] for _ in resp.json["items"]]
+                cursor = resp.json["cursor"]
+                if cursor is None:
+                    return names
+
+        self.assertEqual(list_all(""), ["dir"] + [f"file{i}.txt" for i in range(5)])
+        self.assertEqual(list_all("dir"), ["nested.txt"])
+
+        # Versions without an index get one on first use
+        (version_path / ".index").unlink()
+        resp = self.request(
+            path=f"/version/{version['_id']}/files",
+            method="GET",
+            user=self.user_one,
+            params={"path": "/dir/"},
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(
+            resp.json["items"],
+            [
+                {
+                    "name": "nested.txt",
+                    "path": "dir/nested.txt",
+                    "type": "file",
+                    "size": 6,
+                    "mtime": int((version_path / "workspace/dir/nested.txt").stat().st_mtime),
+                }
+            ],
+        )
+
+        for path in ("file1.txt", "../..", "missing"):
+            resp = self.request(
+                path=f"/version/{version['_id']}/files",
+                method="GET",
+                user=self.user_one,
+                params={"path": path},
+            )
+            self.assertStatus(resp, 400)
+        self._remove_example_tale(tale)
+
+    @mock.patch("girder.plugins.wholetale.lib.manifest.ImageBuilder")
+    def testFileHistory(self, mock_builder):
+        mock_builder.return_value.container_config.repo2docker_version = \
+            "craigwillis/repo2docker:latest"
+        mock_builder.return_value.get_tag.return_value = \
+            "some_image_digest"
+        tale = self._create_example_tale(self.get_dataset([0]))
+        workspace = Folder().load(tale["workspaceId"], force=True)
+        figure = pathlib.Path(workspace["fsPath"]) / "results" / "figure.png"
+        figure.parent.mkdir()
+
+        # Files are replaced, not modified in place, as done by the WebDAV FS
+        unchanged, removed = object(), object()
+        steps = [b"v1", unchanged, b"v3", unchanged, removed, b"v6"]
+        versions = []
+        for i, content in enumerate(steps):
+            if content is not unchanged and figure.exists():
+                figure.unlink()
+            if isinstance(content, bytes):
+                figure.write_bytes(content)
+            resp = self.request(
+                path="/version",
+                method="POST",
+                user=self.user_one,
+                params={"taleId": tale["_id"], "name": f"v{i + 1}", "force": True},
+            )
+            self.assertStatusOk(resp)
+            versions.append(resp.json["_id"])
+        # v5 has no index, the workspace is checked instead
+        version_path = pathlib.Path(Folder().load(versions[4], force=True)["fsPath"])
+        (version_path / ".index").unlink()
+
+        resp = self.request(
+            path="/version/history",
+            method="GET",
+            user=self.user_one,
+            params={"taleId": tale["_id"], "path": "results/figure.png"},
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(
+            [(_["name"], _["change"]) for _ in resp.json],
+            [("v1", "added"), ("v3", "modified"), ("v5", "removed"), ("v6", "added")],
+        )
+        self.assertEqual(resp.json[1]["size"], 2)
+
+        resp = self.request(
+            path="/version/history",
+            method="GET",
+            user=self.user_one,
+            params={"taleId": tale["_id"], "path": "results"},
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual([(_["name"], _["change"]) for _ in resp.json], [("v1", "added")])
+
+        resp = self.request(
+            path="/version/history",
+            method="GET",
+            user=self.user_one,
+            params={"taleId": tale["_id"], "path": "../secret"},
+        )
+        self.assertStatus(resp, 400)
+        self._remove_example_tale(tale)
+
+    @mock.patch("girder.plugins.wholetale.lib.manifest.ImageBuilder")
+    def testSearch(self, mock_builder):
+        mock_builder.return_value.container_config.repo2docker_version = \
+            "craigwillis/repo2docker:latest"
+        mock_builder.return_value.get_tag.return_value = \
+            "some_image_digest"
+        tale = self._create_example_tale(self.get_dataset([0]))
+        workspace = pathlib.Path(Folder().load(tale["workspaceId"], force=True)["fsPath"])
+        (workspace / "data").mkdir()
+
+        def create_version(name):
+            resp = self.request(
+                path="/version",
+                method="POST",
+                user=self.user_one,
+                params={"taleId": tale["_id"], "name": name, "force": True},
+            )
+            self.assertStatusOk(resp)
+            return resp.json["_id"]
+
+        def search(**params):
+            resp = self.request(
+                path="/version/search",
+                method="GET",
+                user=self.user_one,
+                params=dict(params, taleId=tale["_id"]),
+            )
+            self.assertStatusOk(resp)
+            return [(_["path"], [v["name"] for v in _["versions"]]) for _ in resp.json]
+
+        (workspace / "data" / "a.csv").write_bytes(b"1")
+        create_version("v1")
+        (workspace / "data" / "b.csv").write_bytes(b"22")
+        v2 = create_version("v2")
+        (workspace / "data" / "a.csv").unlink()
+        (workspace / "data" / "a.csv").write_bytes(b"333")
+        (workspace / "data" / "b.csv").unlink()
+        create_version("v3")
+
+        self.assertEqual(
+            search(name="*.csv"),
+            [
+                ("data/a.csv", ["v1", "v2"]),
+                ("data/a.csv", ["v3"]),
+                ("data/b.csv", ["v2"]),
+            ],
+        )
+        self.assertEqual(search(regex="^data$"), [("data", ["v1", "v2", "v3"])])
+        # Regular expressions match whole paths
+        self.assertEqual(search(regex="data"), [("data", ["v1", "v2", "v3"])])
+        self.assertEqual(search(regex="data/b.*"), [("data/b.csv", ["v2"])])
+        self.assertEqual(
+            search(name="*.csv", minSize=2), [("data/a.csv", ["v3"]), ("data/b.csv", ["v2"])]
+        )
+        self.assertEqual(search(name="*.csv", maxSize=1), [("data/a.csv", ["v1", "v2"])])
+        self.assertEqual(search(name="*.csv", limit=1, offset=2), [("data/b.csv", ["v2"])])
+        self.assertEqual(search(modifiedBefore=0), [])
+
+        resp = self.request(
+            path="/version/search",
+            method="GET",
+            user=self.user_one,
+            params={"taleId": tale["_id"], "regex": "("},
+        )
+        self.assertStatus(resp, 400)
+        resp = self.request(
+            path="/version/search",
+            method="GET",
+            user=self.user_one,
+            params={"taleId": tale["_id"], "regex": "a" * 257},
+        )
+        self.assertStatus(resp, 400)
+
+        # Entries only present in a removed version are dropped
+        resp = self.request(path=f"/version/{v2}", method="DELETE", user=self.user_one)
+        self.assertStatusOk(resp)
+        self.assertEqual(
+            search(name="*.csv"), [("data/a.csv", ["v1"]), ("data/a.csv", ["v3"])]
+        )
+        self._remove_example_tale(tale)
+
+    @mock.patch("girder.plugins.wholetale.lib.manifest.ImageBuilder")
+    def testSharedWorkspace(self, mock_builder):
+        mock_builder.return_value.container_config.repo2docker_version = \
+            "craigwillis/repo2docker:latest"
+        mock_builder.return_value.get_tag.return_value = \
+            "some_image_digest"
+        tale = self._create_example_tale(self.get_dataset([0]))
+        workspace = pathlib.Path(Folder().load(tale["workspaceId"], force=True)["fsPath"])
+        (workspace / "file.txt").write_bytes(b"data")
+
+        versions = []
+        for i in range(3):
+            tale = Tale().load(tale["_id"], force=True)
+            tale["title"] = f"Title {i}"
+            tale = Tale().save(tale)
+            resp = self.request(
+                path="/version",
+                method="POST",
+                user=self.user_one,
+                params={"taleId": tale["_id"], "name": f"v{i + 1}"},
+            )
+            self.assertStatusOk(resp)
+            versions.append(Folder().load(resp.json["_id"], force=True))
+        v1, v2, v3 = versions
+
+        # Only the title changed, v2 and v3 link to the workspace of v1
+        for version in (v2, v3):
+            version_path = pathlib.Path(version["fsPath"])
+            self.assertTrue((version_path / "workspace").is_symlink())
+            self.assertEqual(version["workspaceVersionId"], v1["_id"])
+            self.assertEqual(version["versionStats"]["newSize"], 0)
+            self.assertEqual(version["versionStats"]["fileCount"], 1)
+            self.assertTrue((version_path / "workspace" / "file.txt").samefile(
+                pathlib.Path(v1["fsPath"]) / "workspace" / "file.txt"
+            ))
+        resp = self.request(
+            path=f"/version/{v3['_id']}/files", method="GET", user=self.user_one
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual([_["name"] for _ in resp.json["items"]], ["file.txt"])
+
+        # Removing v1 moves its workspace to v2
+        resp = self.request(path=f"/version/{v1['_id']}", method="DELETE", user=self.user_one)
+        self.assertStatusOk(resp)
+        v2 = Folder().load(v2["_id"], force=True)
+        v3 = Folder().load(v3["_id"], force=True)
+        self.assertNotIn("workspaceVersionId", v2)
+        self.assertFalse((pathlib.Path(v2["fsPath"]) / "workspace").is_symlink())
+        self.assertEqual(v3["workspaceVersionId"], v2["_id"])
+        self.assertEqual(
+            (pathlib.Path(v3["fsPath"]) / "workspace" / "file.txt").read_bytes(), b"data"
+        )
+
+        # A removed file is a change of the workspace
+        (workspace / "file.txt").unlink()
+        resp = self.request(
+            path="/version",
+            method="POST",
+            user=self.user_one,
+            params={"taleId": tale["_id"], "name": "v4"},
+        )
+        self.assertStatusOk(resp)
+        v4 = Folder().load(resp.json["_id"], force=True)
+        self.assertNotIn("workspaceVersionId", v4)
+        self.assertEqual(list((pathlib.Path(v4["fsPath"]) / "workspace").iterdir()), [])
+        self._remove_example_tale(tale)
+
+    @mock.patch("girder.plugins.wholetale.lib.manifest.ImageBuilder")
+    def testEnvironmentStorage(self, mock_builder):
+        from girder.plugins.wt_versioning.lib.version_hierarchy import VersionHierarchyModel
+
+        mock_builder.return_value.container_config.repo2docker_version = \
+            "craigwillis/repo2docker:latest"
+        mock_builder.return_value.get_tag.return_value = \
+            "some_image_digest"
+        tale = self._create_example_tale(self.get_dataset([0]))
+
+        versions = []
+        for i in range(2):
+            tale = Tale().load(tale["_id"], force=True)
+            tale["title"] = f"Title {i}"
+            tale = Tale().save(tale)
+            resp = self.request(
+                path="/version",
+                method="POST",
+                user=self.user_one,
+                params={"taleId": tale["_id"], "name": f"v{i + 1}"},
+            )
+            self.assertStatusOk(resp)
+            versions.append(Folder().load(resp.json["_id"], force=True))
+        v1, v2 = versions
+
+        # Only the title changed, the environment is stored once
+        self.assertEqual(v1["environmentDigest"], v2["environmentDigest"])
+        env1 = pathlib.Path(v1["fsPath"]) / "environment.json"
+        env2 = pathlib.Path(v2["fsPath"]) / "environment.json"
+        self.assertTrue(env1.samefile(env2))
+        objects = env1.parent.parent / ".objects"
+        self.assertEqual(
+            [_.name for _ in objects.iterdir()], [v1["environmentDigest"] + ".json"]
+        )
+        restored = VersionHierarchyModel().restoreTaleFromVersion(v2)
+        self.assertEqual(restored["title"], "Title 1")
+
+        # Objects are deleted with the last version using them
+        for version in versions:
+            resp = self.request(
+                path=f"/version/{version['_id']}", method="DELETE", user=self.user_one
+            )
+            self.assertStatusOk(resp)
+            resp = self.request(
+                path="/wt_versioning/trash",
+                method="DELETE",
+                user=self.user_one,
+                params={"taleId": tale["_id"]},
+            )
+            self.assertStatusOk(resp)
+            self.assertEqual(len(list(objects.iterdir())), 1 if version is v1 else 0)
+        self._remove_example_tale(tale)
+
+    @mock.patch("girder.plugins.wholetale.lib.manifest.ImageBuilder")
+    def testMetrics(self, mock_builder):
+        from girder.plugins.wt_versioning.lib.metrics import Metrics
+
+        mock_builder.return_value.container_config.repo2docker_version = \
+            "craigwillis/repo2docker:latest"
+        mock_builder.return_value.get_tag.return_value = \
+            "some_image_digest"
+        Metrics().reset()
+        tale = self._create_example_tale(self.get_dataset([0]))
+        workspace = pathlib.Path(Folder().load(tale["workspaceId"], force=True)["fsPath"])
+        (workspace / "file.txt").write_bytes(b"data")
+        resp = self.request(
+            path="/version",
+            method="POST",
+            user=self.user_one,
+            params={"taleId": tale["_id"], "name": "v1"},
+        )
+        self.assertStatusOk(resp)
+
+        resp = self.request(path="/wt_versioning/metrics", method="GET", user=self.user_one)
+        self.assertStatus(resp, 403)
+        resp = self.request(
+            path="/wt_versioning/metrics", method="GET", user=self.admin, isJson=False
+        )
+        self.assertStatusOk(resp)
+        self.assertTrue(resp.headers["Content-Type"].startswith("text/plain"))
+        lines = self.getBody(resp).splitlines()
+        self.assertIn(
+            'wt_versioning_operation_duration_seconds_count{operation="version_create"} 1', lines
+        )
+        for phase in ("admission", "check_modified", "create_subdir", "snapshot", "link"):
+            self.assertIn(
+                "wt_versioning_phase_duration_seconds_count"
+                f'{{operation="version_create",phase="{phase}"}} 1',
+                lines,
+            )
+        self.assertIn('wt_versioning_links_total{operation="version_create"} 1', lines)
+        self._remove_example_tale(tale)
+
+    @mock.patch("girder.plugins.wholetale.lib.manifest.ImageBuilder")
+    def testSlowOperationLog(self, mock_builder):
+        from girder.plugins.wt_versioning.constants import PluginSettings
+
+        mock_builder.return_value.container_config.repo2docker_version = \
+            "craigwillis/repo2docker:latest"
+        mock_builder.return_value.get_tag.return_value = \
+            "some_image_digest"
+        tale = self._create_example_tale(self.get_dataset([0]))
+        Setting().set(PluginSettings.SLOW_OPERATION_MS, 1)
+        try:
+            with mock.patch("girder.plugins.wt_versioning.lib.metrics.logger") as logger:
+                for status in (200, 303):
+                    resp = self.request(
+                        path="/version",
+                        method="POST",
+                        user=self.user_one,
+                        params={"taleId": tale["_id"]},
+                    )
+                    self.assertStatus(resp, status)
+            records = [
+                json.loads(call[0][1]) for call in logger.warning.call_args_list
+                if call[0][0].startswith("Slow versioning operation")
+            ]
+        finally:
+            Setting().set(PluginSettings.SLOW_OPERATION_MS, 0)
+
+        records = [_ for _ in records if _["operation"] == "version_create"]
+        self.assertEqual(len(records), 2)
+        for record, notModified in zip(records, (False, True)):
+            self.assertEqual(record["taleId"], str(tale["_id"]))
+            self.assertEqual(record["notModified"], notModified)
+            self.assertEqual(record["failed"], notModified)
+            self.assertIn("lockWait", record)
+        self.assertIn("snapshot", records[0]["phases"])
+        self.assertIn("same_tree", records[1]["phases"])
+        self.assertIn("files", records[0]["counters"])
+        self._remove_example_tale(tale)
+
+    @mock.patch("girder.plugins.wholetale.lib.manifest.ImageBuilder")
+    def testProfiling(self, mock_builder):
+        import pstats
+        import tempfile
+        from girder.plugins.wt_versioning.constants import PluginSettings
+
+        mock_builder.return_value.container_config.repo2docker_version = \
+            "craigwillis/repo2docker:latest"
+        mock_builder.return_value.get_tag.return_value = \
+            "some_image_digest"
+        tale = self._create_example_tale(self.get_dataset([0]))
+        profile_dir = tempfile.mkdtemp()
+        Setting().set(PluginSettings.PROFILE_DIR, profile_dir)
+        Setting().set(PluginSettings.PROFILE_REQUESTS, 2)
+        try:
+            for _ in range(3):
+                resp = self.request(
+                    path="/version",
+                    method="GET",
+                    user=self.user_one,
+                    params={"taleId": tale["_id"]},
+                )
+                self.assertStatusOk(resp)
+            self.assertEqual(Setting().get(PluginSettings.PROFILE_REQUESTS), 0)
+
+            resp = self.request(path="/wt_versioning/profile", method="GET", user=self.user_one)
+            self.assertStatus(resp, 403)
+            resp = self.request(path="/wt_versioning/profile", method="GET", user=self.admin)
+            self.assertStatusOk(resp)
+            self.assertEqual(len(resp.json), 2)
+            name = resp.json[0]["name"]
+            self.assertTrue(name.endswith("-GET_version.prof"))
+
+            resp = self.request(
+                path=f"/wt_versioning/profile/{name}", method="GET", user=self.admin,
+                isJson=False
+            )
+            self.assertStatusOk(resp)
+            path = pathlib.Path(profile_dir) / "download.prof"
+            path.write_bytes(self.getBody(resp, text=False))
+            self.assertTrue(pstats.Stats(path.as_posix()).total_calls > 0)
+
+            resp = self.request(
+                path="/wt_versioning/profile/missing.prof", method="GET", user=self.admin
+            )
+            self.assertStatus(resp, 404)
+        finally:
+            Setting().set(PluginSettings.PROFILE_REQUESTS, 0)
+            shutil.rmtree(profile_dir)
+        self._remove_example_tale(tale)
+
+    @mock.patch("girder.plugins.wholetale.lib.manifest.ImageBuilder")
+    def testCompactList(self, mock_builder):
+        mock_builder.return_value.container_config.repo2docker_version = \
+            "craigwillis/repo2docker:latest"
+        mock_builder.return_value.get_tag.return_value = \
+            "some_image_digest"
+        tale = self._create_example_tale(self.get_dataset([0]))
+        ids = []
+        for name in ("v1", "v2", "v3"):
+            resp = self.request(
+                path="/version",
+                method="POST",
+                user=self.user_one,
+                params={"taleId": tale["_id"], "name": name, "force": True},
+            )
+            self.assertStatusOk(resp)
+            ids.append(resp.json["_id"])
+
+        resp = self.request(
+            path="/version", method="GET", user=self.user_one, params={"taleId": tale["_id"]}
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual([_["_id"] for _ in resp.json], ids)
+        self.assertEqual(resp.json[0]["_modelType"], "folder")
+
+        params = {"taleId": tale["_id"], "fields": "name,updated", "limit": 2}
+        resp = self.request(path="/version", method="GET", user=self.user_one, params=params)
+        self.assertStatusOk(resp)
+        self.assertEqual([_["_id"] for _ in resp.json["items"]], ids[:2])
+        self.assertEqual(set(resp.json["items"][0]), {"_id", "name", "updated"})
+        self.assertIsNotNone(resp.json["cursor"])
+        resp = self.request(
+            path="/version", method="GET", user=self.user_one,
+            params=dict(params, cursor=resp.json["cursor"]),
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual([_["_id"] for _ in resp.json["items"]], ids[2:])
+        self.assertIsNone(resp.json["cursor"])
+
+        resp = self.request(
+            path="/version", method="GET", user=self.user_one,
+            params=dict(params, sortdir=-1, limit=1),
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual([_["_id"] for _ in resp.json["items"]], ids[2:])
+        resp = self.request(
+            path="/version", method="GET", user=self.user_one,
+            params=dict(params, sortdir=-1, limit=0, cursor=resp.json["cursor"]),
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual([_["_id"] for _ in resp.json["items"]], ids[1::-1])
+
+        for bad in (
+            {"fields": "name,fsPath"},
+            {"fields": "name", "sort": "name"},
+            {"fields": "name", "cursor": "garbage"},
+            {"cursor": "1_5e5df7a0e2c48f2e00a465e5"},
+        ):
+            resp = self.request(
+                path="/version", method="GET", user=self.user_one,
+                params=dict(bad, taleId=tale["_id"]),
+            )
+            self.assertStatus(resp, 400)
+        self._remove_example_tale(tale)
+
+    @mock.patch("girder.plugins.wholetale.lib.manifest.ImageBuilder")
+    def testLatestVersion(self, mock_builder):
+        mock_builder.return_value.container_config.repo2docker_version = \
+            "craigwillis/repo2docker:latest"
+        mock_builder.return_value.get_tag.return_value = \
+            "some_image_digest"
+        tale = self._create_example_tale(self.get_dataset([0]))
+
+        def latest():
+            resp = self.request(
+                path="/version/latest", method="GET", user=self.user_one,
+                params={"taleId": tale["_id"]},
+            )
+            self.assertStatusOk(resp)
+            root = Folder().load(tale["versionsRootId"], force=True)
+            return resp.json and resp.json["_id"], root["versionCount"]
+
+        self.assertEqual(latest(), (None, 0))
+        ids = []
+        for name in ("v1", "v2"):
+            resp = self.request(
+                path="/version",
+                method="POST",
+                user=self.user_one,
+                params={"taleId": tale["_id"], "name": name, "force": True},
+            )
+            self.assertStatusOk(resp)
+            ids.append(resp.json["_id"])
+            self.assertEqual(latest(), (ids[-1], len(ids)))
+
+        resp = self.request(path=f"/version/{ids[0]}", method="DELETE", user=self.user_one)
+        self.assertStatusOk(resp)
+        self.assertEqual(latest(), (ids[1], 1))
+        resp = self.request(path=f"/version/{ids[1]}", method="DELETE", user=self.user_one)
+        self.assertStatusOk(resp)
+        self.assertEqual(latest(), (None, 0))
+        self._remove_example_tale(tale)
+
+    @mock.patch("girder.plugins.wholetale.lib.manifest.ImageBuilder")
+    def testCoalescedTimestamps(self, mock_builder):
+        from girder.plugins.wholetale.models.tale import Tale
+
+        mock_builder.return_value.container_config.repo2docker_version = \
+            "craigwillis/repo2docker:latest"
+        mock_builder.return_value.get_tag.return_value = \
+            "some_image_digest"
+        tale = self._create_example_tale(self.get_dataset([0]))
+        resp = self.request(
+            path="/version",
+            method="POST",
+            user=self.user_one,
+            params={"taleId": tale["_id"], "name": "v1"},
+        )
+        self.assertStatusOk(resp)
+        version = resp.json
+
+        before = Tale().load(tale["_id"], force=True)["updated"]
+        root_before = Folder().load(tale["versionsRootId"], force=True)["updated"]
+        time.sleep(0.01)
+        saving, saved = [], []
+        with mock.patch.object(Tale, "update", wraps=Tale().update) as update, \
+                mock.patch.object(Tale, "save", wraps=Tale().save) as save, \
+                events.bound("model.tale.save", "test", lambda e: saving.append(e.info)), \
+                events.bound("model.tale.save.after", "test", lambda e: saved.append(e.info)):
+            resp = self.request(
+                path=f"/version/{version['_id']}",
+                method="PUT",
+                user=self.user_one,
+                params={"name": "renamed"},
+            )
+            self.assertStatusOk(resp)
+        # The rename and update_parents touch the tale, which is updated once
+        save.assert_not_called()
+        self.assertEqual(update.call_count, 1)
+        # Listeners are still told about the update, before and after it
+        self.assertEqual([str(_["_id"]) for _ in saving], [str(tale["_id"])])
+        self.assertEqual([str(_["_id"]) for _ in saved], [str(tale["_id"])])
+        self.assertGreater(saved[0]["updated"], before)
+        self.assertGreater(Tale().load(tale["_id"], force=True)["updated"], before)
+        self.assertGreater(
+            Folder().load(tale["versionsRootId"], force=True)["updated"], root_before
+        )
+        self._remove_example_tale(tale)
+
+    @mock.patch("girder.plugins.wholetale.lib.manifest.ImageBuilder")
+    def testLazyManifest(self, mock_builder):
+        from girder.plugins.wt_versioning.lib.version_hierarchy import VersionHierarchyModel
+
+        mock_builder.return_value.container_config.repo2docker_version = \
+            "craigwillis/repo2docker:latest"
+        mock_builder.return_value.get_tag.return_value = \
+            "some_image_digest"
+        tale = self._create_example_tale(self.get_dataset([0]))
+        resp = self.request(
+            path="/version",
+            method="POST",
+            user=self.user_one,
+            params={"taleId": tale["_id"], "name": "v1"},
+        )
+        self.assertStatusOk(resp)
+        version = resp.json
+        manifest_path = pathlib.Path(version["fsPath"]) / "manifest.json"
+        with open(manifest_path.as_posix(), "r") as fp:
+            before = json.load(fp)
+
+        with mock.patch("girder.events.daemon.trigger") as trigger:
+            resp = self.request(
+                path=f"/version/{version['_id']}",
+                method="PUT",
+                user=self.user_one,
+                params={"name": "renamed"},
+            )
+            self.assertStatusOk(resp)
+        trigger.assert_called_once()
+        # The manifest is left as it was until it is needed
+        folder = Folder().load(version["_id"], force=True)
+        self.assertTrue(folder["manifestStale"])
+        with open(manifest_path.as_posix(), "r") as fp:
+            self.assertEqual(json.load(fp), before)
+
+        resp = self.request(
+            path=f"/version/{version['_id']}/dataSet", method="GET", user=self.user_one
+        )
+        self.assertStatusOk(resp)
+        folder = Folder().load(version["_id"], force=True)
+        self.assertNotIn("manifestStale", folder)
+        with open(manifest_path.as_posix(), "r") as fp:
+            after = json.load(fp)
+        self.assertNotEqual(after, before)
+        self.assertIn("renamed", json.dumps(after))
+
+        # A no-op once materialized
+        with mock.patch.object(pathlib.Path, "write_text") as write_text:
+            VersionHierarchyModel().materializeManifest(folder)
+        write_text.assert_not_called()
+
+        # Viewing the tale as it was in the version regenerates the manifest too
+        with mock.patch("girder.events.daemon.trigger"):
+            resp = self.request(
+                path=f"/version/{version['_id']}",
+                method="PUT",
+                user=self.user_one,
+                params={"name": "renamed again"},
+            )
+            self.assertStatusOk(resp)
+        self.assertTrue(Folder().load(version["_id"], force=True)["manifestStale"])
+        resp = self.request(
+            path=f"/tale/{tale['_id']}/restore",
+            method="GET",
+            user=self.user_one,
+            params={"versionId": version["_id"]},
+        )
+        self.assertStatusOk(resp)
+        self.assertNotIn("manifestStale", Folder().load(version["_id"], force=True))
+        with open(manifest_path.as_posix(), "r") as fp:
+            self.assertIn("renamed again", fp.read())
+        self._remove_example_tale(tale)
+
+
+class TreeOperationSchedulerTestCase(BaseTestCase):
+    def testPriority(self):
+        import threading
+        from girder.plugins.wt_versioning.constants import PluginSettings
+        from girder.plugins.wt_versioning.lib.scheduler import TreeOperationScheduler
+
+        Setting().set(PluginSettings.MAX_TREE_OPERATIONS, 1)
+        scheduler = TreeOperationScheduler()
+        admitted = []
+
+        def operation(name, background):
+            if background:
+                with scheduler.background(), scheduler.admit(name):
+                    admitted.append(name)
+            else:
+                with scheduler.admit(name):
+                    admitted.append(name)
+
+        threads = []
+        with scheduler.admit("blocker"):
+            for name, background in (("copy", True), ("create", False)):
+                thread = threading.Thread(target=operation, args=(name, background))
+                thread.start()
+                threads.append(thread)
+                while len(scheduler._waiting) < len(threads):
+                    time.sleep(0.01)
+            self.assertEqual(admitted, [])
+        for thread in threads:
+            thread.join()
+        self.assertEqual(admitted, ["create", "copy"])
+        self.assertEqual(scheduler.running, 0)
@@ -2,11 +2,13 @@
 # -*- coding: utf-8 -*-
 from bson import ObjectId
 import copy
+import os
 import pathlib
 import shutil
 
 from girder import events
 from girder.constants import AccessType, SettingDefault
+from girder.exceptions import ValidationException
 from girder.models.folder import Folder
 from girder.models.user import User
 from girder.utility import setting_utilities
@@ -15,18 +17,56 @@ from girder.plugins.wholetale.models.tale import Tale
 from .lib.version_hierarchy import VersionHierarchyModel
 from .resources.version import Version
 from .resources.run import Run
-from .constants import PluginSettings, Constants, FIELD_STATUS_CODE
+from .resources.admin import VersioningAdmin
+from .constants import (
+    PluginSettings, Constants, FIELD_ENVIRONMENT_DIGEST, FIELD_LATEST_VERSION_ID,
+    FIELD_MANIFEST_STALE, FIELD_SEARCH_SEQ, FIELD_STATUS_CODE, FIELD_VERSION_COUNT,
+    FIELD_VERSION_STATS,
+    FIELD_VERSION_STATUS_CODE, FIELD_WORKSPACE_MATERIALIZED, FIELD_WORKSPACE_VERSION_ID
+)
 from .lib import util
+from .lib.accounting import StorageAccounting
+from .lib.coalesce import TimestampCoalescer
+from .lib.scheduler import TreeOperationScheduler
+from .lib.metrics import Metrics, timedOperation
+from .lib.objects import DocumentStore
+from .lib.profiler import RequestProfiler
+from .lib.search import VersionFile
 
 
 @setting_utilities.validator({
     PluginSettings.VERSIONS_DIRS_ROOT,
-    PluginSettings.RUNS_DIRS_ROOT
+    PluginSettings.RUNS_DIRS_ROOT,
+    PluginSettings.PROFILE_DIR
 })
 def validateOtherSettings(event):
     pass
 
 
+@setting_utilities.validator(PluginSettings.DEFERRED_RUN_WORKSPACE)
+def validateDeferredRunWorkspace(doc):
+    if not isinstance(doc['value'], bool):
+        raise ValidationException('Deferred run workspace setting must be a boolean.', 'value')
+
+
+@setting_utilities.validator({
+    PluginSettings.MAX_TREE_OPERATIONS,
+    PluginSettings.TREE_FILES_PER_SECOND,
+    PluginSettings.RETENTION_KEEP_LAST,
+    PluginSettings.RETENTION_KEEP_DAILY,
+    PluginSettings.PRUNE_INTERVAL,
+    PluginSettings.SLOW_OPERATION_MS,
+    PluginSettings.PROFILE_REQUESTS
+})
+def validateNonNegativeInt(doc):
+    try:
+        doc['value'] = int(doc['value'])
+    except (TypeError, ValueError):
+        raise ValidationException('%s must be an integer.' % doc['key'], 'value')
+    if doc['value'] < 0:
+        raise ValidationException('%s must not be negative.' % doc['key'], 'value')
+
+
 def _createAuxFolder(tale, name, rootProp, creator):
     folder = Tale()._createAuxFolder(tale, name, creator=creator)
     folder.update({'seq': 0, 'taleId': tale['_id']})
@@ -60,11 +100,59 @@ def removeVersionsAndRuns(event: events.Event) -> None:
     for folder_id in (tale["runsRootId"], tale["versionsRootId"]):
         if (root := Folder().load(folder_id, force=True)):
             Folder().remove(root)
+    VersionFile().dropRoot(tale["versionsRootId"])
     shutil.rmtree(util.getTaleVersionsDirPath(tale), ignore_errors=True)
     shutil.rmtree(util.getTaleRunsDirPath(tale), ignore_errors=True)
 
 
+def _meteredCopy(src, dst):
+    dst = shutil.copy2(src, dst)
+    metrics = Metrics()
+    metrics.count("files")
+    metrics.count("bytes_copied", os.path.getsize(dst))
+    TreeOperationScheduler().tick()
+    return dst
+
+
+@timedOperation("copy")
 def copyVersionsAndRuns(event: events.Event) -> None:
+    old_tale, new_tale, target_version_id, shallow = event.info
+    if shallow and not target_version_id:
+        return
+    Metrics().annotate(
+        taleId=new_tale["_id"], sourceTaleId=old_tale["_id"], shallow=shallow
+    )
+    scheduler = TreeOperationScheduler()
+    with scheduler.background(), scheduler.admit("copy"):
+        _copyVersionsAndRuns(old_tale, new_tale, target_version_id, shallow)
+
+
+def _copyVersionDocuments(src, dst, new_root_path, versions_map):
+    dst_path = new_root_path / str(dst["_id"])
+    dst[FIELD_ENVIRONMENT_DIGEST] = DocumentStore().adopt(
+        new_root_path, dst_path / "environment.json"
+    )
+    if FIELD_WORKSPACE_VERSION_ID not in src:
+        return
+    # The copied link points to the workspace of a version of the old tale
+    workspace = dst_path / "workspace"
+    owner_id = versions_map.get(str(src[FIELD_WORKSPACE_VERSION_ID]))
+    workspace.unlink()
+    if owner_id is not None:
+        workspace.symlink_to(
+            pathlib.Path("..") / owner_id / "workspace", target_is_directory=True
+        )
+        dst[FIELD_WORKSPACE_VERSION_ID] = ObjectId(owner_id)
+    else:
+        # The owner was not copied (shallow copy), the new version gets its own workspace
+        shutil.copytree(
+            pathlib.Path(src["fsPath"]) / "workspace", workspace, symlinks=True,
+            copy_function=_meteredCopy
+        )
+        del dst[FIELD_WORKSPACE_VERSION_ID]
+
+
+def _copyVersionsAndRuns(old_tale, new_tale, target_version_id, shallow):
 
     def get_dir_path(root_id_key, tale):
         if root_id_key == "versionsRootId":
@@ -72,9 +160,6 @@ def copyVersionsAndRuns(event: events.Event) -> None:
         elif root_id_key == "runsRootId":
             return util.getTaleRunsDirPath(tale)
 
-    old_tale, new_tale, target_version_id, shallow = event.info
-    if shallow and not target_version_id:
-        return
     creator = User().load(new_tale["creatorId"], force=True)
     versions_map = {}
     for root_id_key in ("versionsRootId", "runsRootId"):
@@ -86,8 +171,13 @@ def copyVersionsAndRuns(event: events.Event) -> None:
         )
         old_root_path = get_dir_path(root_id_key, old_tale)
         new_root_path = get_dir_path(root_id_key, new_tale)
-        for src in Folder().childFolders(old_root, "folder", user=creator):
-            if shallow and str(src["_id"]) != target_version_id:
+        # Oldest first, so that shared workspaces are copied before the versions linking to them
+        for src in Folder().childFolders(
+            old_root, "folder", user=creator, sort=[("created", 1)]
+        ):
+            if (
+                shallow and str(src["_id"]) != target_version_id
+            ) or not VersionHierarchyModel.isReady(src):
                 continue
             dst = Folder().createFolder(
                 new_root, src["name"], creator=creator
@@ -96,13 +186,22 @@ def copyVersionsAndRuns(event: events.Event) -> None:
                 versions_map[str(src["_id"])] = str(dst["_id"])
             filtered_folder = Folder().filter(dst, creator)
             for key in src:
-                if key not in filtered_folder and key not in dst:
+                if (
+                    key not in filtered_folder and key not in dst
+                    and key not in (FIELD_SEARCH_SEQ, FIELD_MANIFEST_STALE)
+                ):
                     dst[key] = copy.deepcopy(src[key])
 
             src_path = old_root_path / str(src["_id"])
             dst_path = new_root_path / str(dst["_id"])
             dst_path.mkdir(parents=True)
-            shutil.copytree(src_path, dst_path, dirs_exist_ok=True, symlinks=True)
+            with Metrics().phase("copy_tree"):
+                shutil.copytree(
+                    src_path, dst_path, dirs_exist_ok=True, symlinks=True,
+                    copy_function=_meteredCopy
+                )
+            if root_id_key == "versionsRootId":
+                _copyVersionDocuments(src, dst, new_root_path, versions_map)
             dst.update(
                 {
                     "fsPath": dst_path.absolute().as_posix(),
@@ -122,23 +221,40 @@ def copyVersionsAndRuns(event: events.Event) -> None:
                 current_version.symlink_to(new_version_path, True)
                 dst["runVersionId"] = ObjectId(new_version_id)
             dst = Folder().save(dst, validate=False, triggerEvents=False)
-        # update the time on root
-        Folder().updateFolder(new_root)
+        # The copied files are new inodes, shared workspaces are counted once
+        with Metrics().phase("accounting"):
+            StorageAccounting().rescanTale(
+                new_tale, "versions" if root_id_key == "versionsRootId" else "runs"
+            )
+        # update the time on root, without saving the document loaded before the copy
+        TimestampCoalescer().touchFolder(new_root["_id"])
 
     versions_root = Folder().load(
         new_tale["versionsRootId"], user=creator, level=AccessType.WRITE
     )
-    for version in Folder().childFolders(versions_root, "folder", user=creator):
-        tale = copy.deepcopy(new_tale)
-        tale.update(VersionHierarchyModel().restoreTaleFromVersion(version))
-        manifest = Manifest(
-            tale, creator, versionId=version["_id"], expand_folders=False
+    for version in Folder().childFolders(
+        versions_root, "folder", user=creator, sort=[("created", 1)]
+    ):
+        # The copied index still describes the same files, so the copy is indexed from it
+        VersionFile().addVersion(version)
+        Folder().update(
+            {"_id": version["_id"]},
+            {"$set": {FIELD_SEARCH_SEQ: version[FIELD_SEARCH_SEQ]}},
+            multi=False,
         )
-        dst_path = pathlib.Path(version["fsPath"])
-        with open(dst_path / "manifest.json", "w") as fp:
-            fp.write(manifest.dump_manifest())
+        with Metrics().phase("manifest"):
+            tale = copy.deepcopy(new_tale)
+            tale.update(VersionHierarchyModel().restoreTaleFromVersion(version))
+            manifest = Manifest(
+                tale, creator, versionId=version["_id"], expand_folders=False
+            )
+            dst_path = pathlib.Path(version["fsPath"])
+            with open(dst_path / "manifest.json", "w") as fp:
+                fp.write(manifest.dump_manifest())
 
-    Folder().updateFolder(versions_root)
+    VersionHierarchyModel().refreshLatest(versions_root)
+    # Not a save, addVersion and refreshLatest updated the root since it was loaded
+    TimestampCoalescer().touchFolder(versions_root["_id"])
     if target_version_id:
         new_version_id = versions_map[str(target_version_id)]
         target_version = Folder().load(new_version_id, level=AccessType.READ, user=creator)
@@ -148,18 +264,39 @@ def copyVersionsAndRuns(event: events.Event) -> None:
 def load(info):
     SettingDefault.defaults[PluginSettings.VERSIONS_DIRS_ROOT] = '/tmp/wt/versions'
     SettingDefault.defaults[PluginSettings.RUNS_DIRS_ROOT] = '/tmp/wt/runs'
+    SettingDefault.defaults[PluginSettings.DEFERRED_RUN_WORKSPACE] = False
+    SettingDefault.defaults[PluginSettings.MAX_TREE_OPERATIONS] = 8
+    SettingDefault.defaults[PluginSettings.TREE_FILES_PER_SECOND] = 0
+    SettingDefault.defaults[PluginSettings.RETENTION_KEEP_LAST] = 0
+    SettingDefault.defaults[PluginSettings.RETENTION_KEEP_DAILY] = 0
+    SettingDefault.defaults[PluginSettings.PRUNE_INTERVAL] = 3600
+    SettingDefault.defaults[PluginSettings.SLOW_OPERATION_MS] = 0
+    SettingDefault.defaults[PluginSettings.PROFILE_REQUESTS] = 0
+    SettingDefault.defaults[PluginSettings.PROFILE_DIR] = '/tmp/wt/profiles'
     Folder().ensureIndex('created')
+    Folder().ensureIndex(([('parentId', 1), ('created', 1), ('_id', 1)], {}))
     VersionHierarchyModel().resetCrashedCriticalSections()
 
     events.bind('model.tale.save.created', 'wt_versioning', addVersionsAndRuns)
     events.bind('model.tale.remove', 'wt_versioning', removeVersionsAndRuns)
     events.bind('wholetale.tale.copied', 'wt_versioning', copyVersionsAndRuns)
+    events.bind('model.setting.save.after', 'wt_versioning', RequestProfiler().settingSaved)
     Tale().exposeFields(
         level=AccessType.READ, fields={"versionsRootId", "runsRootId", "restoredFrom"}
     )
     Folder().exposeFields(
-        level=AccessType.READ, fields={"runVersionId", FIELD_STATUS_CODE}
+        level=AccessType.READ,
+        fields={
+            "runVersionId",
+            FIELD_LATEST_VERSION_ID,
+            FIELD_STATUS_CODE,
+            FIELD_VERSION_COUNT,
+            FIELD_VERSION_STATS,
+            FIELD_VERSION_STATUS_CODE,
+            FIELD_WORKSPACE_MATERIALIZED,
+        }
     )
 
     info['apiRoot'].version = Version(info["apiRoot"].tale)
     info['apiRoot'].run = Run()
+    info['apiRoot'].wt_versioning = VersioningAdmin()
@@ -2,6 +2,18 @@
 # -*- coding: utf-8 -*-
 
 FIELD_STATUS_CODE = "runStatus"
+FIELD_WORKSPACE_MATERIALIZED = "runWorkspaceMaterialized"
+FIELD_VERSION_STATUS_CODE = "versionStatus"
+FIELD_VERSION_STATS = "versionStats"
+FIELD_RUN_STATS = "runStats"
+FIELD_STORAGE_USAGE = "storageUsage"
+FIELD_SEARCH_SEQ = "searchSeq"
+FIELD_WORKSPACE_VERSION_ID = "workspaceVersionId"
+FIELD_ENVIRONMENT_DIGEST = "environmentDigest"
+FIELD_LATEST_VERSION_ID = "latestVersionId"
+FIELD_VERSION_COUNT = "versionCount"
+FIELD_MANIFEST_STALE = "manifestStale"
+CREATE_VERSION_STEP_TOTAL = 3
 
 
 class Constants:
@@ -12,6 +24,15 @@ class Constants:
 class PluginSettings:
     VERSIONS_DIRS_ROOT = 'wtversioning.versions_root'
     RUNS_DIRS_ROOT = 'wtversioning.runs_root'
+    DEFERRED_RUN_WORKSPACE = 'wtversioning.deferred_run_workspace'
+    MAX_TREE_OPERATIONS = 'wtversioning.max_tree_operations'
+    TREE_FILES_PER_SECOND = 'wtversioning.tree_files_per_second'
+    RETENTION_KEEP_LAST = 'wtversioning.retention_keep_last'
+    RETENTION_KEEP_DAILY = 'wtversioning.retention_keep_daily'
+    PRUNE_INTERVAL = 'wtversioning.prune_interval'
+    SLOW_OPERATION_MS = 'wtversioning.slow_operation_ms'
+    PROFILE_REQUESTS = 'wtversioning.profile_requests'
+    PROFILE_DIR = 'wtversioning.profile_dir'
 
 
 class RunState:
@@ -34,3 +55,22 @@ class RunStatus:
     @classmethod
     def get(cls, code: int) -> RunState:
         return RunState.ALL[code]
+
+
+class VersionState:
+    ALL = {}  # type: dict
+
+    def __init__(self, code: int, name: str):
+        self.code = code
+        self.name = name
+        VersionState.ALL[code] = self
+
+
+class VersionStatus:
+    READY = VersionState(0, 'READY')
+    PENDING = VersionState(1, 'PENDING')
+    FAILED = VersionState(2, 'FAILED')
+
+    @classmethod
+    def get(cls, code: int) -> VersionState:
+        return VersionState.ALL[code]
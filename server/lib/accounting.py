@@ -0,0 +1,262 @@
+import os
+import shutil
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterator, Optional, Set, Tuple
+
+from bson import ObjectId
+from girder import logger
+from girder.models.folder import Folder
+from girder.models.setting import Setting
+from girder.plugins.wholetale.models.tale import Tale
+
+from . import util
+from .objects import DocumentStore
+from ..constants import FIELD_STORAGE_USAGE, PluginSettings
+
+KINDS = {
+    "versions": ("versionsRootId", PluginSettings.VERSIONS_DIRS_ROOT),
+    "runs": ("runsRootId", PluginSettings.RUNS_DIRS_ROOT),
+}
+
+
+def scanTree(path: Path, seen: Set[Tuple[int, int]], exclude: Optional[str] = None) -> int:
+    """Returns the total size of the regular files under path whose inodes are not in seen,
+    adding them to it. Hard linked files are therefore counted once.
+    """
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        if exclude is not None and dirpath == path.as_posix():
+            dirnames[:] = [_ for _ in dirnames if _ != exclude]
+        for name in filenames:
+            try:
+                st = os.lstat(os.path.join(dirpath, name))
+            except FileNotFoundError:
+                continue
+            key = (st.st_dev, st.st_ino)
+            if key in seen or not stat.S_ISREG(st.st_mode):
+                continue
+            seen.add(key)
+            size += st.st_size
+    return size
+
+
+def scanTale(kind: str, taleDir: Path) -> Tuple[int, int]:
+    """Returns the size and the trash size of the versions (or runs) of a tale. Like the
+    incremental counts, only the workspaces of versions are counted, while runs are counted
+    whole.
+    """
+    seen = set()  # type: Set[Tuple[int, int]]
+    if kind != "versions":
+        size = scanTree(taleDir, seen, exclude=".trash")
+        return size, scanTree(taleDir / ".trash", seen)
+    sizes = []
+    for parent in (taleDir, taleDir / ".trash"):
+        size = 0
+        if parent.is_dir():
+            for version in sorted(parent.iterdir()):
+                if ObjectId.is_valid(version.name):
+                    size += scanTree(version / "workspace", seen)
+        sizes.append(size)
+    return sizes[0], sizes[1]
+
+
+class StorageAccounting(object):
+    """Keeps track of the storage used by the versions and runs of each tale. The usage is
+    stored in the versions and runs root folders as
+
+        storageUsage: {kind: "versions" | "runs", size: int, trashSize: int}
+
+    where size is the total size of the distinct inodes of the live versions (or runs) and
+    trashSize is the size of the removed ones that are waiting in the trash. The counters are
+    updated incrementally (see AbstractHierarchyModel.snapshot and the remove() methods), by
+    comparing a new version with the previous one. When a new version has files that are not
+    in the previous version but are linked from elsewhere, e.g. from an older version after a
+    restore, the usage of the tale is recomputed instead (see rescanTale), so that they are not
+    counted twice. The usage of all tales can be recomputed from scratch using rescan().
+    """
+
+    def __new__(cls):
+        if not hasattr(cls, "instance"):
+            cls.instance = super(StorageAccounting, cls).__new__(cls)
+        return cls.instance
+
+    def addUsage(self, rootId: ObjectId, kind: str, size: int = 0, trashSize: int = 0) -> None:
+        if not size and not trashSize:
+            return
+        Folder().update(
+            {"_id": ObjectId(rootId)},
+            {
+                "$set": {f"{FIELD_STORAGE_USAGE}.kind": kind},
+                "$inc": {
+                    f"{FIELD_STORAGE_USAGE}.size": size,
+                    f"{FIELD_STORAGE_USAGE}.trashSize": trashSize,
+                },
+            },
+            multi=False,
+        )
+
+    def setUsage(self, rootId: ObjectId, kind: str, size: int, trashSize: int) -> None:
+        Folder().update(
+            {"_id": ObjectId(rootId)},
+            {
+                "$set": {
+                    FIELD_STORAGE_USAGE: {"kind": kind, "size": size, "trashSize": trashSize}
+                }
+            },
+            multi=False,
+        )
+
+    def collectTrash(self, tale: dict) -> None:
+        """Deletes removed versions and runs of a tale for good, along with the stored
+        documents that were only used by them.
+        """
+        for kind, (rootField, rootProp) in KINDS.items():
+            trashDir = util.getTaleDirPath(tale, rootProp) / ".trash"
+            if trashDir.is_dir():
+                for path in trashDir.iterdir():
+                    if path.is_dir() and not path.is_symlink():
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        path.unlink()
+            if kind == "versions":
+                DocumentStore().collectGarbage(util.getTaleDirPath(tale, rootProp))
+            Folder().update(
+                {"_id": tale[rootField]},
+                {"$set": {f"{FIELD_STORAGE_USAGE}.trashSize": 0}},
+                multi=False,
+            )
+
+    def getTaleUsage(self, tale: dict) -> dict:
+        usage = {"taleId": tale["_id"]}
+        for kind, (rootField, _) in KINDS.items():
+            root = Folder().load(tale[rootField], force=True, fields=[FIELD_STORAGE_USAGE])
+            doc = (root or {}).get(FIELD_STORAGE_USAGE, {})
+            usage[kind] = {"size": doc.get("size", 0), "trashSize": doc.get("trashSize", 0)}
+        return usage
+
+    def getUserUsage(self, userId: Optional[ObjectId] = None, limit: int = 0) -> list:
+        """Returns storage usage totals grouped by user (the creator of the tales), sorted by
+        the total size in descending order.
+        """
+        query = {FIELD_STORAGE_USAGE: {"$exists": True}}
+        if userId is not None:
+            query["creatorId"] = ObjectId(userId)
+        pipeline = [
+            {"$match": query},
+            {
+                "$group": {
+                    "_id": "$creatorId",
+                    "versionsSize": {"$sum": self._byKind("versions", "size")},
+                    "versionsTrashSize": {"$sum": self._byKind("versions", "trashSize")},
+                    "runsSize": {"$sum": self._byKind("runs", "size")},
+                    "runsTrashSize": {"$sum": self._byKind("runs", "trashSize")},
+                    "taleCount": {"$sum": self._byKind("versions", None)},
+                }
+            },
+            {
+                "$addFields": {
+                    "totalSize": {
+                        "$add": [
+                            "$versionsSize",
+                            "$versionsTrashSize",
+                            "$runsSize",
+                            "$runsTrashSize",
+                        ]
+                    }
+                }
+            },
+            {"$sort": {"totalSize": -1}},
+        ]
+        if limit:
+            pipeline.append({"$limit": limit})
+        return [
+            {
+                "userId": doc["_id"],
+                "taleCount": doc["taleCount"],
+                "versions": {"size": doc["versionsSize"], "trashSize": doc["versionsTrashSize"]},
+                "runs": {"size": doc["runsSize"], "trashSize": doc["runsTrashSize"]},
+                "totalSize": doc["totalSize"],
+            }
+            for doc in Folder().collection.aggregate(pipeline)
+        ]
+
+    @staticmethod
+    def _byKind(kind: str, field: Optional[str]) -> dict:
+        value = 1 if field is None else {"$ifNull": [f"${FIELD_STORAGE_USAGE}.{field}", 0]}
+        return {"$cond": [{"$eq": [f"${FIELD_STORAGE_USAGE}.kind", kind]}, value, 0]}
+
+    def rescan(
+        self, workers: int = 4, progress: Optional[Callable[[str], None]] = None
+    ) -> int:
+        """Recomputes the usage of all tales by walking the versions and runs roots. Each
+        shard (the directories named after the first two characters of tale ids) is scanned
+        by a separate worker. Returns the number of tale directories scanned.
+        """
+        shards = []
+        for kind, (_, rootProp) in KINDS.items():
+            root = Path(Setting().get(rootProp))
+            if root.is_dir():
+                shards.extend((kind, _) for _ in root.iterdir() if _.is_dir())
+
+        count = 0
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            for kind, shard, results in executor.map(lambda _: self._scanShard(*_), shards):
+                for taleId, size, trashSize in results:
+                    self._storeScan(kind, taleId, size, trashSize)
+                    count += 1
+                if progress is not None:
+                    progress(f"Scanned {kind} shard {shard.name}")
+        return count
+
+    def rescanTale(self, tale: dict, kind: str) -> None:
+        """Recomputes the usage of the versions (or runs) of a tale by walking its directory."""
+        rootField, rootProp = KINDS[kind]
+        size, trashSize = scanTale(kind, util.getTaleDirPath(tale, rootProp))
+        self.setUsage(tale[rootField], kind, size, trashSize)
+
+    @staticmethod
+    def _scanShard(kind: str, shard: Path) -> Tuple[str, Path, list]:
+        results = []
+        for taleDir in shard.iterdir():
+            if not taleDir.is_dir() or not ObjectId.is_valid(taleDir.name):
+                continue
+            size, trashSize = scanTale(kind, taleDir)
+            results.append((taleDir.name, size, trashSize))
+        return kind, shard, results
+
+    def _storeScan(self, kind: str, taleId: str, size: int, trashSize: int) -> None:
+        rootField = KINDS[kind][0]
+        tale = Tale().load(taleId, force=True, fields=[rootField])
+        if tale is None or rootField not in tale:
+            logger.info("Skipping storage usage of %s/%s, no such tale", kind, taleId)
+            return
+        self.setUsage(tale[rootField], kind, size, trashSize)
+
+    @staticmethod
+    def iterNewFiles(crt: Path, old: Optional[Path]) -> Iterator[os.stat_result]:
+        """Yields the stat of the files under crt that are not hard links to the file with the
+        same relative path under old.
+        """
+        for c in crt.iterdir():
+            oldc = None if old is None else old / c.name
+            if c.is_dir():
+                if oldc is not None and not oldc.is_dir():
+                    oldc = None
+                yield from StorageAccounting.iterNewFiles(c, oldc)
+                continue
+            st = c.stat()
+            if oldc is not None:
+                try:
+                    old_st = oldc.stat()
+                except FileNotFoundError:
+                    old_st = None
+                if old_st is not None and (old_st.st_ino, old_st.st_dev) == (
+                    st.st_ino, st.st_dev
+                ):
+                    continue
+            yield st
+
+    def newSize(self, crt: Path, old: Optional[Path]) -> int:
+        return sum(_.st_size for _ in self.iterNewFiles(crt, old))
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+import stat
+import tarfile
+from pathlib import Path
+from typing import Iterator, Optional, Tuple, Union
+
+from girder.utility import ziputil
+
+BUF_SIZE = 65536
+METADATA_NAME = "version.json"
+# The number of files with several links whose archive names are remembered
+MAX_LINKS = 100000
+
+Segment = Union[bytes, Tuple[Path, int]]
+
+
+class VersionArchive(object):
+    """Streams the directory of a version as a tar or zip archive. The tree is walked in a
+    deterministic order, so that the tar stream is the same across requests and can be resumed
+    from an arbitrary offset. Files are read in BUF_SIZE chunks, so the memory used does not
+    depend on the size of the files, but the listings of the directories being walked and the
+    names of up to MAX_LINKS files with several links (see below) are kept in memory. The size
+    of a tar archive, which is sent before its content, is computed by walking and stating the
+    whole tree once more before the first byte is sent.
+
+    Files that are hard links to a file already stored in the tar archive are stored as links,
+    as long as fewer than MAX_LINKS such files were seen; the others are stored as copies.
+    The zip format has no equivalent, so zip archives contain a copy of every file.
+
+    If mtime is given, it is used for the root directory and the metadata file instead of the
+    modification time of the root directory, which changes whenever the manifest is rewritten.
+
+    If metadata is given, e.g. the name and the creation time of the version, which the version
+    directory does not hold reliably, it is stored as JSON in a version.json file next to the
+    manifest (see VersionImporter).
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        prefix: str,
+        metadata: Optional[dict] = None,
+        mtime: Optional[int] = None,
+    ):
+        self.root = root
+        self.prefix = prefix
+        self.mtime = mtime
+        self.metadata = (
+            None if metadata is None
+            else json.dumps(metadata, sort_keys=True, default=str).encode()
+        )
+
+    def entries(self) -> Iterator[Tuple[str, Path, os.stat_result]]:
+        """Yields (archive name, path, lstat) for the root and all the entries below it."""
+        yield self.prefix, self.root, self.root.lstat()
+        yield from self._walk(self.root, self.prefix)
+
+    def _walk(self, directory: Path, arcdir: str):
+        for name in sorted(os.listdir(directory)):
+            if directory == self.root and name.startswith("."):
+                continue  # the index and other data derived from the version
+            path = directory / name
+            st = path.lstat()
+            if directory == self.root and stat.S_ISLNK(st.st_mode):
+                st = path.stat()  # a workspace shared with a previous version
+            arcname = f"{arcdir}/{name}"
+            yield arcname, path, st
+            if stat.S_ISDIR(st.st_mode):
+                yield from self._walk(path, arcname)
+
+    def _tarMembers(self) -> Iterator[Segment]:
+        links = {}
+        for arcname, path, st in self.entries():
+            info = tarfile.TarInfo(arcname)
+            info.mode = stat.S_IMODE(st.st_mode)
+            info.mtime = int(st.st_mtime)
+            if path == self.root and self.mtime is not None:
+                info.mtime = self.mtime
+            size = 0
+            if stat.S_ISDIR(st.st_mode):
+                info.type = tarfile.DIRTYPE
+            elif stat.S_ISLNK(st.st_mode):
+                info.type = tarfile.SYMTYPE
+                info.linkname = os.readlink(path)
+            elif stat.S_ISREG(st.st_mode):
+                key = (st.st_dev, st.st_ino)
+                if key in links:
+                    info.type = tarfile.LNKTYPE
+                    info.linkname = links[key]
+                else:
+                    if st.st_nlink > 1 and len(links) < MAX_LINKS:
+                        # Only files with other links can be seen again
+                        links[key] = arcname
+                    size = info.size = st.st_size
+            else:
+                continue
+            yield info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+            if size:
+                yield path, size
+                if size % tarfile.BLOCKSIZE:
+                    yield tarfile.NUL * (tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE)
+            if path == self.root and self.metadata is not None:
+                yield from self._tarMetadata(info.mtime)
+
+    def _tarMetadata(self, mtime: int) -> Iterator[Segment]:
+        info = tarfile.TarInfo(f"{self.prefix}/{METADATA_NAME}")
+        info.mode = 0o644
+        info.mtime = mtime
+        info.size = len(self.metadata)
+        yield info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+        yield self.metadata
+        if info.size % tarfile.BLOCKSIZE:
+            yield tarfile.NUL * (tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE)
+
+    def etag(self, key: str) -> str:
+        """Returns an entity tag for the tar archive of a version identified by key. The
+        workspace of a version never changes, so the tag only covers the manifest and the
+        metadata, which change when the version is renamed.
+        """
+        digest = hashlib.sha256(key.encode())
+        manifest = self.root / "manifest.json"
+        digest.update(manifest.read_bytes() if manifest.exists() else b"")
+        digest.update(self.metadata or b"")
+        return '"{}-{}"'.format(key, digest.hexdigest()[:16])
+
+    def tarSize(self) -> int:
+        if not hasattr(self, "_tarSize"):
+            size = 2 * tarfile.BLOCKSIZE
+            for segment in self._tarMembers():
+                size += len(segment) if isinstance(segment, bytes) else segment[1]
+            if size % tarfile.RECORDSIZE:
+                size += tarfile.RECORDSIZE - size % tarfile.RECORDSIZE
+            self._tarSize = size
+        return self._tarSize
+
+    def _tarSegments(self) -> Iterator[Segment]:
+        size = self.tarSize()
+        offset = 0
+        for segment in self._tarMembers():
+            offset += len(segment) if isinstance(segment, bytes) else segment[1]
+            yield segment
+        # Empty blocks mark the end of the archive, which is padded to a full record
+        yield tarfile.NUL * (size - offset)
+
+    def streamTar(self, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+        """Yields the bytes [start, end) of the tar archive."""
+        offset = 0
+        for segment in self._tarSegments():
+            length = len(segment) if isinstance(segment, bytes) else segment[1]
+            if offset + length <= start:
+                offset += length
+                continue
+            lo = max(start - offset, 0)
+            hi = length if end is None else min(length, end - offset)
+            if isinstance(segment, bytes):
+                yield segment[lo:hi]
+            else:
+                yield from self._readFile(segment[0], lo, hi)
+            offset += length
+            if end is not None and offset >= end:
+                return
+
+    @staticmethod
+    def _readFile(path: Path, lo: int, hi: int) -> Iterator[bytes]:
+        with open(path, "rb") as fp:
+            fp.seek(lo)
+            remaining = hi - lo
+            while remaining > 0:
+                data = fp.read(min(BUF_SIZE, remaining))
+                if not data:
+                    # The file shrank since the archive size was computed; keep the layout
+                    data = tarfile.NUL * min(BUF_SIZE, remaining)
+                remaining -= len(data)
+                yield data
+
+    def streamZip(self) -> Iterator[bytes]:
+        zip = ziputil.ZipGenerator()
+        if self.metadata is not None:
+            yield from zip.addFile(lambda: iter([self.metadata]), f"{self.prefix}/{METADATA_NAME}")
+        for arcname, path, st in self.entries():
+            if stat.S_ISREG(st.st_mode):
+                yield from zip.addFile(
+                    lambda path=path, size=st.st_size: self._readFile(path, 0, size), arcname
+                )
+        yield zip.footer()
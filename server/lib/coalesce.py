@@ -0,0 +1,67 @@
+import datetime
+import threading
+from contextlib import contextmanager
+
+from girder import events
+from girder.models.folder import Folder
+from girder.plugins.wholetale.models.tale import Tale
+
+
+class TimestampCoalescer(object):
+    """Bumps the updated timestamp of tales and folders, e.g. of the versions root and the tale
+    when a version is created or renamed, with a single $set instead of saving the whole
+    document. Within request(), the bumps are collected and done when the request handler
+    returns, with one update per model however many times, and by whichever code, each document
+    was touched. Outside of it, e.g. in jobs, they are done immediately.
+
+    The model.<name>.save and model.<name>.save.after events are triggered once per touched
+    document, as a save would, with the document as updated. Only the timestamp is written:
+    changes that listeners of model.<name>.save make to other fields are not persisted, and a
+    listener that prevents the default keeps the document from being touched.
+    """
+
+    def __new__(cls):
+        if not hasattr(cls, "instance"):
+            cls.instance = super(TimestampCoalescer, cls).__new__(cls)
+            cls.instance._local = threading.local()
+        return cls.instance
+
+    @contextmanager
+    def request(self):
+        if getattr(self._local, "pending", None) is not None:
+            yield  # nested, flushed by the outer one
+            return
+        self._local.pending = {}
+        try:
+            yield
+        finally:
+            pending, self._local.pending = self._local.pending, None
+            self._flush(pending)
+
+    def touchFolder(self, folderId) -> None:
+        self._touch(Folder(), folderId)
+
+    def touchTale(self, taleId) -> None:
+        self._touch(Tale(), taleId)
+
+    def _touch(self, model, _id) -> None:
+        pending = getattr(self._local, "pending", None)
+        if pending is None:
+            self._flush({model.name: (model, {_id})})
+        else:
+            pending.setdefault(model.name, (model, set()))[1].add(_id)
+
+    @staticmethod
+    def _flush(pending: dict) -> None:
+        now = datetime.datetime.utcnow()
+        for model, ids in pending.values():
+            touched = []
+            for doc in model.find({"_id": {"$in": list(ids)}}):
+                doc["updated"] = now
+                if not events.trigger(f"model.{model.name}.save", doc).defaultPrevented:
+                    touched.append(doc)
+            if not touched:
+                continue
+            model.update({"_id": {"$in": [_["_id"] for _ in touched]}}, {"$set": {"updated": now}})
+            for doc in touched:
+                events.trigger(f"model.{model.name}.save.after", doc)
@@ -0,0 +1,67 @@
+import copy
+import threading
+from collections import OrderedDict, defaultdict
+from pathlib import Path
+from typing import List
+
+from girder.models.folder import Folder
+from girder.models.item import Item
+from girder.plugins.wholetale.lib.manifest_parser import ManifestParser
+from girder.plugins.wt_data_manager.models.session import Session
+
+ACCESS_FIELDS = ["access", "public", "publicFlags"]
+
+
+class DatasetCache(object):
+    """Resolves the dataset of a version, i.e. the dataset stored in its manifest.json with
+    the corresponding Girder objects. The dataset of a version does not change after it is
+    created, so the resolved dataset is memoized, keyed by the version id and the modification
+    time of the manifest (which is rewritten when the version is renamed).
+
+    The objects are returned as they were when the dataset was first resolved, except for
+    their access control fields, which are reloaded on every call with one query per model.
+    """
+
+    max_size = 64
+
+    def __new__(cls):
+        if not hasattr(cls, "instance"):
+            cls.instance = super(DatasetCache, cls).__new__(cls)
+            cls.instance._cache = OrderedDict()
+            cls.instance._lock = threading.Lock()
+        return cls.instance
+
+    def get(self, version: dict) -> List[dict]:
+        path = Path(version["fsPath"]) / "manifest.json"
+        key = (version["_id"], path.stat().st_mtime_ns)
+        with self._lock:
+            dataSet = self._cache.get(key)
+            if dataSet is not None:
+                self._cache.move_to_end(key)
+        if dataSet is None:
+            dataSet = ManifestParser(path).get_dataset()
+            Session().loadObjects(dataSet)
+            with self._lock:
+                self._cache[key] = dataSet
+                while len(self._cache) > self.max_size:
+                    self._cache.popitem(last=False)
+        dataSet = copy.deepcopy(dataSet)
+        self._refreshAccess(dataSet)
+        return dataSet
+
+    @staticmethod
+    def _refreshAccess(dataSet: List[dict]) -> None:
+        objects = defaultdict(list)
+        for entry in dataSet:
+            if isinstance(entry.get("obj"), dict) and "_id" in entry["obj"]:
+                objects[entry["obj"]["_id"]].append(entry["obj"])
+        if not objects:
+            return
+        for model in (Folder(), Item()):
+            for doc in model.find({"_id": {"$in": list(objects)}}, fields=ACCESS_FIELDS):
+                for obj in objects[doc["_id"]]:
+                    for field in ACCESS_FIELDS:
+                        if field in doc:
+                            obj[field] = doc[field]
+                        else:
+                            obj.pop(field, None)
@@ -0,0 +1,115 @@
+import json
+import os
+import stat
+import uuid
+from pathlib import Path
+from typing import Iterator, Optional
+
+
+def _entry(path: str, change: str, st: os.stat_result, old: Optional[os.stat_result] = None):
+    entry = {"path": path, "change": change}
+    if stat.S_ISDIR(st.st_mode):
+        entry["type"] = "directory"
+    else:
+        entry["type"] = "file"
+        entry["size"] = st.st_size
+        if old is not None:
+            entry["oldSize"] = old.st_size
+    return entry
+
+
+class VersionDiff(object):
+    """Computes the differences between the workspaces and metadata of two versions. Files are
+    compared by inode, which is the same invariant used by AbstractHierarchyModel.sameTree(),
+    so the contents of files are never read. Since versions are immutable, the list of changes
+    between two versions is cached, in the .cache/diff directory of the versions of the tale.
+    """
+
+    cache_dir = ".cache/diff"
+
+    def __init__(self, old: dict, new: dict):
+        self.old = old
+        self.new = new
+
+    @property
+    def cachePath(self) -> Path:
+        return (
+            Path(self.new["fsPath"]).parent / self.cache_dir
+            / f"{self.old['_id']}-{self.new['_id']}.jsonl"
+        )
+
+    @staticmethod
+    def diffMetadata(old: dict, new: dict) -> dict:
+        """Returns the fields that differ between two tales restored from versions."""
+        return {
+            key: {"old": old.get(key), "new": new.get(key)}
+            for key in sorted(set(old) | set(new))
+            if old.get(key) != new.get(key)
+        }
+
+    def changes(self) -> Iterator[dict]:
+        path = self.cachePath
+        if path.is_file():
+            with open(path) as fp:
+                for line in fp:
+                    yield json.loads(line)
+            return
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{uuid.uuid4().hex}")
+        try:
+            with open(tmp, "w") as fp:
+                for change in self.diffTrees(
+                    Path(self.old["fsPath"]) / "workspace", Path(self.new["fsPath"]) / "workspace"
+                ):
+                    fp.write(json.dumps(change) + "\n")
+                    yield change
+            os.replace(tmp, path)
+        finally:
+            # Only complete diffs are cached
+            if tmp.exists():
+                tmp.unlink()
+
+    def stream(self, metadata: dict) -> Iterator[bytes]:
+        """Yields the metadata differences and the changes as a JSON document, without holding
+        the list of changes in memory.
+        """
+        yield b'{"metadata": '
+        yield json.dumps(metadata, default=str).encode()
+        yield b', "changes": ['
+        sep = b""
+        for change in self.changes():
+            yield sep + json.dumps(change).encode()
+            sep = b", "
+        yield b"]}"
+
+    @classmethod
+    def diffTrees(cls, old: Path, new: Path, prefix: str = "") -> Iterator[dict]:
+        """Yields the entries added, removed and modified between two directories, in path
+        order. Added or removed directories are reported as a whole, without their contents.
+        """
+        oldNames = set(os.listdir(old))
+        newNames = set(os.listdir(new))
+        for name in sorted(oldNames | newNames):
+            path = prefix + name
+            ost = (old / name).lstat() if name in oldNames else None
+            nst = (new / name).lstat() if name in newNames else None
+            if nst is None:
+                yield _entry(path, "removed", ost)
+            elif ost is None:
+                yield _entry(path, "added", nst)
+            elif stat.S_ISDIR(ost.st_mode) and stat.S_ISDIR(nst.st_mode):
+                yield from cls.diffTrees(old / name, new / name, prefix=path + "/")
+            elif stat.S_ISDIR(ost.st_mode) != stat.S_ISDIR(nst.st_mode):
+                yield _entry(path, "removed", ost)
+                yield _entry(path, "added", nst)
+            elif (ost.st_ino, ost.st_dev) != (nst.st_ino, nst.st_dev):
+                yield _entry(path, "modified", nst, old=ost)
+
+    @classmethod
+    def dropCache(cls, version: dict) -> None:
+        """Removes the cached diffs involving a version."""
+        cacheDir = Path(version["fsPath"]).parent / cls.cache_dir
+        if cacheDir.is_dir():
+            for path in cacheDir.glob(f"*{version['_id']}*"):
+                path.unlink(missing_ok=True)
@@ -3,16 +3,28 @@ import os
 import shutil
 from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional, Set
 
 import pathvalidate
-from girder import logger
+import pymongo
+from bson import ObjectId
+from girder import events, logger
 from girder.constants import AccessType
 from girder.exceptions import RestException
 from girder.models.folder import Folder
 from girder.plugins.wholetale.lib.manifest import Manifest
 from girder.plugins.wholetale.models.tale import Tale
 
+from .accounting import StorageAccounting
+from .coalesce import TimestampCoalescer
+from .index import VersionIndex
+from .metrics import Metrics
+from .objects import DocumentStore
+from .scheduler import TreeOperationScheduler
+from ..constants import (
+    FIELD_ENVIRONMENT_DIGEST, FIELD_VERSION_STATS, FIELD_WORKSPACE_VERSION_ID
+)
+
 
 class AbstractHierarchyModel(object):
     root_tale_field = None
@@ -20,6 +32,7 @@ class AbstractHierarchyModel(object):
     name_format = "%c"
     field_critical_section_flag = None
     field_reference_counter = None
+    usage_kind = None
 
     def __new__(cls):
         if not hasattr(cls, "instance"):
@@ -60,21 +73,63 @@ class AbstractHierarchyModel(object):
         return q["name"]
 
     @staticmethod
-    def createSubdir(rootDir: Path, rootFolder: dict, name: str, user=None) -> dict:
+    def createSubdir(
+        rootDir: Path,
+        rootFolder: dict,
+        name: str,
+        user=None,
+        fields: Optional[dict] = None,
+        updates: Optional[list] = None,
+    ) -> dict:
         """Create both Girder folder and corresponding directory. The name is stored in the Girder
         folder, whereas the name of the directory is taken from the folder ID. This is a
         deliberate step to discourage renaming of directories directly on disk, which would mess
         up the mapping between Girder folders and directories
+
+        The folder is built in full, with the given additional fields, as Folder().createFolder
+        would (the name must have been checked with checkNameSanity), validated and inserted in a
+        single bulk write with the update of the time of the root and the given updates of other
+        folders (pymongo UpdateOne operations). The events of Folder().save are triggered around
+        the write.
         """
-        folder = Folder().createFolder(rootFolder, name, creator=user)
-        dirname = str(folder["_id"])
-        directory = rootDir / dirname
+        _id = ObjectId()
+        directory = rootDir / str(_id)
+        now = datetime.utcnow()
+        folder = {
+            "_id": _id,
+            "name": name,
+            "lowerName": name.lower(),
+            "description": "",
+            "parentCollection": "folder",
+            "parentId": rootFolder["_id"],
+            "baseParentType": rootFolder["baseParentType"],
+            "baseParentId": rootFolder["baseParentId"],
+            "creatorId": None if user is None else user["_id"],
+            "created": now,
+            "updated": now,
+            "size": 0,
+            "meta": {},
+            "fsPath": directory.absolute().as_posix(),
+            "isMapping": True,
+        }
+        folder.update(fields or {})
+        Folder().copyAccessPolicies(rootFolder, folder, save=False)
+        if user is not None:
+            Folder().setUserAccess(folder, user=user, level=AccessType.ADMIN, save=False)
+        if not events.trigger("model.folder.validate", folder).defaultPrevented:
+            folder = Folder().validate(folder)
+        events.trigger("model.folder.save", folder)
         directory.mkdir(parents=True)
-        folder.update({"fsPath": directory.absolute().as_posix(), "isMapping": True})
-        folder = Folder().save(folder, validate=False, triggerEvents=False)
-
-        # update the time
-        Folder().updateFolder(rootFolder)
+        Folder().collection.bulk_write(
+            [
+                pymongo.InsertOne(folder),
+                # update the time
+                pymongo.UpdateOne({"_id": rootFolder["_id"]}, {"$set": {"updated": now}}),
+            ]
+            + (updates or [])
+        )
+        events.trigger("model.folder.save.created", folder)
+        events.trigger("model.folder.save.after", folder)
         return folder
 
     def snapshot(
@@ -103,25 +158,94 @@ class AbstractHierarchyModel(object):
         instead of doing an actual copy. This allows for O(1) equality comparisons between files,
         but requires that modifications to files in the workspace always create a new file (which
         is the case if files are only modified through the WebDAV FS mounted in a tale container).
+
+        While linking, the number of files and directories in the new version, their logical size
+        and the size of the files that are not shared with the old version are collected and
+        stored in the version folder. Finally, the listing of the new workspace is written to its
+        index (see VersionIndex).
+
+        If the workspace is the same as the one of the previous version, i.e. only the metadata
+        of the tale changed, nothing is linked and the new version shares the workspace of the
+        previous one (see shareWorkspace).
         """
+        metrics = Metrics()
         new_version_path = Path(new_version["fsPath"])
-        manifest = Manifest(
-            tale, user, versionId=new_version["_id"], expand_folders=False
-        )
-        with open((new_version_path / "manifest.json").as_posix(), "w") as fp:
-            fp.write(manifest.dump_manifest())
-
-        with open((new_version_path / "environment.json").as_posix(), "w") as fp:
-            fp.write(manifest.dump_environment())
+        with metrics.phase("manifest"):
+            manifest = Manifest(
+                tale, user, versionId=new_version["_id"], expand_folders=False
+            )
+            with open((new_version_path / "manifest.json").as_posix(), "w") as fp:
+                fp.write(manifest.dump_manifest())
+
+            # The environment rarely changes between versions, it is stored once
+            new_version[FIELD_ENVIRONMENT_DIGEST] = DocumentStore().write(
+                new_version_path.parent,
+                manifest.dump_environment(),
+                new_version_path / "environment.json",
+            )
 
         oldWorkspace = (
             None if version is None else Path(version["fsPath"]) / "workspace"
         )
         workspace = Folder().load(tale["workspaceId"], force=True)
         crtWorkspace = Path(workspace["fsPath"])
-        newWorkspace = new_version_path / "workspace"
-        newWorkspace.mkdir()
-        self.snapshotRecursive(oldWorkspace, crtWorkspace, newWorkspace)
+        with metrics.phase("same_tree"):
+            same = (
+                version is not None
+                and FIELD_VERSION_STATS in version
+                and self.sameTree(oldWorkspace, crtWorkspace)
+            )
+        reused = 0
+        if same:
+            self.shareWorkspace(version, new_version)
+        else:
+            newWorkspace = new_version_path / "workspace"
+            newWorkspace.mkdir()
+            stats = {"fileCount": 0, "dirCount": 0, "size": 0, "newSize": 0, "reused": 0}
+            previous = None
+            if version is not None:
+                with metrics.phase("index"):
+                    previous = {
+                        _["ino"] for _ in VersionIndex(version).entries() if _["type"] == "file"
+                    }
+            with metrics.phase("link"):
+                self.snapshotRecursive(
+                    oldWorkspace, crtWorkspace, newWorkspace, stats=stats, previous=previous
+                )
+            reused = stats.pop("reused")
+            new_version[FIELD_VERSION_STATS] = stats
+            with metrics.phase("index"):
+                VersionIndex(new_version).build()
+        with metrics.phase("index"):
+            self.recordSnapshot(new_version)
+        Folder().save(new_version, False)
+        if reused:
+            # Files of an older version, which the comparison with the previous one misses
+            with metrics.phase("rescan"):
+                StorageAccounting().rescanTale(tale, self.usage_kind)
+        else:
+            StorageAccounting().addUsage(
+                new_version["parentId"], self.usage_kind,
+                size=new_version[FIELD_VERSION_STATS]["newSize"]
+            )
+
+    @staticmethod
+    def shareWorkspace(version: dict, new_version: dict) -> None:
+        """Makes the workspace of new_version a link to the (immutable) workspace of version,
+        or to the one version links to, so that the link is always one level deep. The version
+        that owns the workspace is stored in the workspaceVersionId field of new_version. The
+        index is shared as well, since it is replaced, not modified, when rebuilt.
+        """
+        ownerId = version.get(FIELD_WORKSPACE_VERSION_ID, version["_id"])
+        new_version_path = Path(new_version["fsPath"])
+        (new_version_path / "workspace").symlink_to(
+            Path("..") / str(ownerId) / "workspace", target_is_directory=True
+        )
+        index = VersionIndex(version)
+        if index.exists():
+            os.link(index.path, VersionIndex(new_version).path)
+        new_version[FIELD_WORKSPACE_VERSION_ID] = ownerId
+        new_version[FIELD_VERSION_STATS] = dict(version[FIELD_VERSION_STATS], newSize=0)
 
     def is_same(self, tale, version, user):
         workspace = Folder().load(tale["workspaceId"], force=True)
@@ -132,21 +256,33 @@ class AbstractHierarchyModel(object):
             None if version_path is None else version_path / "workspace"
         )
 
-        manifest_obj = Manifest(tale, user)
-        manifest = json.loads(manifest_obj.dump_manifest())
-        environment = json.loads(manifest_obj.dump_environment())
-        tale_restored_from_wrk = Tale().restoreTale(manifest, environment)
-        tale_restored_from_ver = (
-            self.restoreTaleFromVersion(version, annotate=False) if version else None
-        )
-
-        if self.sameTaleMetadata(
-            tale_restored_from_ver, tale_restored_from_wrk
-        ) and self.sameTree(version_workspace_path, tale_workspace_path):
-            raise RestException("Not modified", code=303, extra=str(version["_id"]))
-
-    def snapshotRecursive(self, old: Optional[Path], crt: Path, new: Path) -> None:
+        with Metrics().phase("manifest"):
+            manifest_obj = Manifest(tale, user)
+            manifest = json.loads(manifest_obj.dump_manifest())
+            environment = json.loads(manifest_obj.dump_environment())
+            tale_restored_from_wrk = Tale().restoreTale(manifest, environment)
+            tale_restored_from_ver = (
+                self.restoreTaleFromVersion(version, annotate=False) if version else None
+            )
+
+        if self.sameTaleMetadata(tale_restored_from_ver, tale_restored_from_wrk):
+            with Metrics().phase("same_tree"):
+                same = self.sameTree(version_workspace_path, tale_workspace_path)
+            if same:
+                Metrics().annotate(notModified=True)
+                raise RestException("Not modified", code=303, extra=str(version["_id"]))
+
+    def snapshotRecursive(
+        self,
+        old: Optional[Path],
+        crt: Path,
+        new: Path,
+        stats: Optional[dict] = None,
+        previous: Optional[Set[int]] = None,
+    ) -> None:
+        metrics = Metrics()
         for c in crt.iterdir():
+            metrics.count("files")
             newc = new / c.name
             oldc = None if old is None else old / c.name
             crtc = crt / c.name
@@ -161,7 +297,9 @@ class AbstractHierarchyModel(object):
 
             if c.is_dir():
                 newc.mkdir()
-                self.snapshotRecursive(oldc, crtc, newc)
+                if stats is not None:
+                    stats["dirCount"] += 1
+                self.snapshotRecursive(oldc, crtc, newc, stats=stats, previous=previous)
             else:
                 crtcstr = crtc.absolute()
                 newcstr = newc.absolute()
@@ -171,6 +309,33 @@ class AbstractHierarchyModel(object):
                     logger.warn("link %s -> %s" % (crtcstr, newcstr))
                     raise
                 shutil.copystat(crtcstr, newcstr)
+                metrics.count("links")
+                TreeOperationScheduler().tick()
+                if stats is not None:
+                    self.updateStats(stats, newc, oldc, previous)
+
+    @staticmethod
+    def updateStats(
+        stats: dict, new: Path, old: Optional[Path], previous: Optional[Set[int]] = None
+    ) -> None:
+        """Counts a file linked into a new version. previous holds the inodes of the files of
+        the previous version, which catches files that were moved since.
+        """
+        st = new.stat()
+        stats["fileCount"] += 1
+        stats["size"] += st.st_size
+        if old is not None:
+            old_st = old.stat()
+            if (old_st.st_ino, old_st.st_dev) == (st.st_ino, st.st_dev):
+                return
+        if previous is not None and st.st_ino in previous:
+            return
+        if st.st_nlink > 2:
+            # Linked from somewhere else than the workspace, e.g. from an older version
+            # after a restore, so it is not new
+            stats["reused"] += 1
+            return
+        stats["newSize"] += st.st_size
 
     def incrementReferenceCount(self, vfolder):
         if self.field_reference_counter not in vfolder:
@@ -181,15 +346,16 @@ class AbstractHierarchyModel(object):
         self.updateReferenceCount(vfolder, -1)
 
     def updateReferenceCount(self, vfolder: dict, n: int):
-        root = Folder().load(vfolder["parentId"], force=True)
-        self.setCriticalSectionFlag(root)
-        try:
-            vfolder[self.field_reference_counter] += n
-            vfolder = Folder().save(vfolder)
-        except KeyError:
-            pass
-        finally:
-            self.resetCriticalSectionFlag(root)
+        if self.field_reference_counter not in vfolder:
+            return
+        vfolder[self.field_reference_counter] += n
+        Folder().update(
+            {"_id": vfolder["_id"]}, self.referenceCountUpdate(n), multi=False
+        )
+
+    def referenceCountUpdate(self, n: int) -> dict:
+        """The atomic update of the reference counter of a folder by n."""
+        return {"$inc": {self.field_reference_counter: n}}
 
     def setCriticalSectionFlag(self, root: dict) -> bool:
         return self.updateCriticalSectionFlag(root, True)
@@ -198,17 +364,18 @@ class AbstractHierarchyModel(object):
         return self.updateCriticalSectionFlag(root, False)
 
     def updateCriticalSectionFlag(self, root: dict, value: bool) -> bool:
-        result = Folder().update(
-            query={
-                "_id": root["_id"],
-                self.field_critical_section_flag: {"$ne": value},
-            },
-            update={
-                "$set": {self.field_critical_section_flag: value},
-                "$inc": {self.field_sequence_number: 1},
-            },
-            multi=False,
-        )
+        with Metrics().phase("lock"):
+            result = Folder().update(
+                query={
+                    "_id": root["_id"],
+                    self.field_critical_section_flag: {"$ne": value},
+                },
+                update={
+                    "$set": {self.field_critical_section_flag: value},
+                    "$inc": {self.field_sequence_number: 1},
+                },
+                multi=False,
+            )
         return result.matched_count > 0
 
     def generateName(self):
@@ -224,7 +391,11 @@ class AbstractHierarchyModel(object):
     def sameTree(self, old: Optional[Path], crt: Path) -> bool:
         if old is None:
             return False
+        if {_.name for _ in old.iterdir()} != {_.name for _ in crt.iterdir()}:
+            return False  # something was added or removed
+        metrics = Metrics()
         for c in crt.iterdir():
+            metrics.count("files")
             oldc = old / c.name
             crtc = crt / c.name
 
@@ -244,14 +415,12 @@ class AbstractHierarchyModel(object):
 
     def remove(self, version: dict, user: dict) -> None:
         root = Folder().load(version["parentId"], user=user, level=AccessType.WRITE)
-        self.setCriticalSectionFlag(root)
+        if not self.setCriticalSectionFlag(root):
+            raise RestException("Another operation is in progress. Try again later.", 409)
         try:
             # make sure we use information protected by the critical section
             version = Folder().load(version["_id"], user=user, level=AccessType.ADMIN)
-            if version.get(self.field_reference_counter, 0) > 0:
-                raise RestException(
-                    "Version is in use by a run and cannot be deleted.", 461
-                )
+            self.checkRemovable(version)
         finally:
             self.resetCriticalSectionFlag(root)
 
@@ -259,5 +428,62 @@ class AbstractHierarchyModel(object):
         trashDir = path.parent / ".trash"
         Folder().remove(version)
 
-        shutil.move(path.as_posix(), trashDir)
-        Tale().updateTale(Tale().load(root["taleId"], force=True))
+        with Metrics().phase("move"):
+            shutil.move(path.as_posix(), trashDir)
+        TimestampCoalescer().touchTale(root["taleId"])
+
+    def removeBatch(self, root: dict, folders: List[dict]) -> List[dict]:
+        """Moves several folders of the same root to the trash. The critical section is
+        taken once and reference counters are checked with a single query; folders that are in
+        use are skipped. The folders are deleted with a single query and the tale is updated
+        once, at the end. Returns the removed folders.
+        """
+        if not folders:
+            return []
+        locked = self.field_critical_section_flag is not None
+        if locked and not self.setCriticalSectionFlag(root):
+            raise RestException("Another operation is in progress. Try again later.", 409)
+        try:
+            query = {"_id": {"$in": [_["_id"] for _ in folders]}, "parentId": root["_id"]}
+            query.update(self.removableQuery())
+            removed = list(Folder().find(query, sort=[("created", pymongo.ASCENDING)]))
+            # Version and run folders are mappings of directories, they have no Girder children
+            Folder().removeWithQuery({"_id": {"$in": [_["_id"] for _ in removed]}})
+        finally:
+            if locked:
+                self.resetCriticalSectionFlag(root)
+
+        metrics = Metrics()
+        for folder in removed:
+            path = Path(folder["fsPath"])
+            with metrics.phase("move"):
+                shutil.move(path.as_posix(), (path.parent / ".trash").as_posix())
+            with metrics.phase("accounting"):
+                self.recordRemoval(folder)
+        coalescer = TimestampCoalescer()
+        coalescer.touchFolder(root["_id"])
+        coalescer.touchTale(root["taleId"])
+        return removed
+
+    def checkRemovable(self, folder: dict) -> None:
+        """Raises a RestException if the folder cannot be moved to the trash. Called from within
+        the critical section.
+        """
+        if folder.get(self.field_reference_counter, 0) > 0:
+            raise RestException("Version is in use by a run and cannot be deleted.", 461)
+
+    def removableQuery(self) -> dict:
+        """Returns the query conditions that select the folders removeBatch() may remove."""
+        if self.field_reference_counter:
+            return {self.field_reference_counter: {"$not": {"$gt": 0}}}
+        return {}
+
+    def recordSnapshot(self, folder: dict) -> None:
+        """Called after the workspace of a new version or run was linked and indexed, before
+        the folder is saved.
+        """
+        pass
+
+    def recordRemoval(self, folder: dict) -> None:
+        """Updates the storage usage after a folder was moved to the trash."""
+        pass
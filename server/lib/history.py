@@ -0,0 +1,104 @@
+import os
+import stat
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Optional
+
+import pymongo
+from girder.models.folder import Folder
+
+from .index import VersionIndex
+from .version_hierarchy import VersionHierarchyModel
+from ..constants import FIELD_VERSION_STATUS_CODE
+
+
+class FileHistory(object):
+    """Finds the versions of a tale in which a workspace path was added, modified or removed. A
+    file is modified when its inode differs from the one in the previous version; directories
+    are only reported when they appear or disappear. Each version is looked up in its index, if
+    it has one, so the cost is proportional to the number of versions rather than to the number
+    of files.
+
+    Results are memoized per versions root and path. The sequence number of the versions root,
+    which changes whenever versions are created or removed, and its update time, which changes
+    when versions are renamed, are part of the key.
+    """
+
+    max_size = 256
+
+    def __new__(cls):
+        if not hasattr(cls, "instance"):
+            cls.instance = super(FileHistory, cls).__new__(cls)
+            cls.instance._cache = OrderedDict()
+            cls.instance._lock = threading.Lock()
+        return cls.instance
+
+    def get(self, tale: dict, path: str) -> List[dict]:
+        root = VersionHierarchyModel().getRootFromTale(tale)
+        key = (root["_id"], root.get("seq"), root.get("updated"), path)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        history = self._compute(root, path)
+        with self._lock:
+            self._cache[key] = history
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return history
+
+    def _compute(self, root: dict, path: str) -> List[dict]:
+        versions = Folder().find(
+            {"parentId": root["_id"]},
+            fields=["name", "created", "fsPath", FIELD_VERSION_STATUS_CODE],
+            sort=[("created", pymongo.ASCENDING)],
+        )
+        history = []
+        previous = None
+        for version in versions:
+            if not VersionHierarchyModel.isReady(version):
+                continue
+            entry = self._lookup(version, path)
+            change = None
+            if entry is None:
+                if previous is not None:
+                    change = "removed"
+            elif previous is None:
+                change = "added"
+            elif entry["type"] != previous["type"]:
+                change = "modified"
+            elif entry["type"] != "directory" and entry["ino"] != previous["ino"]:
+                change = "modified"
+            if change is not None:
+                record = {
+                    "versionId": version["_id"],
+                    "name": version["name"],
+                    "created": version["created"],
+                    "change": change,
+                }
+                if entry is not None:
+                    record.update(type=entry["type"], size=entry["size"])
+                history.append(record)
+            previous = entry
+        return history
+
+    @staticmethod
+    def _lookup(version: dict, path: str) -> Optional[dict]:
+        index = VersionIndex(version)
+        if index.exists():
+            entry = index.lookup(path)
+            if entry is None or entry["ino"] is not None:
+                return entry
+        try:
+            st = os.lstat(Path(version["fsPath"]) / "workspace" / path)
+        except FileNotFoundError:
+            return None
+        if stat.S_ISDIR(st.st_mode):
+            kind = "directory"
+        elif stat.S_ISLNK(st.st_mode):
+            kind = "symlink"
+        else:
+            kind = "file"
+        return {"type": kind, "size": st.st_size, "mtime": int(st.st_mtime), "ino": st.st_ino}
@@ -0,0 +1,334 @@
+import copy
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tarfile
+from datetime import datetime
+from pathlib import Path, PurePosixPath
+from typing import BinaryIO, Callable, List, Optional, Set
+
+from bson import ObjectId
+from girder.models.folder import Folder
+from girder.plugins.wholetale.lib.manifest import Manifest
+
+from .accounting import StorageAccounting
+from .archive import METADATA_NAME
+from .coalesce import TimestampCoalescer
+from .index import VersionIndex
+from .objects import DocumentStore
+from .scheduler import TreeOperationScheduler
+from .search import VersionFile
+from .version_hierarchy import VersionHierarchyModel
+from ..constants import FIELD_ENVIRONMENT_DIGEST, FIELD_SEARCH_SEQ, FIELD_VERSION_STATS
+
+BUF_SIZE = 65536
+
+
+class VersionImporter(object):
+    """Imports versions from a tar archive (optionally compressed) into the versions of a tale.
+    Each top level directory of the archive is a version, laid out as on disk, i.e., with a
+    manifest.json, an environment.json and a workspace directory. This is the layout produced by
+    GET /version/:id/archive. Versions are expected in chronological order: a workspace file
+    identical to the file with the same path in the preceding version is hard linked to it
+    instead of being stored again. The name and the creation time of a version are read from
+    its version.json, which GET /version/:id/archive adds. Without it, the version is named
+    after its top level directory, whose modification time is used as its creation time.
+
+    Nothing is written outside of the versions: paths and links that would lead outside of
+    their version are rejected, as are hard links to anything but the files of the archive,
+    and no file or directory is created through a link.
+
+    The archive is read as a stream and all the folders are inserted with a single query once
+    the archive was unpacked. Only the directories created are remembered, hard links are
+    resolved on disk. If the import fails, the folders, the search index entries and the
+    directories of the versions are removed.
+    """
+
+    def __init__(
+        self,
+        tale: dict,
+        root: dict,
+        rootDir: Path,
+        user: dict,
+        progress: Optional[Callable[[str], None]] = None,
+    ):
+        self.tale = tale
+        self.root = root
+        self.rootDir = rootDir
+        self.user = user
+        self.progress = progress
+        self.versions = []  # type: List[dict]
+        self.byName = {}  # type: dict
+        self.dirs: Set[Path] = set()
+        self.folders = []  # type: List[dict]
+
+    def run(self, fileobj: BinaryIO) -> List[dict]:
+        try:
+            with tarfile.open(fileobj=fileobj, mode="r|*") as tf:
+                for member in tf:
+                    self._extract(tf, member)
+            folders = self._insert()
+        except Exception:
+            self._discard()
+            raise
+        self._writeManifests(folders)
+        return folders
+
+    def _version(self, name: str) -> dict:
+        version = self.byName.get(name)
+        if version is None:
+            previous = self.versions[-1] if self.versions else None
+            if previous is not None and previous["previous"] is not None:
+                # Only the hashes of the preceding version are needed
+                previous["previous"]["hashes"] = {}
+            _id = ObjectId()
+            version = {
+                "_id": _id,
+                "name": name,
+                "path": self.rootDir / str(_id),
+                "created": None,
+                "previous": previous,
+                "hashes": {},
+                "stats": {"fileCount": 0, "dirCount": 0, "size": 0, "newSize": 0},
+            }
+            version["path"].mkdir(parents=True)
+            self.versions.append(version)
+            self.byName[name] = version
+            if self.progress is not None:
+                self.progress(f"Importing version {name}")
+        return version
+
+    def _target(self, name: str) -> Path:
+        parts = PurePosixPath(name).parts
+        if not parts or parts[0] == "/" or ".." in parts:
+            raise ValueError(f"Illegal path in archive: {name}")
+        return self._version(parts[0])["path"].joinpath(*parts[1:])
+
+    def _makeParents(self, version: dict, target: Path) -> None:
+        """Creates the missing directories above target, checking that the existing ones are
+        directories, not links, so that nothing is written outside of the version.
+        """
+        parents = []
+        for parent in target.parents:
+            if parent == version["path"]:
+                break
+            parents.append(parent)
+        for parent in reversed(parents):
+            if parent in self.dirs:
+                continue
+            try:
+                st = os.lstat(parent)
+            except FileNotFoundError:
+                parent.mkdir()
+            else:
+                if not stat.S_ISDIR(st.st_mode):
+                    raise ValueError(f"Illegal path in archive, {parent.name} is not a directory")
+            self.dirs.add(parent)
+
+    @staticmethod
+    def _checkSymlink(member: tarfile.TarInfo) -> None:
+        """Only allows links to paths within the version, which go up (with leading ..) no
+        further than the version directory and then only down. Since links are only made to
+        such paths, those of the path are resolved within the version too.
+        """
+        parts = PurePosixPath(member.linkname).parts
+        up = 0
+        while up < len(parts) and parts[up] == "..":
+            up += 1
+        depth = len(PurePosixPath(member.name).parts) - 2
+        if (
+            not parts
+            or parts[0] == "/"
+            or ".." in parts[up:]
+            or up > depth
+        ):
+            raise ValueError(f"Illegal link in archive: {member.name} -> {member.linkname}")
+
+    def _extract(self, tf: tarfile.TarFile, member: tarfile.TarInfo) -> None:
+        parts = PurePosixPath(member.name).parts
+        target = self._target(member.name)
+        version = self.byName[parts[0]]
+        inWorkspace = len(parts) > 2 and parts[1] == "workspace"
+        if len(parts) == 1:
+            if member.isdir():
+                version["created"] = datetime.utcfromtimestamp(member.mtime)
+            return
+
+        if len(parts) == 2 and parts[1] == METADATA_NAME and member.isfile():
+            self._readMetadata(tf, member, version)
+            return
+
+        self._makeParents(version, target)
+        if member.isdir():
+            self._extractDir(member, target)
+            if inWorkspace:
+                version["stats"]["dirCount"] += 1
+            return
+        if not (member.issym() or member.islnk() or member.isfile()):
+            return
+        if os.path.lexists(target):
+            raise ValueError(f"Illegal path in archive, {member.name} already exists")
+        if member.issym():
+            self._checkSymlink(member)
+            target.symlink_to(member.linkname)
+        elif member.islnk():
+            source = self._linkSource(member)
+            os.link(source, target, follow_symlinks=False)
+            if inWorkspace:
+                version["stats"]["fileCount"] += 1
+                version["stats"]["size"] += source.stat().st_size
+        else:
+            self._extractFile(tf, member, version, PurePosixPath(*parts[1:]), target, inWorkspace)
+            if inWorkspace:
+                version["stats"]["fileCount"] += 1
+                version["stats"]["size"] += member.size
+        TreeOperationScheduler().tick()
+
+    def _linkSource(self, member: tarfile.TarInfo) -> Path:
+        """Returns the file a hard link of the archive points to, which must be a file of the
+        archive extracted before: a regular file in a directory that was created by the import.
+        """
+        parts = PurePosixPath(member.linkname).parts
+        source = None
+        if parts and parts[0] in self.byName and ".." not in parts and len(parts) > 1:
+            source = self.byName[parts[0]]["path"].joinpath(*parts[1:])
+            if len(parts) > 2 and source.parent not in self.dirs:
+                source = None
+        try:
+            if source is not None and stat.S_ISREG(os.lstat(source).st_mode):
+                return source
+        except FileNotFoundError:
+            pass
+        raise ValueError(f"Illegal link in archive: {member.name} -> {member.linkname}")
+
+    def _extractDir(self, member: tarfile.TarInfo, target: Path) -> None:
+        if target in self.dirs:
+            return  # created as the parent of a previous member
+        if os.path.lexists(target):
+            raise ValueError(f"Illegal path in archive, {member.name} already exists")
+        target.mkdir()
+        self.dirs.add(target)
+
+    @staticmethod
+    def _readMetadata(tf: tarfile.TarFile, member: tarfile.TarInfo, version: dict) -> None:
+        try:
+            if member.size > BUF_SIZE:
+                raise ValueError("too large")
+            metadata = json.loads(tf.extractfile(member).read().decode())
+            if "name" in metadata:
+                version["name"] = str(metadata["name"])
+            if "created" in metadata:
+                version["created"] = datetime.fromisoformat(metadata["created"])
+        except (AttributeError, TypeError, ValueError) as exc:
+            raise ValueError(f"Illegal {member.name} in archive: {exc}")
+
+    def _extractFile(
+        self,
+        tf: tarfile.TarFile,
+        member: tarfile.TarInfo,
+        version: dict,
+        relpath: PurePosixPath,
+        target: Path,
+        inWorkspace: bool,
+    ) -> None:
+        digest = hashlib.sha256()
+        src = tf.extractfile(member)
+        fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+        with open(fd, "wb") as fp:
+            while True:
+                data = src.read(BUF_SIZE)
+                if not data:
+                    break
+                digest.update(data)
+                fp.write(data)
+        os.chmod(target, member.mode & 0o777)
+        os.utime(target, (member.mtime, member.mtime))
+        if not inWorkspace:
+            return
+
+        key = digest.hexdigest()
+        version["hashes"][relpath] = key
+        previous = version["previous"]
+        if previous is not None and previous["hashes"].get(relpath) == key:
+            target.unlink()
+            os.link(previous["path"] / relpath, target, follow_symlinks=False)
+        else:
+            version["stats"]["newSize"] += member.size
+
+    def _insert(self) -> List[dict]:
+        if not self.versions:
+            return []
+        now = datetime.utcnow()
+        names = set()
+        folders = self.folders
+        for version in self.versions:
+            for fname in ("manifest.json", "environment.json"):
+                path = version["path"] / fname
+                if path.is_symlink() or not path.is_file():
+                    raise ValueError(f"{version['name']} is not a version, {fname} is missing")
+            (version["path"] / "workspace").mkdir(exist_ok=True)
+            name = base = VersionHierarchyModel.checkNameSanity(
+                version["name"], self.root, allow_rename=True
+            )
+            n = 0
+            while name in names:
+                n += 1
+                name = f"{base} ({n})"
+            names.add(name)
+            folder = {
+                "_id": version["_id"],
+                "name": name,
+                "lowerName": name.lower(),
+                "description": "",
+                "parentCollection": "folder",
+                "parentId": self.root["_id"],
+                "baseParentType": self.root["baseParentType"],
+                "baseParentId": self.root["baseParentId"],
+                "creatorId": self.user["_id"],
+                "created": version["created"] or now,
+                "updated": now,
+                "size": 0,
+                "meta": {},
+                "fsPath": version["path"].absolute().as_posix(),
+                "isMapping": True,
+                FIELD_VERSION_STATS: version["stats"],
+                FIELD_ENVIRONMENT_DIGEST: DocumentStore().adopt(
+                    self.rootDir, version["path"] / "environment.json"
+                ),
+            }
+            Folder().copyAccessPolicies(self.root, folder, save=False)
+            folders.append(folder)
+            VersionIndex(folder).build()
+            VersionFile().addVersion(folder)
+        Folder().collection.insert_many(folders)
+        StorageAccounting().addUsage(
+            self.root["_id"],
+            VersionHierarchyModel.usage_kind,
+            size=sum(_["stats"]["newSize"] for _ in self.versions),
+        )
+        # Not a save, the root was updated since it was loaded, e.g. its searchSeq
+        TimestampCoalescer().touchFolder(self.root["_id"])
+        return folders
+
+    def _discard(self) -> None:
+        """Removes what a failed import created."""
+        Folder().removeWithQuery({"_id": {"$in": [_["_id"] for _ in self.folders]}})
+        for folder in self.folders:
+            if FIELD_SEARCH_SEQ in folder:
+                VersionFile().dropVersion(folder)
+        for version in self.versions:
+            shutil.rmtree(version["path"], ignore_errors=True)
+
+    def _writeManifests(self, folders: List[dict]) -> None:
+        # The manifests refer to the ids of the exported versions
+        for folder in folders:
+            tale = copy.deepcopy(self.tale)
+            tale.update(VersionHierarchyModel().restoreTaleFromVersion(folder))
+            manifest = Manifest(tale, self.user, versionId=folder["_id"], expand_folders=False)
+            path = Path(folder["fsPath"]) / "manifest.json"
+            # The archive may have stored it as a link to the manifest of another version
+            path.unlink()
+            with open(path, "w") as fp:
+                fp.write(manifest.dump_manifest())
@@ -0,0 +1,185 @@
+import mmap
+import os
+import stat
+import uuid
+from pathlib import Path, PurePosixPath
+from typing import Iterator, List, Optional, Tuple
+
+INDEX_FILE = ".index"
+TYPES = {"d": "directory", "f": "file", "l": "symlink"}
+
+
+def _escape(name: str) -> bytes:
+    return (
+        name.encode("utf-8", "surrogateescape")
+        .replace(b"\\", b"\\\\")
+        .replace(b"\t", b"\\t")
+        .replace(b"\n", b"\\n")
+    )
+
+
+def _unescape(data: bytes) -> str:
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        c = data[i:i + 1]
+        if c == b"\\" and i + 1 < len(data):
+            out += {b"t": b"\t", b"n": b"\n"}.get(data[i + 1:i + 2], data[i + 1:i + 2])
+            i += 2
+        else:
+            out += c
+            i += 1
+    return out.decode("utf-8", "surrogateescape")
+
+
+class VersionIndex(object):
+    """A listing of the workspace of a version, stored in the .index file of the version
+    directory. Since versions are immutable, the index is written once, when the version is
+    created (or lazily, for versions that predate the index), and directories are listed
+    without touching the workspace.
+
+    The index has one line per entry, "<parent>\\t<name>\\t<type>\\t<size>\\t<mtime>\\t<inode>",
+    sorted by parent and name, so that the entries of a directory are contiguous and can be found
+    by a binary search over the memory mapped file. The name of the last entry returned serves
+    as the pagination cursor.
+    """
+
+    def __init__(self, version: dict):
+        self.root = Path(version["fsPath"])
+        self.workspace = self.root / "workspace"
+        self.path = self.root / INDEX_FILE
+
+    def build(self) -> None:
+        dirs = [""]
+        for dirpath, dirnames, _ in os.walk(self.workspace):
+            rel = os.path.relpath(dirpath, self.workspace)
+            prefix = "" if rel == "." else rel + "/"
+            dirs.extend(prefix + _ for _ in dirnames)
+        dirs.sort(key=_escape)
+
+        tmp = self.path.with_name(f"{INDEX_FILE}.{uuid.uuid4().hex}")
+        with open(tmp, "wb") as fp:
+            for parent in dirs:
+                eparent = _escape(parent)
+                with os.scandir(self.workspace / parent) as it:
+                    entries = sorted(((_escape(_.name), _) for _ in it), key=lambda _: _[0])
+                for ename, entry in entries:
+                    st = entry.stat(follow_symlinks=False)
+                    if stat.S_ISDIR(st.st_mode):
+                        kind = b"d"
+                    elif stat.S_ISLNK(st.st_mode):
+                        kind = b"l"
+                    else:
+                        kind = b"f"
+                    fields = (st.st_size, st.st_mtime, st.st_ino)
+                    fp.write(
+                        b"\t".join((eparent, ename, kind) + tuple(b"%d" % _ for _ in fields))
+                        + b"\n"
+                    )
+        os.replace(tmp, self.path)
+
+    def list(
+        self, parent: str = "", cursor: Optional[str] = None, limit: int = 100
+    ) -> Tuple[List[dict], Optional[str]]:
+        """Returns up to limit entries of the directory parent (relative to the workspace)
+        whose names follow cursor, and the cursor for the next page (None on the last page).
+        """
+        if not self.path.is_file():
+            self.build()
+        parent = str(PurePosixPath(parent)).strip("/")
+        parent = "" if parent == "." else parent
+        items = []
+        for ename, fields in self._scan(_escape(parent), cursor):
+            if limit and len(items) == limit:
+                return items, items[-1]["name"]
+            name = _unescape(ename)
+            items.append(
+                {
+                    "name": name,
+                    "path": f"{parent}/{name}" if parent else name,
+                    "type": TYPES[fields[0].decode()],
+                    "size": int(fields[1]),
+                    "mtime": int(fields[2]),
+                }
+            )
+        return items, None
+
+    def entries(self) -> Iterator[dict]:
+        """Yields all the entries of the workspace, as dicts with path, name, type, size, mtime
+        and inode.
+        """
+        if not self.path.is_file():
+            self.build()
+        with open(self.path, "rb") as fp:
+            for line in fp:
+                fields = line.rstrip(b"\n").split(b"\t")
+                parent, name = _unescape(fields[0]), _unescape(fields[1])
+                yield {
+                    "path": f"{parent}/{name}" if parent else name,
+                    "name": name,
+                    "type": TYPES[fields[2].decode()],
+                    "size": int(fields[3]),
+                    "mtime": int(fields[4]),
+                    "ino": int(fields[5]) if len(fields) > 5 else None,
+                }
+
+    def exists(self) -> bool:
+        return self.path.is_file()
+
+    def lookup(self, path: str) -> Optional[dict]:
+        """Returns the type, size, mtime and inode of the entry at path (relative to the
+        workspace), or None if there is no such entry.
+        """
+        parent, name = os.path.split(str(PurePosixPath(path)).strip("/"))
+        key = _escape(parent) + b"\t" + _escape(name) + b"\t"
+        if self.path.stat().st_size == 0:
+            return None
+        with open(self.path, "rb") as fp, mmap.mmap(
+            fp.fileno(), 0, access=mmap.ACCESS_READ
+        ) as mm:
+            offset = self._lowerBound(mm, key)
+            end = mm.find(b"\n", offset)
+            line = mm[offset:end] if offset < len(mm) else b""
+        if not line.startswith(key):
+            return None
+        fields = line[len(key):].split(b"\t")
+        return {
+            "type": TYPES[fields[0].decode()],
+            "size": int(fields[1]),
+            "mtime": int(fields[2]),
+            "ino": int(fields[3]) if len(fields) > 3 else None,
+        }
+
+    def _scan(self, parent: bytes, cursor: Optional[str]) -> Iterator[Tuple[bytes, list]]:
+        if self.path.stat().st_size == 0:
+            return
+        prefix = parent + b"\t"
+        key = prefix if cursor is None else prefix + _escape(cursor) + b"\t"
+        with open(self.path, "rb") as fp, mmap.mmap(
+            fp.fileno(), 0, access=mmap.ACCESS_READ
+        ) as mm:
+            offset = self._lowerBound(mm, key)
+            while offset < len(mm):
+                end = mm.find(b"\n", offset)
+                line = mm[offset:end]
+                offset = end + 1
+                if not line.startswith(prefix):
+                    return
+                fields = line[len(prefix):].split(b"\t")
+                if cursor is not None and line.startswith(key):
+                    continue  # the cursor entry itself
+                yield fields[0], fields[1:]
+
+    @staticmethod
+    def _lowerBound(mm: mmap.mmap, key: bytes) -> int:
+        """Returns the offset of the first line that is not less than key."""
+        lo, hi = 0, len(mm)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = mm.rfind(b"\n", 0, mid) + 1
+            end = mm.find(b"\n", start)
+            if mm[start:end] < key:
+                lo = end + 1
+            else:
+                hi = start
+        return lo
@@ -0,0 +1,216 @@
+import bisect
+import functools
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from girder import logger
+from girder.models.setting import Setting
+
+from ..constants import PluginSettings
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+PREFIX = "wt_versioning"
+COUNTERS = {
+    "files": "Files and directories visited.",
+    "links": "Hard links made.",
+    "bytes_copied": "Bytes copied.",
+    "runs": "Runs checked by the heartbeat.",
+}
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+
+class Operation(object):
+    """The state of an operation in progress. Counters are accumulated here, without locking,
+    and added to the totals when the operation ends.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.counters: Dict[str, int] = defaultdict(int)
+        self.phases: List[Tuple[str, float]] = []
+        self.context: dict = {}
+
+
+class Metrics(object):
+    """Timers and counters of the operations on versions and runs (e.g. version_create,
+    run_create, version_remove), which are exposed in the Prometheus text format by
+    GET /wt_versioning/metrics. The duration of each operation and of each of its phases (e.g.
+    same_tree, link) is recorded in histograms, and the files visited, links made and bytes
+    copied by the operation in counters.
+
+    The current operation is tracked per thread, so that phases and counters are recorded by
+    the code doing the work without passing it around. Outside of an operation, they are not
+    recorded. The metrics are those of the current Girder process.
+
+    Operations taking longer than wtversioning.slow_operation_ms are logged, with their
+    phases, counters and context (see annotate), e.g. the tale they operated on.
+    """
+
+    def __new__(cls):
+        if not hasattr(cls, "instance"):
+            cls.instance = super(Metrics, cls).__new__(cls)
+            cls.instance._lock = threading.Lock()
+            cls.instance._local = threading.local()
+            cls.instance.reset()
+        return cls.instance
+
+    def reset(self) -> None:
+        with self._lock:
+            self._operations: Dict[str, Histogram] = defaultdict(Histogram)
+            self._phases: Dict[Tuple[str, str], Histogram] = defaultdict(Histogram)
+            self._counters: Dict[Tuple[str, str], int] = defaultdict(int)
+
+    def _stack(self) -> List[Operation]:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def current(self) -> Optional[Operation]:
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def operation(self, name: str) -> Iterator[Operation]:
+        """Records the duration of an operation. Nested operations are recorded separately,
+        except when they have the same name as the enclosing one.
+        """
+        stack = self._stack()
+        if stack and stack[-1].name == name:
+            yield stack[-1]
+            return
+        op = Operation(name)
+        stack.append(op)
+        start = time.perf_counter()
+        failed = False
+        try:
+            yield op
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            with self._lock:
+                self._operations[name].observe(elapsed)
+                for phase, duration in op.phases:
+                    self._phases[(name, phase)].observe(duration)
+                for counter, value in op.counters.items():
+                    self._counters[(name, counter)] += value
+            self._logIfSlow(op, elapsed, failed)
+
+    @staticmethod
+    def _logIfSlow(op: Operation, elapsed: float, failed: bool) -> None:
+        threshold = Setting().get(PluginSettings.SLOW_OPERATION_MS)
+        if not threshold or elapsed * 1000 < threshold:
+            return
+        phases = defaultdict(float)
+        for phase, duration in op.phases:
+            phases[phase] += duration
+        record = dict(
+            op.context,
+            operation=op.name,
+            duration=round(elapsed, 3),
+            failed=failed,
+            counters=dict(op.counters),
+            phases={k: round(v, 3) for k, v in phases.items()},
+            lockWait=round(phases["admission"] + phases["lock"], 3),
+        )
+        logger.warning("Slow versioning operation: %s", json.dumps(record, default=str))
+
+    def annotate(self, **kwargs) -> None:
+        """Adds context to the current operation, which is logged if it is slow."""
+        op = self.current()
+        if op is not None:
+            op.context.update(kwargs)
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        op = self.current()
+        if op is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            op.phases.append((name, time.perf_counter() - start))
+
+    def observePhase(self, name: str, duration: float) -> None:
+        op = self.current()
+        if op is not None:
+            op.phases.append((name, duration))
+
+    def count(self, counter: str, n: int = 1) -> None:
+        stack = getattr(self._local, "stack", None)
+        if stack:
+            stack[-1].counters[counter] += n
+
+    def render(self) -> str:
+        """Returns the metrics in the Prometheus text exposition format."""
+        with self._lock:
+            operations = {k: (list(v.counts), v.sum) for k, v in self._operations.items()}
+            phases = {k: (list(v.counts), v.sum) for k, v in self._phases.items()}
+            counters = dict(self._counters)
+
+        lines = []
+        metric = f"{PREFIX}_operation_duration_seconds"
+        lines += [
+            f"# HELP {metric} Duration of the operations on versions and runs.",
+            f"# TYPE {metric} histogram",
+        ]
+        for name in sorted(operations):
+            lines += self._histogram(metric, {"operation": name}, *operations[name])
+        metric = f"{PREFIX}_phase_duration_seconds"
+        lines += [
+            f"# HELP {metric} Duration of the phases of the operations on versions and runs.",
+            f"# TYPE {metric} histogram",
+        ]
+        for name, phase in sorted(phases):
+            lines += self._histogram(
+                metric, {"operation": name, "phase": phase}, *phases[(name, phase)]
+            )
+        for counter, description in COUNTERS.items():
+            metric = f"{PREFIX}_{counter}_total"
+            lines += [f"# HELP {metric} {description}", f"# TYPE {metric} counter"]
+            for name, value in sorted(
+                (name, value) for (name, c), value in counters.items() if c == counter
+            ):
+                lines.append(f'{metric}{{operation="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _histogram(metric: str, labels: dict, counts: List[int], total: float) -> List[str]:
+        labelStr = ",".join(f'{k}="{v}"' for k, v in labels.items())
+        lines = []
+        cumulative = 0
+        for bound, count in zip(BUCKETS + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f'{metric}_bucket{{{labelStr},le="{le}"}} {cumulative}')
+        lines.append(f"{metric}_sum{{{labelStr}}} {total}")
+        lines.append(f"{metric}_count{{{labelStr}}} {cumulative}")
+        return lines
+
+
+def timedOperation(name: str):
+    """Decorator recording the calls of a function as an operation (see Metrics)."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Metrics().operation(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,97 @@
+import copy
+import hashlib
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+OBJECTS_DIR = ".objects"
+
+
+class DocumentStore(object):
+    """Stores the documents of the versions of a tale that rarely change between versions, such
+    as environment.json, once per distinct content. Each document is kept in the versions
+    directory of the tale as .objects/<sha256>.json and the file in the version directory is a
+    hard link to it, so that anything reading the version directory directly (archives, runs,
+    copies) is unaffected. The digest is stored in the version folder, which allows readers to
+    share parsed documents through an in-memory cache.
+
+    Objects are never modified in place. Those that are no longer linked from any version,
+    including the versions in the trash, are deleted by collectGarbage.
+    """
+
+    max_size = 256
+
+    def __new__(cls):
+        if not hasattr(cls, "instance"):
+            cls.instance = super(DocumentStore, cls).__new__(cls)
+            cls.instance._cache = OrderedDict()
+            cls.instance._lock = threading.Lock()
+        return cls.instance
+
+    @staticmethod
+    def _objectPath(versionsDir: Path, digest: str) -> Path:
+        return versionsDir / OBJECTS_DIR / f"{digest}.json"
+
+    def write(self, versionsDir: Path, content: str, target: Path) -> str:
+        """Stores content, if not already stored, links it to target and returns its digest."""
+        data = content.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._objectPath(versionsDir, digest)
+        if not path.is_file():
+            path.parent.mkdir(exist_ok=True)
+            tmp = path.with_name(f"{digest}.{uuid.uuid4().hex}")
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+        os.link(path, target)
+        return digest
+
+    def adopt(self, versionsDir: Path, target: Path) -> str:
+        """Replaces an existing file with a link to the stored object with the same content, or
+        makes it the stored object. Returns its digest.
+        """
+        digest = hashlib.sha256(target.read_bytes()).hexdigest()
+        path = self._objectPath(versionsDir, digest)
+        path.parent.mkdir(exist_ok=True)
+        try:
+            os.link(target, path)
+        except FileExistsError:
+            tmp = target.with_name(f".{target.name}.{uuid.uuid4().hex}")
+            os.link(path, tmp)
+            os.replace(tmp, target)
+        return digest
+
+    def load(self, path: Path, digest: str = None) -> dict:
+        """Returns the parsed document stored in path. If the digest of its content is known,
+        the parsed document is cached.
+        """
+        if digest is None:
+            with open(path, "r") as fp:
+                return json.load(fp)
+        with self._lock:
+            doc = self._cache.get(digest)
+            if doc is not None:
+                self._cache.move_to_end(digest)
+        if doc is None:
+            with open(path, "r") as fp:
+                doc = json.load(fp)
+            with self._lock:
+                self._cache[digest] = doc
+                while len(self._cache) > self.max_size:
+                    self._cache.popitem(last=False)
+        # callers are free to modify the document
+        return copy.deepcopy(doc)
+
+    def collectGarbage(self, versionsDir: Path) -> int:
+        """Deletes the objects that are not linked from any version. Returns their number."""
+        objectsDir = versionsDir / OBJECTS_DIR
+        if not objectsDir.is_dir():
+            return 0
+        count = 0
+        for path in objectsDir.iterdir():
+            if path.stat().st_nlink == 1:
+                path.unlink()
+                count += 1
+        return count
@@ -0,0 +1,109 @@
+import cProfile
+import os
+import re
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from girder import logger
+from girder.models.setting import Setting
+from pymongo import ReturnDocument
+
+from ..constants import PluginSettings
+
+
+class RequestProfiler(object):
+    """Profiles the next wtversioning.profile_requests calls to the version and run endpoints
+    with cProfile. Each profiled call decrements the setting, atomically, so that the calls are
+    shared by all Girder processes. The profiles are written to wtversioning.profile_dir, from
+    where they can be downloaded with GET /wt_versioning/profile/{name}.
+
+    When profiling is disabled, which is the normal case, a request only costs a comparison:
+    the setting is reread at most every refresh_interval seconds, or when it is saved by the
+    current process.
+    """
+
+    refresh_interval = 10.0
+
+    def __new__(cls):
+        if not hasattr(cls, "instance"):
+            cls.instance = super(RequestProfiler, cls).__new__(cls)
+            cls.instance.remaining = 0
+            cls.instance._nextRefresh = 0.0
+        return cls.instance
+
+    def settingSaved(self, event) -> None:
+        if event.info.get("key") == PluginSettings.PROFILE_REQUESTS:
+            self.remaining = event.info["value"]
+            self._nextRefresh = time.monotonic() + self.refresh_interval
+
+    def enabled(self) -> bool:
+        now = time.monotonic()
+        if now >= self._nextRefresh:
+            self._nextRefresh = now + self.refresh_interval
+            self.remaining = Setting().get(PluginSettings.PROFILE_REQUESTS)
+        return self.remaining > 0
+
+    def _take(self) -> bool:
+        setting = Setting().collection.find_one_and_update(
+            {"key": PluginSettings.PROFILE_REQUESTS, "value": {"$gt": 0}},
+            {"$inc": {"value": -1}},
+            return_document=ReturnDocument.AFTER,
+        )
+        self.remaining = 0 if setting is None else setting["value"]
+        return setting is not None
+
+    def call(self, label: str, func: Callable):
+        """Returns func(), profiled if profiling is enabled and calls are left."""
+        if not self.enabled() or not self._take():
+            return func()
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return func()
+        finally:
+            profile.disable()
+            self._dump(profile, label)
+
+    def _dump(self, profile: cProfile.Profile, label: str) -> None:
+        profileDir = self.directory()
+        name = "{}-{}-{}.prof".format(
+            datetime.utcnow().strftime("%Y%m%dT%H%M%S.%f"),
+            os.getpid(),
+            re.sub(r"[^A-Za-z0-9]+", "_", label).strip("_"),
+        )
+        try:
+            profileDir.mkdir(parents=True, exist_ok=True)
+            profile.dump_stats((profileDir / name).as_posix())
+        except OSError:
+            logger.exception("Could not write the profile of %s", label)
+            return
+        logger.info("Profile of %s written to %s", label, name)
+
+    @staticmethod
+    def directory() -> Path:
+        return Path(Setting().get(PluginSettings.PROFILE_DIR))
+
+    def list(self) -> List[dict]:
+        profileDir = self.directory()
+        if not profileDir.is_dir():
+            return []
+        profiles = []
+        for path in profileDir.glob("*.prof"):
+            stat = path.stat()
+            profiles.append(
+                {
+                    "name": path.name,
+                    "size": stat.st_size,
+                    "created": datetime.utcfromtimestamp(stat.st_mtime),
+                }
+            )
+        return sorted(profiles, key=lambda _: _["name"], reverse=True)
+
+    def path(self, name: str) -> Optional[Path]:
+        """Returns the path of a profile, or None if there is no such profile."""
+        if "/" in name or not name.endswith(".prof"):
+            return None
+        path = self.directory() / name
+        return path if path.is_file() else None
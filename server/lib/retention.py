@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional, Set
+
+from bson import ObjectId
+from girder.models.setting import Setting
+
+from ..constants import PluginSettings
+
+
+class RetentionPolicy(object):
+    """Decides which versions of a tale are kept. The newest keepLast versions are kept, as
+    well as the newest version of each of the last keepDaily days. A policy with both values
+    set to zero keeps everything. The newest version is always kept since it is the baseline
+    against which the next version is created.
+    """
+
+    def __init__(self, keepLast: int = 0, keepDaily: int = 0):
+        self.keepLast = keepLast
+        self.keepDaily = keepDaily
+
+    @classmethod
+    def fromSettings(cls) -> "RetentionPolicy":
+        return cls(
+            keepLast=Setting().get(PluginSettings.RETENTION_KEEP_LAST),
+            keepDaily=Setting().get(PluginSettings.RETENTION_KEEP_DAILY),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.keepLast or self.keepDaily)
+
+    def selectExpired(
+        self,
+        versions: Iterable[dict],
+        protected: Set[ObjectId],
+        now: Optional[datetime] = None,
+    ) -> List[dict]:
+        """Returns the versions not retained by the policy. The versions must be sorted from
+        the newest to the oldest. Versions whose ids are in protected are never returned.
+        """
+        if not self.enabled:
+            return []
+        horizon = (now or datetime.utcnow()) - timedelta(days=self.keepDaily)
+        days = set()
+        expired = []
+        for i, version in enumerate(versions):
+            keep = i < max(self.keepLast, 1) or version["_id"] in protected
+            day = version["created"].date()
+            if self.keepDaily and version["created"] >= horizon and day not in days:
+                days.add(day)
+                keep = True
+            if not keep:
+                expired.append(version)
+        return expired
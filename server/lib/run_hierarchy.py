@@ -1,9 +1,13 @@
 import shutil
+import uuid
+from collections import Counter
 from pathlib import Path
-from typing import Optional, Union
+from typing import List, Optional, Union
 
+import pymongo
 from girder.constants import AccessType
 from girder.models.folder import Folder
+from girder.models.setting import Setting
 from girder.models.user import User
 from girder.models.token import Token
 from girder.plugins.jobs.models.job import Job
@@ -12,13 +16,24 @@ from girder.plugins.wholetale.models.tale import Tale
 from gwvolman.tasks import check_on_run, cleanup_run
 
 from . import util
+from .accounting import StorageAccounting
+from .coalesce import TimestampCoalescer
 from .hierarchy import AbstractHierarchyModel
+from .metrics import Metrics, timedOperation
+from .scheduler import TreeOperationScheduler
 from .version_hierarchy import VersionHierarchyModel
-from ..constants import FIELD_STATUS_CODE, RunStatus, RunState
+from ..constants import (
+    FIELD_RUN_STATS, FIELD_STATUS_CODE, FIELD_WORKSPACE_MATERIALIZED, PluginSettings,
+    RunStatus, RunState
+)
+
+
+FINAL_RUN_STATES = (RunStatus.COMPLETED, RunStatus.FAILED, RunStatus.CANCELLED)
 
 
 class RunHierarchyModel(AbstractHierarchyModel):
     root_tale_field = "runsRootId"
+    usage_kind = "runs"
 
     def getStatus(self, rfolder: dict) -> dict:
         if FIELD_STATUS_CODE in rfolder:
@@ -35,35 +50,59 @@ class RunHierarchyModel(AbstractHierarchyModel):
         else:
             _status = status
         rfolder[FIELD_STATUS_CODE] = _status.code
+        if _status in FINAL_RUN_STATES:
+            self.recordUsage(rfolder)
         Folder().save(rfolder)
         runDir = Path(rfolder["fsPath"])
         self.write_status(runDir, _status)
 
+    @timedOperation("run_create")
     def create(
-        self, version: dict, name: Optional[str], user: dict, allowRename: bool = False
+        self,
+        version: dict,
+        name: Optional[str],
+        user: dict,
+        allowRename: bool = False,
+        deferred: Optional[bool] = None,
     ) -> dict:
         if not name:
             name = self.generateName()
+        if deferred is None:
+            deferred = Setting().get(PluginSettings.DEFERRED_RUN_WORKSPACE)
+        VersionHierarchyModel().checkReady(version)
 
         versionsRoot = Folder().load(
             version["parentId"], user=user, level=AccessType.WRITE
         )
         taleId = versionsRoot["taleId"]
+        Metrics().annotate(taleId=taleId, versionId=version["_id"], deferred=deferred)
         tale = Tale().load(taleId, user=user, level=AccessType.WRITE)
         root = self.getRootFromTale(tale, user=user, level=AccessType.WRITE)
         name = self.checkNameSanity(name, root, allow_rename=allowRename)
 
         rootDir = util.getTaleRunsDirPath(tale)
 
-        runFolder = self.createSubdir(rootDir, root, name, user=user)
-
-        runFolder["runVersionId"] = version["_id"]
-        runFolder[FIELD_STATUS_CODE] = RunStatus.UNKNOWN.code
-        Folder().save(runFolder, False)
+        versionModel = VersionHierarchyModel()
+        with Metrics().phase("create_subdir"):
+            # The run is inserted with the reference from its version in a single bulk write
+            runFolder = self.createSubdir(
+                rootDir,
+                root,
+                name,
+                user=user,
+                fields={
+                    "runVersionId": version["_id"],
+                    FIELD_STATUS_CODE: RunStatus.UNKNOWN.code,
+                    FIELD_WORKSPACE_MATERIALIZED: not deferred,
+                },
+                updates=[
+                    pymongo.UpdateOne({"_id": version["_id"]}, versionModel.referenceCountUpdate(1))
+                ],
+            )
 
         # Structure is:
         #  @version -> ../Versions/<version> (link handled manually by FS)
-        #  @workspace -> version/workspace (same)
+        #  workspace (links to the files of the version, or empty and read-only if deferred)
         #  .status
         #  .stdout (created using stream() above)
         #  .stderr (-''-)
@@ -73,22 +112,75 @@ class RunHierarchyModel(AbstractHierarchyModel):
         (runDir / "version").symlink_to(
             f"../../../../versions/{tale_id[:2]}/{tale_id}/{version['_id']}", True
         )
-        (runDir / "workspace").mkdir()
-        self.snapshotRecursive(
-            None, (runDir / "version" / "workspace"), (runDir / "workspace")
-        )
+        if deferred:
+            # Until the run is started, its workspace is an empty placeholder: nothing written
+            # through it can reach the files of the version, which are read from version/
+            (runDir / "workspace").mkdir(mode=0o555)
+        else:
+            (runDir / "workspace").mkdir()
+            with TreeOperationScheduler().admit("run_create"), Metrics().phase("link"):
+                self.snapshotRecursive(
+                    None, (runDir / "version" / "workspace"), (runDir / "workspace")
+                )
         self.write_status(runDir, RunStatus.UNKNOWN)
 
-        Tale().updateTale(tale)
-        VersionHierarchyModel().incrementReferenceCount(version)
+        TimestampCoalescer().touchTale(tale["_id"])
 
         return runFolder
 
+    def materializeWorkspace(self, rfolder: dict) -> dict:
+        """Replaces the placeholder workspace of a run created with a deferred workspace with
+        links to the files of its version. This is the work done by create for other runs,
+        deferred until the run is started: runs that are never started do not pay for it, the
+        others pay for it in full.
+        """
+        if rfolder.get(FIELD_WORKSPACE_MATERIALIZED, True):
+            return rfolder
+        runDir = Path(rfolder["fsPath"])
+        tmp = runDir / f".workspace.{uuid.uuid4().hex}"
+        tmp.mkdir()
+        with TreeOperationScheduler().admit("run_materialize"), Metrics().phase("link"):
+            self.snapshotRecursive(None, runDir / "version" / "workspace", tmp)
+        workspace = runDir / "workspace"
+        try:
+            if workspace.is_symlink():
+                # Deferred runs used to link to the version workspace
+                workspace.unlink()
+            # A directory atomically replaces an empty one
+            tmp.rename(workspace)
+        except OSError:
+            # Materialized concurrently
+            shutil.rmtree(tmp, ignore_errors=True)
+        Folder().update(
+            {"_id": rfolder["_id"]},
+            {"$set": {FIELD_WORKSPACE_MATERIALIZED: True}},
+            multi=False,
+        )
+        rfolder[FIELD_WORKSPACE_MATERIALIZED] = True
+        return rfolder
+
     @staticmethod
     def write_status(runDir: Path, status: RunState):
         with open(runDir / ".status", "w") as f:
             f.write("%s %s" % (status.code, status.name))
 
+    def recordUsage(self, rfolder: dict) -> dict:
+        """Computes the size of the files written by a run, i.e., the files of the run directory
+        which are not links to the files of its version, and updates the storage usage of the
+        tale runs accordingly. The caller is responsible for saving the run folder.
+        """
+        runDir = Path(rfolder["fsPath"])
+        accounting = StorageAccounting()
+        size = accounting.newSize(runDir / "workspace", runDir / "version" / "workspace")
+        size += sum(
+            _.stat().st_size for _ in runDir.iterdir() if _.is_file() and not _.is_symlink()
+        )
+        previous = rfolder.get(FIELD_RUN_STATS, {}).get("newSize", 0)
+        rfolder[FIELD_RUN_STATS] = {"newSize": size}
+        accounting.addUsage(rfolder["parentId"], self.usage_kind, size=size - previous)
+        return rfolder
+
+    @timedOperation("run_remove")
     def remove(self, rfolder: dict, user: dict) -> None:
         path = Path(rfolder["fsPath"])
         trashDir = path.parent / ".trash"
@@ -98,7 +190,24 @@ class RunHierarchyModel(AbstractHierarchyModel):
         Folder().remove(rfolder)
         shutil.move(path.as_posix(), trashDir)
         VersionHierarchyModel().decrementReferenceCount(version)
-
+        self.recordRemoval(rfolder)
+
+    @timedOperation("run_remove")
+    def removeBatch(self, root: dict, folders: List[dict]) -> List[dict]:
+        removed = super().removeBatch(root, folders)
+        # one reference count update per version, however many of its runs were removed
+        versionModel = VersionHierarchyModel()
+        for versionId, n in Counter(_["runVersionId"] for _ in removed).items():
+            version = Folder().load(versionId, force=True)
+            if version is not None:
+                versionModel.updateReferenceCount(version, -n)
+        return removed
+
+    def recordRemoval(self, rfolder: dict) -> None:
+        size = rfolder.get(FIELD_RUN_STATS, {}).get("newSize", 0)
+        StorageAccounting().addUsage(rfolder["parentId"], self.usage_kind, -size, size)
+
+    @timedOperation("run_heartbeat")
     def run_heartbeat(self, event):
         celery_inspector = getCeleryApp().control.inspect()
         try:
@@ -111,7 +220,9 @@ class RunHierarchyModel(AbstractHierarchyModel):
                 "meta.container_name": {"$exists": True}
             }
         )
+        metrics = Metrics()
         for run in active_runs:
+            metrics.count("runs")
             queue = f"celery@{run['meta']['node_id']}"
             if queue not in active_queues:
                 if run[FIELD_STATUS_CODE] == RunStatus.RUNNING.code:
@@ -0,0 +1,114 @@
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+from girder.models.setting import Setting
+
+from .metrics import Metrics
+from ..constants import PluginSettings
+
+
+class Priority:
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+
+class Ticket(object):
+    """Represents an admitted tree operation. Operations report the number of files they
+    process through tick(), which throttles them to their share of the files/sec budget.
+    """
+
+    # Maximum amount of unused budget (in seconds) an operation can accumulate
+    max_burst = 1.0
+
+    def __init__(self, scheduler, name: str, priority: int, rate: int):
+        self.scheduler = scheduler
+        self.name = name
+        self.priority = priority
+        self.rate = rate
+        self.files = 0
+        self._next = time.monotonic()
+
+    def tick(self, n: int = 1) -> None:
+        self.files += n
+        if not self.rate:
+            return
+        share = self.rate / max(self.scheduler.running, 1)
+        now = time.monotonic()
+        self._next = max(self._next, now - self.max_burst) + n / share
+        delay = self._next - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class TreeOperationScheduler(object):
+    """Node-wide admission control for operations that walk or link entire directory trees,
+    i.e. version snapshots, restores, run creation and tale copies. At most
+    wtversioning.max_tree_operations of them run at the same time and waiting interactive
+    operations are admitted before background ones. Additionally, the
+    wtversioning.tree_files_per_second budget is shared equally by the running operations, so
+    that a single huge tale cannot starve the others.
+
+    The scheduler only sees the operations of the current Girder process.
+    """
+
+    def __new__(cls):
+        if not hasattr(cls, "instance"):
+            cls.instance = super(TreeOperationScheduler, cls).__new__(cls)
+            cls.instance._cond = threading.Condition()
+            cls.instance._waiting = []
+            cls.instance._counter = itertools.count()
+            cls.instance._local = threading.local()
+            cls.instance.running = 0
+        return cls.instance
+
+    @contextmanager
+    def admit(self, name: str, priority: int = None):
+        current = getattr(self._local, "ticket", None)
+        if current is not None:
+            # Nested operation, e.g. a restore done as part of a copy. It has been admitted
+            # already.
+            yield current
+            return
+
+        if priority is None:
+            priority = getattr(self._local, "priority", Priority.INTERACTIVE)
+        limit = Setting().get(PluginSettings.MAX_TREE_OPERATIONS)
+        ticket = Ticket(self, name, priority, Setting().get(PluginSettings.TREE_FILES_PER_SECOND))
+        entry = (priority, next(self._counter), ticket)
+        start = time.perf_counter()
+        with self._cond:
+            heapq.heappush(self._waiting, entry)
+            while self._waiting[0] is not entry or (limit and self.running >= limit):
+                self._cond.wait()
+            heapq.heappop(self._waiting)
+            self.running += 1
+            # let the next waiting operation check whether it can go as well
+            self._cond.notify_all()
+        Metrics().observePhase("admission", time.perf_counter() - start)
+
+        self._local.ticket = ticket
+        try:
+            yield ticket
+        finally:
+            self._local.ticket = None
+            with self._cond:
+                self.running -= 1
+                self._cond.notify_all()
+
+    @contextmanager
+    def background(self):
+        """Operations admitted within this context have background priority."""
+        previous = getattr(self._local, "priority", Priority.INTERACTIVE)
+        self._local.priority = Priority.BACKGROUND
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    def tick(self, n: int = 1) -> None:
+        ticket = getattr(self._local, "ticket", None)
+        if ticket is not None:
+            ticket.tick(n)
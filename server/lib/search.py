@@ -0,0 +1,197 @@
+import bisect
+import fnmatch
+from typing import Iterator, List, Optional
+
+import pymongo
+from bson import ObjectId
+from girder.models.folder import Folder
+from girder.models.model_base import Model
+from pymongo import ReturnDocument
+
+from .index import VersionIndex
+from ..constants import FIELD_SEARCH_SEQ
+
+CHUNK_SIZE = 1000
+# The maximum length of the regular expressions searches are made with
+MAX_REGEX_LENGTH = 256
+
+
+def _chunks(items: list) -> Iterator[list]:
+    for i in range(0, len(items), CHUNK_SIZE):
+        yield items[i:i + CHUNK_SIZE]
+
+
+class VersionFile(Model):
+    """Index of the files of all the versions of a tale, used to search them. Versions are
+    numbered, in the order they are indexed, by the searchSeq field of the version folders.
+    Each document describes a workspace entry (a path and inode) and the range of version
+    numbers, [from, to], in which it is present. Since consecutive versions share most of
+    their files, adding a version extends the range of the entries it shares with the previous
+    one with a single query and only the entries that changed are inserted or updated. When a
+    version is removed, the entries left without a version are dropped, so that searches can
+    be paged by the database.
+    """
+
+    def initialize(self):
+        self.name = "wt_version_file"
+        self.ensureIndices(
+            [
+                ([("rootId", 1), ("to", 1)], {}),
+                ([("rootId", 1), ("name", 1)], {}),
+                ([("rootId", 1), ("size", 1)], {}),
+                ([("rootId", 1), ("mtime", 1)], {}),
+                ([("rootId", 1), ("path", 1), ("from", 1)], {}),
+            ]
+        )
+
+    def validate(self, doc):
+        return doc
+
+    @staticmethod
+    def _identity(entry: dict) -> tuple:
+        # Directories are created anew in each version, only files keep their inode
+        return entry["type"], None if entry["type"] == "directory" else entry["ino"]
+
+    def addVersion(self, version: dict, unchanged: bool = False) -> dict:
+        """Indexes a version that was just created. Sets and returns its searchSeq, the caller
+        is responsible for saving the version folder. If unchanged is set, the workspace is known
+        to be the same as the one of the previous version.
+        """
+        root = Folder().collection.find_one_and_update(
+            {"_id": version["parentId"]},
+            {"$inc": {FIELD_SEARCH_SEQ: 1}},
+            projection=[FIELD_SEARCH_SEQ],
+            return_document=ReturnDocument.AFTER,
+        )
+        rootId, n = root["_id"], root[FIELD_SEARCH_SEQ]
+        # Set first, so that the entries of a version that failed to be indexed can be dropped
+        version[FIELD_SEARCH_SEQ] = n
+        if unchanged:
+            self.collection.update_many({"rootId": rootId, "to": n - 1}, {"$set": {"to": n}})
+            return version
+        previous = {
+            _["path"]: self._identity(_)
+            for _ in self.find({"rootId": rootId, "to": n - 1}, fields=["path", "type", "ino"])
+        }
+
+        added = []
+        changed = []
+        for entry in VersionIndex(version).entries():
+            identity = previous.pop(entry["path"], None)
+            if identity == self._identity(entry):
+                continue
+            if identity is not None:
+                changed.append(entry["path"])
+            entry.update({"rootId": rootId, "from": n, "to": n})
+            added.append(entry)
+        changed.extend(previous)  # removed
+
+        self.collection.update_many({"rootId": rootId, "to": n - 1}, {"$set": {"to": n}})
+        for paths in _chunks(changed):
+            self.collection.update_many(
+                {"rootId": rootId, "to": n, "from": {"$lt": n}, "path": {"$in": paths}},
+                {"$set": {"to": n - 1}},
+            )
+        for docs in _chunks(added):
+            self.collection.insert_many(docs)
+        return version
+
+    def dropVersion(self, version: dict) -> None:
+        """Drops the entries that are no longer present in any version after a version was
+        removed, i.e. those in between the versions before and after it. The entries of the
+        newest version are kept, since the next version is indexed against them.
+        """
+        n = version.get(FIELD_SEARCH_SEQ)
+        if n is None:
+            return
+        rootId = version["parentId"]
+        root = Folder().load(rootId, force=True, fields=[FIELD_SEARCH_SEQ])
+        if root is None:
+            return
+
+        def neighbor(op: str, order: int) -> Optional[int]:
+            folder = Folder().findOne(
+                {"parentId": rootId, FIELD_SEARCH_SEQ: {op: n}},
+                fields=[FIELD_SEARCH_SEQ],
+                sort=[(FIELD_SEARCH_SEQ, order)],
+            )
+            return None if folder is None else folder[FIELD_SEARCH_SEQ]
+
+        previous = neighbor("$lt", pymongo.DESCENDING) or 0
+        following = neighbor("$gt", pymongo.ASCENDING) or root[FIELD_SEARCH_SEQ]
+        self.removeWithQuery(
+            {"rootId": rootId, "from": {"$gt": previous}, "to": {"$lt": following}}
+        )
+
+    def dropRoot(self, rootId: ObjectId) -> None:
+        self.removeWithQuery({"rootId": rootId})
+
+    def search(
+        self,
+        root: dict,
+        name: Optional[str] = None,
+        regex: Optional[str] = None,
+        minSize: Optional[int] = None,
+        maxSize: Optional[int] = None,
+        modifiedAfter: Optional[int] = None,
+        modifiedBefore: Optional[int] = None,
+        limit: int = 100,
+        offset: int = 0,
+    ) -> List[dict]:
+        """Returns the workspace entries matching the criteria, with the versions that contain
+        them. name is a glob matched against file names and regex is matched against whole
+        paths.
+        """
+        query = {"rootId": root["_id"]}
+        if name:
+            query["name"] = {"$regex": fnmatch.translate(name)}
+        if regex:
+            query["path"] = {"$regex": "^(?:%s)$" % regex}
+        for field, low, high in (
+            ("size", minSize, maxSize),
+            ("mtime", modifiedAfter, modifiedBefore),
+        ):
+            if low is not None or high is not None:
+                query[field] = {}
+                if low is not None:
+                    query[field]["$gte"] = low
+                if high is not None:
+                    query[field]["$lte"] = high
+
+        versions = list(
+            Folder().find(
+                {"parentId": root["_id"], FIELD_SEARCH_SEQ: {"$exists": True}},
+                fields=["name", FIELD_SEARCH_SEQ],
+                sort=[(FIELD_SEARCH_SEQ, pymongo.ASCENDING)],
+            )
+        )
+        if not versions:
+            return []
+        seqs = [_[FIELD_SEARCH_SEQ] for _ in versions]
+        # The entries of a removed newest version are kept until the next version is indexed
+        query["from"] = {"$lte": seqs[-1]}
+
+        results = []
+        cursor = self.find(
+            query,
+            sort=[("path", pymongo.ASCENDING), ("from", pymongo.ASCENDING)],
+            offset=offset,
+            limit=limit,
+        )
+        for doc in cursor:
+            lo = bisect.bisect_left(seqs, doc["from"])
+            hi = bisect.bisect_right(seqs, doc["to"])
+            if lo == hi:
+                continue  # only in versions removed before they were dropped from the index
+            results.append(
+                {
+                    "path": doc["path"],
+                    "type": doc["type"],
+                    "size": doc["size"],
+                    "mtime": doc["mtime"],
+                    "versions": [
+                        {"_id": _["_id"], "name": _["name"]} for _ in versions[lo:hi]
+                    ],
+                }
+            )
+        return results
@@ -1,23 +1,51 @@
 from bson import ObjectId
 import json
+import os
 import shutil
+import time
+import uuid
 from pathlib import Path
 import pymongo
-from typing import Optional
+from typing import Iterator, List, Optional
 
 from girder import logger
 from girder.constants import AccessType
 from girder.exceptions import RestException
 from girder.models.folder import Folder
+from girder.models.setting import Setting
+from girder.models.user import User
+from girder.plugins.jobs.models.job import Job
+from girder.plugins.wholetale.lib.manifest import Manifest
 from girder.plugins.wholetale.models.tale import Tale
+from girder.plugins.wholetale.utils import init_progress
+from .accounting import StorageAccounting
+from .diff import VersionDiff
+from .search import VersionFile
 from .hierarchy import AbstractHierarchyModel
+from .metrics import Metrics, timedOperation
+from .objects import DocumentStore
+from .retention import RetentionPolicy
+from .scheduler import TreeOperationScheduler
+from ..constants import (
+    CREATE_VERSION_STEP_TOTAL, FIELD_ENVIRONMENT_DIGEST, FIELD_LATEST_VERSION_ID,
+    FIELD_MANIFEST_STALE,
+    FIELD_VERSION_COUNT, FIELD_VERSION_STATS, FIELD_VERSION_STATUS_CODE,
+    FIELD_WORKSPACE_VERSION_ID, PluginSettings, VersionState,
+    VersionStatus
+)
 
 
 class VersionHierarchyModel(AbstractHierarchyModel):
     root_tale_field = "versionsRootId"
     field_critical_section_flag = "versionsCriticalSectionFlag"
     field_reference_counter = "versionsRefCount"
+    usage_kind = "versions"
+    # The fields needed to restore a tale from a version, see restoreTaleFromVersion
+    manifest_fields = [
+        "name", "parentId", "fsPath", FIELD_ENVIRONMENT_DIGEST, FIELD_MANIFEST_STALE
+    ]
 
+    @timedOperation("version_create")
     def create(
         self,
         tale: dict,
@@ -27,7 +55,92 @@ class VersionHierarchyModel(AbstractHierarchyModel):
         user=None,
         force=False,
     ) -> dict:
-        last = self.getLastVersion(versionsRoot)
+        metrics = Metrics()
+        metrics.annotate(taleId=tale["_id"], notModified=False)
+        with TreeOperationScheduler().admit("version_create"):
+            last = self.getLastVersion(versionsRoot)
+            if not force:
+                with metrics.phase("check_modified"):
+                    self.checkModified(tale, last, user)
+
+            with metrics.phase("create_subdir"):
+                new_version = self.createSubdir(versionsDir, versionsRoot, name, user=user)
+
+            try:
+                with metrics.phase("snapshot"):
+                    self.snapshot(last, tale, new_version, user=user, force=force)
+                self.recordLatest(new_version)
+                return new_version
+            except Exception:  # NOQA
+                try:
+                    shutil.rmtree(new_version["fsPath"])
+                    Folder().remove(new_version)
+                except Exception as ex:  # NOQA
+                    logger.warning(
+                        "Exception caught while rolling back version ckeckpoint.", ex
+                    )
+                raise
+
+    def createAsync(
+        self,
+        tale: dict,
+        name: Optional[str],
+        versionsDir: Path,
+        versionsRoot: dict,
+        user=None,
+        force=False,
+    ) -> dict:
+        """Reserves a version folder in a pending state and schedules a job that takes the
+        snapshot (see tasks.create_version). The caller must hold the critical section of the
+        versions root, which is released by the job once it is done.
+        """
+        new_version = self.createSubdir(
+            versionsDir, versionsRoot, name, user=user,
+            fields={FIELD_VERSION_STATUS_CODE: VersionStatus.PENDING.code},
+        )
+
+        resource = {
+            "type": "wt_create_version",
+            "tale_id": tale["_id"],
+            "tale_title": tale["title"],
+            "version_id": new_version["_id"],
+        }
+        notification = init_progress(
+            resource, user, "Creating version", "Initializing", CREATE_VERSION_STEP_TOTAL
+        )
+        job = Job().createLocalJob(
+            title="Create version",
+            user=user,
+            type="wt_create_version",
+            public=False,
+            asynchronous=True,
+            module="girder.plugins.wt_versioning.tasks.create_version",
+            args=(str(tale["_id"]), str(new_version["_id"])),
+            kwargs={"force": force},
+            otherFields={"wt_notification_id": str(notification["_id"])},
+        )
+        new_version = Folder().setMetadata(new_version, {"jobId": str(job["_id"])})
+        Job().scheduleJob(job)
+        return new_version
+
+    def importVersions(self, tale: dict, archive: dict, user=None) -> dict:
+        """Schedules a job that imports the versions stored in a tar archive (a Girder file)
+        into the versions of a tale (see lib.importer). The caller must hold the critical section
+        of the versions root, which is released by the job once it is done.
+        """
+        job = Job().createLocalJob(
+            title="Import versions",
+            user=user,
+            type="wt_import_versions",
+            public=False,
+            asynchronous=True,
+            module="girder.plugins.wt_versioning.tasks.import_versions",
+            args=(str(tale["_id"]), str(archive["_id"])),
+        )
+        Job().scheduleJob(job)
+        return job
+
+    def checkModified(self, tale: dict, last: Optional[dict], user) -> None:
         last_restore = Folder().load(tale.get("restoredFrom", ObjectId()), force=True)
         workspace = Folder().load(tale["workspaceId"], force=True)
         crtWorkspace = Path(workspace["fsPath"])
@@ -38,44 +151,290 @@ class VersionHierarchyModel(AbstractHierarchyModel):
                 None if version is None else Path(version["fsPath"]) / "workspace"
             )
             if (
-                not force
-                and self.is_same(tale, version, user)
+                self.is_same(tale, version, user)
                 and self.sameTree(oldWorkspace, crtWorkspace)
             ):
                 assert version is not None
+                Metrics().annotate(notModified=True)
                 raise RestException("Not modified", code=303, extra=str(version["_id"]))
 
-        new_version = self.createSubdir(versionsDir, versionsRoot, name, user=user)
+    def getLastVersion(self, versionsFolder: dict) -> Optional[dict]:
+        """Returns the most recently created version that is ready, using the latestVersionId
+        pointer maintained on the versions root.
+        """
+        root = Folder().load(
+            versionsFolder["_id"], force=True, fields=[FIELD_LATEST_VERSION_ID]
+        )
+        if FIELD_LATEST_VERSION_ID not in root:
+            # Roots created before the pointer was maintained
+            return self.refreshLatest(root)
+        if root[FIELD_LATEST_VERSION_ID] is None:
+            return None
+        return Folder().load(root[FIELD_LATEST_VERSION_ID], force=True)
 
-        try:
-            self.snapshot(last, tale, new_version, user=user, force=force)
-            return new_version
-        except Exception:  # NOQA
-            try:
-                shutil.rmtree(new_version["fsPath"])
-                Folder().remove(new_version)
-            except Exception as ex:  # NOQA
-                logger.warning(
-                    "Exception caught while rolling back version ckeckpoint.", ex
-                )
-            raise
+    def recordLatest(self, version: dict) -> None:
+        """Makes a version that just became ready the latest one of its root. Versions are
+        created in the critical section of the root, so it is the most recent one.
+        """
+        root = Folder().load(version["parentId"], force=True, fields=[FIELD_LATEST_VERSION_ID])
+        if FIELD_LATEST_VERSION_ID not in root:
+            self.refreshLatest(root)
+            return
+        Folder().update(
+            {"_id": root["_id"]},
+            {
+                "$set": {FIELD_LATEST_VERSION_ID: version["_id"]},
+                "$inc": {FIELD_VERSION_COUNT: 1},
+            },
+            multi=False,
+        )
 
-    def getLastVersion(self, versionsFolder: dict) -> Optional[dict]:
-        # The versions root folder is kept as a pure Girder folder.
-        # This is because there is no efficient way to
-        # say "give me the latest subdir" on a POSIX filesystem.
-        return Folder().findOne(
-            {"parentId": versionsFolder["_id"]}, sort=[("created", pymongo.DESCENDING)]
+    def refreshLatest(self, versionsFolder: dict) -> Optional[dict]:
+        """Recomputes the latestVersionId and versionCount of a versions root from its
+        versions, e.g. after versions were removed, copied or imported. Returns the latest
+        version.
+        """
+        query = {
+            "parentId": versionsFolder["_id"],
+            FIELD_VERSION_STATUS_CODE: {
+                "$nin": [VersionStatus.PENDING.code, VersionStatus.FAILED.code]
+            },
+        }
+        latest = Folder().findOne(query, sort=[("created", pymongo.DESCENDING)])
+        Folder().update(
+            {"_id": versionsFolder["_id"]},
+            {
+                "$set": {
+                    FIELD_LATEST_VERSION_ID: None if latest is None else latest["_id"],
+                    FIELD_VERSION_COUNT: Folder().find(query).count(),
+                }
+            },
+            multi=False,
+        )
+        return latest
+
+    @timedOperation("version_remove")
+    def remove(self, version: dict, user: dict) -> None:
+        super().remove(version, user)
+        with Metrics().phase("accounting"):
+            self.recordRemoval(version)
+
+    @timedOperation("version_remove")
+    def removeBatch(self, root: dict, folders: List[dict]) -> List[dict]:
+        return super().removeBatch(root, folders)
+
+    def recordSnapshot(self, version: dict) -> None:
+        VersionFile().addVersion(version, unchanged=FIELD_WORKSPACE_VERSION_ID in version)
+
+    def recordRemoval(self, version: dict) -> None:
+        """Updates the storage usage after a version was moved to the trash. The files of the
+        removed version that are not shared with the previous one were counted by its
+        versionStats.newSize. Those of them that are shared with the next version are now new
+        with respect to the previous version, so the newSize of the next version is recomputed.
+        Cached data derived from the version is dropped as well.
+        """
+        self.recordLatestRemoval(version)
+        self.handOverWorkspace(version)
+        VersionDiff.dropCache(version)
+        VersionFile().dropVersion(version)
+        if FIELD_VERSION_STATS not in version:
+            return  # not accounted for, left to a rescan
+        delta = -version[FIELD_VERSION_STATS]["newSize"]
+        query = {"parentId": version["parentId"]}
+        prev = Folder().findOne(
+            dict(query, created={"$lt": version["created"]}),
+            sort=[("created", pymongo.DESCENDING)],
+        )
+        nxt = Folder().findOne(
+            dict(query, created={"$gt": version["created"]}),
+            sort=[("created", pymongo.ASCENDING)],
+        )
+        if nxt is not None and FIELD_VERSION_STATS in nxt:
+            newSize = StorageAccounting().newSize(
+                Path(nxt["fsPath"]) / "workspace",
+                None if prev is None else Path(prev["fsPath"]) / "workspace",
+            )
+            delta += newSize - nxt[FIELD_VERSION_STATS]["newSize"]
+            Folder().update(
+                {"_id": nxt["_id"]},
+                {"$set": {f"{FIELD_VERSION_STATS}.newSize": newSize}},
+                multi=False,
+            )
+        StorageAccounting().addUsage(version["parentId"], self.usage_kind, delta, -delta)
+
+    def recordLatestRemoval(self, version: dict) -> None:
+        if not self.isReady(version):
+            return  # not counted
+        root = Folder().load(version["parentId"], force=True, fields=[FIELD_LATEST_VERSION_ID])
+        if root.get(FIELD_LATEST_VERSION_ID, version["_id"]) == version["_id"]:
+            self.refreshLatest(root)
+        else:
+            Folder().update(
+                {"_id": root["_id"]}, {"$inc": {FIELD_VERSION_COUNT: -1}}, multi=False
+            )
+
+    def handOverWorkspace(self, version: dict) -> None:
+        """Called after a version was moved to the trash. If its workspace is shared with later
+        versions (see AbstractHierarchyModel.shareWorkspace), it is moved to the oldest of them,
+        which becomes its owner, and the links of the others are updated.
+        """
+        if FIELD_WORKSPACE_VERSION_ID in version:
+            return
+        sharing = list(
+            Folder().find(
+                {"parentId": version["parentId"], FIELD_WORKSPACE_VERSION_ID: version["_id"]},
+                fields=["fsPath"],
+                sort=[("created", pymongo.ASCENDING)],
+            )
+        )
+        if not sharing:
+            return
+        heir, others = sharing[0], sharing[1:]
+        path = Path(version["fsPath"])
+        heirWorkspace = Path(heir["fsPath"]) / "workspace"
+        heirWorkspace.unlink()
+        os.rename(path.parent / ".trash" / path.name / "workspace", heirWorkspace)
+        Folder().update(
+            {"_id": heir["_id"]}, {"$unset": {FIELD_WORKSPACE_VERSION_ID: ""}}, multi=False
+        )
+        for other in others:
+            link = Path(other["fsPath"]) / "workspace"
+            tmp = link.with_name(".workspace.tmp")
+            tmp.symlink_to(Path("..") / str(heir["_id"]) / "workspace", target_is_directory=True)
+            os.replace(tmp, link)
+        if others:
+            Folder().update(
+                {"_id": {"$in": [_["_id"] for _ in others]}},
+                {"$set": {FIELD_WORKSPACE_VERSION_ID: heir["_id"]}},
+            )
+
+    def prune(self, tale: dict, policy: Optional[RetentionPolicy] = None) -> List[dict]:
+        """Moves the versions of a tale that are not retained by the policy (by default, the
+        one configured in the settings) to the trash. Versions used by runs, versions that the
+        tale was restored from or published as, and versions that are not ready are kept.
+        Returns the removed versions.
+        """
+        if policy is None:
+            policy = RetentionPolicy.fromSettings()
+        if not policy.enabled:
+            return []
+        root = self.getRootFromTale(tale)
+        versions = list(
+            Folder().find(
+                {"parentId": root["_id"]},
+                fields=["created", FIELD_VERSION_STATUS_CODE, self.field_reference_counter],
+                sort=[("created", pymongo.DESCENDING)],
+            )
+        )
+        # Versions that are not ready are kept without taking the place of a ready one, so a
+        # failed newest version does not expire the last good one
+        versions = [_ for _ in versions if self.isReady(_)]
+        protected = {_["_id"] for _ in versions if _.get(self.field_reference_counter, 0) > 0}
+        protected.add(tale.get("restoredFrom"))
+        protected.update(
+            ObjectId(_["versionId"]) for _ in tale.get("publishInfo", []) if _.get("versionId")
+        )
+        expired = policy.selectExpired(versions, protected)
+        return self.removeBatch(root, expired)
+
+    def prune_heartbeat(self, event) -> None:
+        interval = Setting().get(PluginSettings.PRUNE_INTERVAL)
+        policy = RetentionPolicy.fromSettings()
+        now = time.monotonic()
+        if not interval or not policy.enabled or now < getattr(self, "_nextPrune", 0):
+            return
+        self._nextPrune = now + interval
+
+        scheduler = TreeOperationScheduler()
+        tales = Tale().find(
+            {self.root_tale_field: {"$exists": True}},
+            fields=[self.root_tale_field, "restoredFrom", "publishInfo"],
+        )
+        with scheduler.background():
+            for tale in tales:
+                try:
+                    # One tale at a time, so that interactive operations are not held up by
+                    # the whole pass
+                    with scheduler.admit("version_prune"):
+                        removed = self.prune(tale, policy)
+                except RestException as exc:
+                    # Busy tales are pruned next time
+                    logger.info("Skipping pruning of tale %s: %s", tale["_id"], exc)
+                    continue
+                if removed:
+                    logger.info("Pruned %d versions of tale %s", len(removed), tale["_id"])
+
+    def diff(self, old: dict, new: dict) -> Iterator[bytes]:
+        """Returns a generator of the differences between two versions as a JSON document
+        (see VersionDiff).
+        """
+        root = Folder().load(new["parentId"], force=True, fields=["taleId"])
+        tale = None
+        if root is not None and "taleId" in root:
+            tale = Tale().load(root["taleId"], force=True, fields=["versionsRootId"])
+        for version in (old, new):
+            if tale is None or version["parentId"] != tale.get("versionsRootId"):
+                raise RestException("Not a version of the tale: %s" % version["_id"], 400)
+            self.checkReady(version)
+        metadata = VersionDiff.diffMetadata(
+            self.restoreTaleFromVersion(old, annotate=False),
+            self.restoreTaleFromVersion(new, annotate=False),
         )
+        return VersionDiff(old, new).stream(metadata)
+
+    def getStatus(self, vfolder: dict) -> dict:
+        vs = VersionStatus.get(vfolder.get(FIELD_VERSION_STATUS_CODE, VersionStatus.READY.code))
+        return {"status": vs.code, "statusString": vs.name}
+
+    def setStatus(self, vfolder: dict, status: VersionState) -> Optional[dict]:
+        """Sets the status of a version. Returns None, without recreating it, if the version
+        folder was removed in the meantime.
+        """
+        result = Folder().update(
+            {"_id": vfolder["_id"]},
+            {"$set": {FIELD_VERSION_STATUS_CODE: status.code}},
+            multi=False,
+        )
+        if result.matched_count == 0:
+            return None
+        vfolder[FIELD_VERSION_STATUS_CODE] = status.code
+        return vfolder
+
+    @staticmethod
+    def isReady(vfolder: dict) -> bool:
+        # Versions created synchronously never get a status
+        status = vfolder.get(FIELD_VERSION_STATUS_CODE, VersionStatus.READY.code)
+        return status == VersionStatus.READY.code
+
+    def checkReady(self, version: dict) -> None:
+        if not self.isReady(version):
+            raise RestException("Version is not ready.", 409)
+
+    def checkNotPending(self, version: dict) -> None:
+        # Failed versions are left behind to be deleted, only pending ones are off limits
+        if version.get(FIELD_VERSION_STATUS_CODE) == VersionStatus.PENDING.code:
+            raise RestException("Version is not ready.", 409)
+
+    def checkRemovable(self, version: dict) -> None:
+        self.checkNotPending(version)
+        super().checkRemovable(version)
 
+    def removableQuery(self) -> dict:
+        query = super().removableQuery()
+        query[FIELD_VERSION_STATUS_CODE] = {"$ne": VersionStatus.PENDING.code}
+        return query
+
+    @timedOperation("version_restore")
     def restore(self, tale: dict, version: dict, user: dict):
+        self.checkReady(version)
+        Metrics().annotate(taleId=tale["_id"], versionId=version["_id"])
         version_root = Folder().load(
             version["parentId"], user=user, level=AccessType.READ
         )
 
         workspace = Folder().load(tale["workspaceId"], force=True)
         workspace_path = Path(workspace["fsPath"])
-        version = Folder().load(version["_id"], force=True, fields=["fsPath"])
+        version = Folder().load(version["_id"], force=True, fields=self.manifest_fields)
         version_workspace_path = Path(version["fsPath"]) / "workspace"
 
         if not self.setCriticalSectionFlag(version_root):
@@ -84,28 +443,71 @@ class VersionHierarchyModel(AbstractHierarchyModel):
             )
         try:
             # restore workspace
-            shutil.rmtree(workspace_path)
-            workspace_path.mkdir()
-            self.snapshotRecursive(None, version_workspace_path, workspace_path)
+            with TreeOperationScheduler().admit("version_restore"), Metrics().phase("link"):
+                shutil.rmtree(workspace_path)
+                workspace_path.mkdir()
+                self.snapshotRecursive(None, version_workspace_path, workspace_path)
             # restore Tale
-            tale.update(self.restoreTaleFromVersion(version))
-            return Tale().save(tale)
+            with Metrics().phase("metadata"):
+                tale.update(self.restoreTaleFromVersion(version))
+                return Tale().save(tale)
         finally:
             # probably need a better way to deal with hard crashes here
             self.resetCriticalSectionFlag(version_root)
 
     @staticmethod
     def restoreTaleFromVersion(version, annotate=True):
+        VersionHierarchyModel().materializeManifest(version)
+        return VersionHierarchyModel._readTale(version, annotate)
+
+    @staticmethod
+    def _readTale(version, annotate):
         version_path = Path(version["fsPath"])
         with open((version_path / "manifest.json").as_posix(), "r") as fp:
             manifest = json.load(fp)
-        with open((version_path / "environment.json").as_posix(), "r") as fp:
-            env = json.load(fp)
+        env = DocumentStore().load(
+            version_path / "environment.json", version.get(FIELD_ENVIRONMENT_DIGEST)
+        )
         restored_tale = Tale().restoreTale(manifest, env)
         if annotate:
             restored_tale["restoredFrom"] = version["_id"]
         return restored_tale
 
+    def materializeManifest(self, version: dict) -> None:
+        """Regenerates the manifest.json of a version if it is stale, i.e. if the version was
+        renamed since it was written. Renaming a version only marks its manifest as stale, so
+        that it is a single update; the manifest is regenerated in the background (see
+        materializeManifestEvent) or, at the latest, before it is read.
+        """
+        if not version.get(FIELD_MANIFEST_STALE):
+            return
+        current = Folder().load(version["_id"], force=True, fields=self.manifest_fields)
+        if current is None or not current.get(FIELD_MANIFEST_STALE):
+            version.pop(FIELD_MANIFEST_STALE, None)
+            return
+        root = Folder().load(current["parentId"], force=True, fields=["taleId"])
+        tale = Tale().load(root["taleId"], force=True)
+        user = User().load(tale["creatorId"], force=True)
+        # Like copies and imports, the manifest describes the tale as it was in the version
+        tale.update(self._readTale(current, annotate=False))
+        manifest = Manifest(tale, user, versionId=current["_id"], expand_folders=False)
+        path = Path(current["fsPath"]) / "manifest.json"
+        tmp = path.with_name(f".manifest.json.{uuid.uuid4().hex}")
+        tmp.write_text(manifest.dump_manifest())
+        os.replace(tmp, path)
+        # Unless it was renamed again in the meantime
+        Folder().update(
+            {"_id": current["_id"], "name": current["name"], FIELD_MANIFEST_STALE: True},
+            {"$unset": {FIELD_MANIFEST_STALE: ""}},
+            multi=False,
+        )
+        version.pop(FIELD_MANIFEST_STALE, None)
+
+    def materializeManifestEvent(self, event) -> None:
+        version = Folder().load(event.info, force=True)
+        if version is not None:
+            self.materializeManifest(version)
+
     def resetCrashedCriticalSections(self):
         Folder().update(
             {self.field_critical_section_flag: True},
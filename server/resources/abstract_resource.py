@@ -1,4 +1,11 @@
+import datetime
+import functools
 import os
+from typing import List, Optional
+
+from bson import ObjectId
+from bson.errors import InvalidId
+import pymongo
 from girder import events
 from girder.api import access
 from girder.constants import AccessType, TokenScope
@@ -8,6 +15,21 @@ from girder.models.folder import Folder
 
 from girder.plugins.wholetale.models.tale import Tale
 
+from ..constants import (
+    FIELD_STATUS_CODE, FIELD_VERSION_STATS, FIELD_VERSION_STATUS_CODE,
+    FIELD_WORKSPACE_MATERIALIZED
+)
+from ..lib.coalesce import TimestampCoalescer
+from ..lib.profiler import RequestProfiler
+
+# The fields that can be requested from the compact list
+COMPACT_FIELDS = {
+    '_id', 'name', 'description', 'created', 'updated', 'creatorId', 'runVersionId',
+    FIELD_STATUS_CODE, FIELD_VERSION_STATS, FIELD_VERSION_STATUS_CODE,
+    FIELD_WORKSPACE_MATERIALIZED
+}
+_EPOCH = datetime.datetime(1970, 1, 1)
+
 
 class AbstractVRResource(Resource):
     root_tale_field = None
@@ -27,6 +49,15 @@ class AbstractVRResource(Resource):
         self.route('GET', (':id',), self.load)
         self.route('PUT', (':id',), self.rename)
         self.route('DELETE', (':id',), self.delete)
+        self.route('DELETE', (), self.deleteMany)
+
+    def handleRoute(self, method, path, params):
+        label = '%s %s/%s' % (method, self.resourceName, '/'.join(path))
+        # The timestamps touched by the handler and the event handlers are bumped at the end
+        with TimestampCoalescer().request():
+            return RequestProfiler().call(
+                label, functools.partial(super().handleRoute, method, path, params)
+            )
 
     def rename(self, vrfolder: dict, newName: str, allow_rename: bool = False) -> dict:
         user = self.getCurrentUser()
@@ -49,9 +80,49 @@ class AbstractVRResource(Resource):
         vrfolder = Folder().load(vrfolder_id, user=user, level=AccessType.WRITE)
         if vrfolder:
             root = Folder().load(vrfolder['parentId'], user=user, level=AccessType.WRITE)
-            Folder().updateFolder(root)
             tale = Tale().load(root["meta"]["taleId"], user=user, level=AccessType.WRITE)
-            Tale().updateTale(tale)
+            coalescer = TimestampCoalescer()
+            coalescer.touchFolder(root['_id'])
+            coalescer.touchTale(tale['_id'])
+
+    def deleteMany(self, ids: Optional[List[str]] = None, tale: Optional[dict] = None) -> dict:
+        """Deletes the folders with the given ids, or all folders of a tale. Folders in use
+        (e.g., versions referenced by runs) are skipped. Returns the ids of the deleted and
+        skipped folders.
+        """
+        user = self.getCurrentUser()
+        if tale is not None:
+            root = self.model.getRootFromTale(tale, user=user, level=AccessType.WRITE)
+            query = {'parentId': root['_id']}
+        elif ids:
+            try:
+                query = {'_id': {'$in': [ObjectId(_) for _ in ids]}}
+            except (InvalidId, TypeError):
+                raise RestException('Invalid ids.', code=400)
+        else:
+            raise RestException('Either ids or taleId must be specified.', code=400)
+
+        groups = {}
+        for folder in Folder().find(query):
+            Folder().requireAccess(folder, user=user, level=AccessType.ADMIN)
+            groups.setdefault(folder['parentId'], []).append(folder)
+
+        deleted = []
+        for parentId, folders in groups.items():
+            root = Folder().load(parentId, user=user, level=AccessType.WRITE)
+            owner = None
+            if 'taleId' in root:
+                owner = Tale().load(root['taleId'], force=True, fields=[self.model.root_tale_field])
+            if owner is None or owner.get(self.model.root_tale_field) != root['_id']:
+                raise RestException('Not a %s: %s' % (self.resourceName, folders[0]['_id']), 400)
+            deleted.extend(_['_id'] for _ in self.model.removeBatch(root, folders))
+
+        requested = [_['_id'] for folders in groups.values() for _ in folders]
+        removed = set(deleted)
+        return {
+            'deleted': deleted,
+            'skipped': [_ for _ in requested if _ not in removed],
+        }
 
     def list(
         self,
@@ -61,10 +132,16 @@ class AbstractVRResource(Resource):
         offset=0,
         sort=None,
         filters=None,
+        fields=None,
+        cursor=None,
         **kwargs
     ):
         root = self.model.getRootFromTale(tale, user=user, level=AccessType.READ)
-        return Folder().childFolders(
+        if fields is not None:
+            return self.listCompact(root, fields, limit, offset, sort, cursor)
+        if cursor is not None:
+            raise RestException('A cursor can only be used with fields.', code=400)
+        folders = Folder().childFolders(
             root,
             "folder",
             user=user,
@@ -74,6 +151,57 @@ class AbstractVRResource(Resource):
             filters=filters,
             **kwargs
         )
+        return [Folder().filter(_, user) for _ in folders]
+
+    @staticmethod
+    def listCompact(
+        root: dict, fields: str, limit: int, offset: int, sort: list, cursor: Optional[str]
+    ) -> dict:
+        """Lists the given fields of the folders of a root with a single projected query. The
+        folders inherit their access from the root, which the caller has already checked.
+        Pagination is keyed on (created, _id): the returned cursor is the key of the last folder
+        of the page, or None on the last page.
+        """
+        requested = {_.strip() for _ in fields.split(',') if _.strip()} | {'_id'}
+        unknown = requested - COMPACT_FIELDS
+        if unknown:
+            raise RestException('Invalid fields: %s.' % ', '.join(sorted(unknown)), code=400)
+        if sort and sort[0][0] != 'created':
+            raise RestException('Compact lists can only be sorted by created.', code=400)
+        direction = sort[0][1] if sort else pymongo.ASCENDING
+
+        query = {'parentId': root['_id']}
+        if cursor is not None:
+            try:
+                ms, _id = cursor.split('_')
+                created = _EPOCH + datetime.timedelta(milliseconds=int(ms))
+                _id = ObjectId(_id)
+            except (InvalidId, ValueError):
+                raise RestException('Invalid cursor.', code=400)
+            op = '$gt' if direction == pymongo.ASCENDING else '$lt'
+            query['$or'] = [
+                {'created': {op: created}},
+                {'created': created, '_id': {op: _id}},
+            ]
+            offset = 0
+
+        docs = list(Folder().find(
+            query,
+            fields=list(requested | {'created'}),
+            sort=[('created', direction), ('_id', direction)],
+            offset=offset,
+            limit=limit + 1 if limit else 0,
+        ))
+        nextCursor = None
+        if limit and len(docs) > limit:
+            docs = docs[:limit]
+            last = docs[-1]
+            ms = (last['created'] - _EPOCH) // datetime.timedelta(milliseconds=1)
+            nextCursor = '%d_%s' % (ms, last['_id'])
+        if 'created' not in requested:
+            for doc in docs:
+                del doc['created']
+        return {'items': docs, 'cursor': nextCursor}
 
     def exists(self, tale: dict, name: str):
         user = self.getCurrentUser()
@@ -0,0 +1,129 @@
+from girder.api import access
+from girder.api.describe import Description, autoDescribeRoute
+from girder.api.rest import setResponseHeader, setContentDisposition
+from girder.api.v1.resource import Resource
+from girder.constants import AccessType, TokenScope
+from girder.exceptions import RestException
+from girder.models.user import User
+from girder.plugins.jobs.models.job import Job
+from girder.plugins.wholetale.models.tale import Tale
+
+from ..lib.accounting import StorageAccounting
+from ..lib.metrics import Metrics
+from ..lib.profiler import RequestProfiler
+
+
+class VersioningAdmin(Resource):
+
+    def __init__(self):
+        super().__init__()
+        self.resourceName = 'wt_versioning'
+        self.route('GET', ('usage',), self.getUsage)
+        self.route('POST', ('usage', 'rescan'), self.rescanUsage)
+        self.route('DELETE', ('trash',), self.collectTrash)
+        self.route('GET', ('metrics',), self.getMetrics)
+        self.route('GET', ('profile',), self.listProfiles)
+        self.route('GET', ('profile', ':name'), self.downloadProfile)
+
+    @access.admin
+    @autoDescribeRoute(
+        Description('Returns the storage used by the versions and runs of tales.')
+        .notes('If a tale is specified, the usage of that tale is returned. Otherwise, the '
+               'totals per user (i.e., per creator of the tales) are returned, sorted by size. '
+               'Files shared by several versions or runs of a tale are counted once.')
+        .modelParam('taleId', 'The ID of a tale.', model=Tale, plugin='wholetale',
+                    level=AccessType.READ, destName='tale', paramType='query', required=False)
+        .modelParam('userId', 'Only return the totals of this user.', model=User,
+                    level=AccessType.READ, destName='owner', paramType='query', required=False)
+        .param('limit', 'Maximum number of users to return, 0 for all of them.', required=False,
+               dataType='integer', default=50)
+        .errorResponse('Invalid limit.', 400)
+        .errorResponse('Admin access was denied.', 403)
+    )
+    def getUsage(self, tale: dict = None, owner: dict = None, limit: int = 50):
+        if limit < 0:
+            raise RestException('Invalid limit: %d' % limit, 400)
+        if tale is not None:
+            return StorageAccounting().getTaleUsage(tale)
+        return StorageAccounting().getUserUsage(
+            userId=None if owner is None else owner['_id'], limit=limit
+        )
+
+    @access.admin
+    @autoDescribeRoute(
+        Description('Recomputes the storage usage of all tales by scanning the versions and '
+                    'runs directories. Returns the job doing the scan.')
+        .param('workers', 'The number of shards scanned in parallel.', required=False,
+               dataType='integer', default=4)
+        .errorResponse('Admin access was denied.', 403)
+    )
+    def rescanUsage(self, workers: int):
+        user = self.getCurrentUser()
+        job = Job().createLocalJob(
+            title='Rescan versions and runs storage usage',
+            user=user,
+            type='wt_versioning_rescan',
+            public=False,
+            asynchronous=True,
+            module='girder.plugins.wt_versioning.tasks.rescan_usage',
+            kwargs={'workers': workers},
+        )
+        Job().scheduleJob(job)
+        return Job().filter(job, user=user)
+
+    @access.user(scope=TokenScope.DATA_OWN)
+    @autoDescribeRoute(
+        Description('Permanently deletes the removed versions and runs of a tale.')
+        .modelParam('taleId', 'The ID of a tale.', model=Tale, plugin='wholetale',
+                    level=AccessType.ADMIN, destName='tale', paramType='query')
+        .errorResponse('Access was denied (if current user does not have admin access to this '
+                       'tale)', 403)
+    )
+    def collectTrash(self, tale: dict) -> None:
+        StorageAccounting().collectTrash(tale)
+
+    @access.admin
+    @autoDescribeRoute(
+        Description('Returns the timings and counters of the operations on versions and runs, in '
+                    'the Prometheus text format.')
+        .notes('The metrics are those of the Girder process serving the request.')
+        .produces('text/plain')
+        .errorResponse('Admin access was denied.', 403)
+    )
+    def getMetrics(self):
+        setResponseHeader('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        text = Metrics().render()
+
+        def stream():
+            yield text.encode('utf-8')
+        return stream
+
+    @access.admin
+    @autoDescribeRoute(
+        Description('Lists the profiles of the version and run endpoints, most recent first.')
+        .notes('The next N calls to the version and run endpoints are profiled when the '
+               'wtversioning.profile_requests setting is set to N.')
+        .errorResponse('Admin access was denied.', 403)
+    )
+    def listProfiles(self):
+        return RequestProfiler().list()
+
+    @access.admin(cookie=True)
+    @autoDescribeRoute(
+        Description('Downloads a profile, in the format of the Python pstats module.')
+        .param('name', 'The name of the profile.', paramType='path')
+        .produces('application/octet-stream')
+        .errorResponse('Admin access was denied.', 403)
+        .errorResponse('Profile not found.', 404)
+    )
+    def downloadProfile(self, name: str):
+        path = RequestProfiler().path(name)
+        if path is None:
+            raise RestException('Profile not found.', 404)
+        data = path.read_bytes()
+        setResponseHeader('Content-Type', 'application/octet-stream')
+        setContentDisposition(name)
+
+        def stream():
+            yield data
+        return stream
@@ -85,13 +85,20 @@ class Run(AbstractVRResource):
         .param('allowRename', 'Allow to modify "name" if object with the same name '
                               'already exists.', required=False, dataType='boolean',
                default=False)
+        .param('deferred', 'If set, the run workspace is a link to the version workspace until '
+                           'the run is started, when it is populated with links to the files '
+                           'of the version. Defaults to the value of the '
+                           'wtversioning.deferred_run_workspace setting.', required=False,
+               dataType='boolean')
         .errorResponse('Access was denied (if current user does not have write access to the tale '
                        'associated with this version)', 403)
         .errorResponse('Illegal file name', 400)
     )
-    def create(self, version: dict, name: str = None, allowRename: bool = False) -> dict:
+    def create(
+        self, version: dict, name: str = None, allowRename: bool = False, deferred: bool = None
+    ) -> dict:
         user = self.getCurrentUser()
-        return self.model.create(version, name, user, allowRename=allowRename)
+        return self.model.create(version, name, user, allowRename=allowRename, deferred=deferred)
 
     @access.user(TokenScope.DATA_OWN)
     @autoDescribeRoute(
@@ -104,19 +111,40 @@ class Run(AbstractVRResource):
     def delete(self, rfolder: dict) -> None:
         self.model.remove(rfolder, self.getCurrentUser())
 
+    @access.user(TokenScope.DATA_OWN)
+    @autoDescribeRoute(
+        Description('Deletes several runs at once. Returns the ids of the deleted runs.')
+        .jsonParam('ids', 'A JSON list of run ids.', required=False, requireArray=True)
+        .modelParam('taleId', 'Delete all runs of this tale instead.', model=Tale,
+                    level=AccessType.ADMIN, destName='tale', paramType='query', required=False)
+        .errorResponse('Either ids or taleId must be specified.', 400)
+        .errorResponse('Access was denied (if current user does not have admin access to the '
+                       'runs)', 403)
+    )
+    def deleteMany(self, ids: list = None, tale: dict = None) -> dict:
+        return super().deleteMany(ids=ids, tale=tale)
+
     @access.public
-    @filtermodel('folder')
     @autoDescribeRoute(
         Description('Lists runs.')
+        .notes('If fields is set, an object is returned with the requested fields of the runs '
+               'in "items" and the cursor to pass in order to get the next page in "cursor", '
+               'which is null on the last page.')
         .modelParam('taleId', 'The ID of the tale to which the runs belong.', model=Tale,
                     level=AccessType.READ, destName='tale', paramType="query")
+        .param('fields', 'A comma separated list of fields to return, e.g. '
+                         '"_id,name,created,updated,runStatus,runVersionId".', required=False)
+        .param('cursor', 'The cursor returned with the previous page. Requires fields.',
+               required=False)
         .pagingParams(defaultSort='created')
+        .errorResponse('Invalid fields, sort or cursor.', 400)
         .errorResponse('Access was denied (if current user does not have read access to this '
                        'tale)', 403)
     )
-    def list(self, tale: dict, limit, offset, sort):
+    def list(self, tale: dict, fields, cursor, limit, offset, sort):
         return super().list(
-            tale, user=self.getCurrentUser(), limit=limit, offset=offset, sort=sort
+            tale, user=self.getCurrentUser(), limit=limit, offset=offset, sort=sort,
+            fields=fields, cursor=cursor
         )
 
     @access.user(TokenScope.DATA_READ)
@@ -177,6 +205,7 @@ class Run(AbstractVRResource):
 
         runRoot = Folder().load(run['parentId'], user=user, level=AccessType.WRITE)
         tale = Tale().load(runRoot['meta']['taleId'], user=user, level=AccessType.READ)
+        run = self.model.materializeWorkspace(run)
 
         resource = {
             'type': 'wt_recorded_run',
@@ -231,9 +260,11 @@ class Run(AbstractVRResource):
             if status == JobStatus.SUCCESS:
                 rfolder[FIELD_STATUS_CODE] = RunStatus.COMPLETED.code
                 self._expire_job_token(job)
+                self.model.recordUsage(rfolder)
             elif status == JobStatus.ERROR:
                 rfolder[FIELD_STATUS_CODE] = RunStatus.FAILED.code
                 self._expire_job_token(job)
+                self.model.recordUsage(rfolder)
             elif status in (JobStatus.QUEUED, JobStatus.RUNNING):
                 rfolder[FIELD_STATUS_CODE] = RunStatus.RUNNING.code
 
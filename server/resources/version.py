@@ -1,20 +1,30 @@
+import calendar
+import re
 from pathlib import Path
 
+import cherrypy
+from bson import ObjectId
 from girder import events
 from girder.api import access
 from girder.api.describe import Description, autoDescribeRoute
-from girder.api.rest import filtermodel
+from girder.api.rest import filtermodel, setContentDisposition, setResponseHeader
 from girder.constants import AccessType, TokenScope
 from girder.exceptions import RestException
+from girder.models.file import File
 from girder.models.folder import Folder
-from girder.plugins.wholetale.lib.manifest import Manifest
-from girder.plugins.wholetale.lib.manifest_parser import ManifestParser
+from girder.plugins.jobs.models.job import Job
 from girder.plugins.wholetale.models.tale import Tale
-from girder.plugins.wt_data_manager.models.session import Session
 from girder.plugins.virtual_resources.rest import VirtualObject
 
-from ..constants import Constants
+from ..constants import Constants, FIELD_MANIFEST_STALE
 from ..lib import util
+from ..lib.archive import VersionArchive
+from ..lib.coalesce import TimestampCoalescer
+from ..lib.dataset import DatasetCache
+from ..lib.history import FileHistory
+from ..lib.index import VersionIndex
+from ..lib.scheduler import TreeOperationScheduler
+from ..lib.search import MAX_REGEX_LENGTH, VersionFile
 from ..lib.version_hierarchy import VersionHierarchyModel
 from .abstract_resource import AbstractVRResource
 
@@ -24,6 +34,14 @@ class Version(AbstractVRResource):
     def __init__(self, tale_node):
         super().__init__('version', Constants.VERSIONS_ROOT_DIR_NAME)
         self.route('GET', (':id', 'dataSet'), self.getDataset)
+        self.route('GET', (':id', 'status'), self.status)
+        self.route('GET', (':id', 'archive'), self.archive)
+        self.route('POST', ('import',), self.importVersions)
+        self.route('GET', (':id', 'diff'), self.diff)
+        self.route('GET', (':id', 'files'), self.listFiles)
+        self.route('GET', ('history',), self.fileHistory)
+        self.route('GET', ('search',), self.searchFiles)
+        self.route('GET', ('latest',), self.getLatestVersion)
         tale_node.route("GET", (":id", "restore"), self.restoreView)
         tale_node.route("PUT", (":id", "restore"), self.restore)
         events.bind("rest.get.tale/:id/export.before", "wt_versioning", self.ensure_version)
@@ -32,6 +50,10 @@ class Version(AbstractVRResource):
         events.bind("rest.delete.version/:id.before", "wt_versioning", self.update_parents)
         events.bind("tale.view_restored", "wt_versioning", self.restoreViewEvent)
         self.model = VersionHierarchyModel()
+        events.bind("heartbeat", "wt_versioning_prune", self.model.prune_heartbeat)
+        events.bind(
+            "wt_versioning.manifest_stale", "wt_versioning", self.model.materializeManifestEvent
+        )
 
     @access.user(TokenScope.DATA_WRITE)
     @filtermodel('folder')
@@ -46,19 +68,15 @@ class Version(AbstractVRResource):
         .errorResponse('Access was denied (if current user does not have write access to this '
                        'tale)', 403)
         .errorResponse('Illegal file name', 400)
-        .errorResponse('Name already exists', 409)
+        .errorResponse('Name already exists, or version is not ready', 409)
     )
     def rename(self, vfolder: dict, name: str, allowRename: bool) -> dict:
+        self.model.checkNotPending(vfolder)
+        # The manifest holds the name of the version, it is regenerated lazily. The root and
+        # the tale are touched by update_parents.
+        vfolder[FIELD_MANIFEST_STALE] = True
         renamed_version = super().rename(vfolder, name, allow_rename=allowRename)
-        user = self.getCurrentUser()
-
-        root = Folder().load(vfolder["parentId"], user=user, level=AccessType.WRITE)
-        tale = Tale().load(root["taleId"], user=user, level=AccessType.WRITE)
-        manifest = Manifest(tale, user, versionId=renamed_version["_id"], expand_folders=False)
-        version_path = Path(renamed_version["fsPath"])
-        with open((version_path / "manifest.json").as_posix(), "w") as fp:
-            fp.write(manifest.dump_manifest())
-        Tale().updateTale(Tale().load(root["taleId"], force=True))
+        events.daemon.trigger('wt_versioning.manifest_stale', info=renamed_version['_id'])
         return renamed_version
 
     @access.user(TokenScope.DATA_READ)
@@ -71,10 +89,183 @@ class Version(AbstractVRResource):
                        'respective version folder.', 403)
     )
     def getDataset(self, version: dict) -> dict:
-        mp = ManifestParser(Path(version["fsPath"]) / "manifest.json")
-        dataSet = mp.get_dataset()
-        Session().loadObjects(dataSet)
-        return dataSet
+        self.model.materializeManifest(version)
+        return DatasetCache().get(version)
+
+    @access.user(TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description('Returns the status of a version in an object with two fields: status and '
+                    'statusString. The possible values for status, an integer, are 0, 1, 2, with '
+                    'statusString being, respectively, READY, PENDING, FAILED.')
+        .modelParam('id', 'The ID of a version', model=Folder, level=AccessType.READ,
+                    destName='vfolder')
+        .errorResponse('Access was denied (if current user does not have read access to the '
+                       'respective version folder.', 403)
+    )
+    def status(self, vfolder: dict) -> dict:
+        return self.model.getStatus(vfolder)
+
+    @access.user(TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description('Streams an archive of a version directory, including its manifest.json, '
+                    'environment.json and workspace.')
+        .notes('Tar archives are laid out deterministically, so interrupted downloads can be '
+               'resumed using the Range header, with the ETag of the archive in If-Range. Files '
+               'hard linked to each other are stored once in tar archives.')
+        .modelParam('id', 'The ID of a version', model=Folder, level=AccessType.READ,
+                    destName='vfolder')
+        .param('format', 'The archive format.', required=False, enum=['zip', 'tar'],
+               default='zip')
+        .produces(['application/zip', 'application/x-tar'])
+        .errorResponse('Access was denied (if current user does not have read access to the '
+                       'respective version folder.', 403)
+        .errorResponse('Version is not ready.', 409)
+        .errorResponse('Requested range not satisfiable.', 416)
+    )
+    def archive(self, vfolder: dict, format: str):
+        self.model.checkReady(vfolder)
+        self.model.materializeManifest(vfolder)
+        archive = VersionArchive(
+            Path(vfolder['fsPath']), vfolder['name'],
+            metadata={'name': vfolder['name'], 'created': vfolder['created'].isoformat()},
+            mtime=calendar.timegm(vfolder['created'].utctimetuple()),
+        )
+        setContentDisposition(f"{vfolder['name']}.{format}")
+        if format == 'zip':
+            setResponseHeader('Content-Type', 'application/zip')
+            return archive.streamZip
+
+        size = archive.tarSize()
+        start, end = 0, size
+        etag = archive.etag(str(vfolder['_id']))
+        setResponseHeader('Content-Type', 'application/x-tar')
+        setResponseHeader('Accept-Ranges', 'bytes')
+        setResponseHeader('ETag', etag)
+        ranges = None
+        ifRange = cherrypy.request.headers.get('If-Range')
+        if ifRange is None or ifRange == etag:
+            # Otherwise the archive changed since the download started, it is sent in full
+            ranges = cherrypy.lib.httputil.get_ranges(cherrypy.request.headers.get('Range'), size)
+        if ranges == []:
+            setResponseHeader('Content-Range', f'bytes */{size}')
+            raise cherrypy.HTTPError(416, 'Requested range not satisfiable.')
+        if ranges:
+            start, end = ranges[0]
+            setResponseHeader('Content-Range', f'bytes {start}-{end - 1}/{size}')
+            cherrypy.response.status = 206
+        setResponseHeader('Content-Length', end - start)
+
+        def stream():
+            yield from archive.streamTar(start, end)
+        return stream
+
+    @access.user(TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description('Returns the differences between a version and another version.')
+        .notes('The response is a JSON object with two fields. "metadata" maps the tale fields '
+               'that differ to their "old" (other version) and "new" (this version) values. '
+               '"changes" lists the workspace paths that were added, removed or modified, in '
+               'path order. Files are compared by identity, not by content.')
+        .modelParam('id', 'The ID of a version', model=Folder, level=AccessType.READ,
+                    destName='vfolder')
+        .modelParam('against', 'The ID of the version to compare with.', model=Folder,
+                    level=AccessType.READ, destName='other', paramType='query')
+        .produces(['application/json'])
+        .errorResponse('Not a version, or not a version of the same tale.', 400)
+        .errorResponse('Access was denied (if current user does not have read access to the '
+                       'respective version folders.', 403)
+        .errorResponse('Version is not ready.', 409)
+    )
+    def diff(self, vfolder: dict, other: dict):
+        stream = self.model.diff(other, vfolder)
+        setResponseHeader('Content-Type', 'application/json')
+        return lambda: stream
+
+    @access.user(TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description('Lists a directory of the workspace of a version.')
+        .notes('Returns an object with the entries of the directory, sorted by name, in "items" '
+               'and the cursor to pass in order to get the next page in "cursor", which is null '
+               'on the last page.')
+        .modelParam('id', 'The ID of a version', model=Folder, level=AccessType.READ,
+                    destName='vfolder')
+        .param('path', 'The path of the directory, relative to the workspace.', required=False,
+               default='')
+        .param('cursor', 'The cursor returned with the previous page.', required=False)
+        .param('limit', 'The maximum number of entries to return.', required=False,
+               dataType='integer', default=100)
+        .errorResponse('Not a directory.', 400)
+        .errorResponse('Access was denied (if current user does not have read access to the '
+                       'respective version folder.', 403)
+        .errorResponse('Version is not ready.', 409)
+    )
+    def listFiles(self, vfolder: dict, path: str, cursor: str, limit: int) -> dict:
+        self.model.checkReady(vfolder)
+        path = path.strip('/')
+        workspace = Path(vfolder['fsPath']) / 'workspace'
+        if '..' in Path(path).parts or not (workspace / path).is_dir():
+            raise RestException('Not a directory: ' + path, 400)
+        items, cursor = VersionIndex(vfolder).list(path, cursor=cursor, limit=limit)
+        return {'items': items, 'cursor': cursor}
+
+    @access.user(TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description('Returns the versions of a tale in which a workspace path was added, '
+                    'modified or removed, in chronological order.')
+        .modelParam('taleId', 'The ID of a tale.', model=Tale, level=AccessType.READ,
+                    destName='tale', paramType='query')
+        .param('path', 'A path relative to the workspace.', required=True)
+        .errorResponse('Invalid path.', 400)
+        .errorResponse('Access was denied (if current user does not have read access to this '
+                       'tale)', 403)
+    )
+    def fileHistory(self, tale: dict, path: str) -> list:
+        path = path.strip('/')
+        if not path or '..' in Path(path).parts:
+            raise RestException('Invalid path: ' + path, 400)
+        return FileHistory().get(tale, path)
+
+    @access.user(TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description('Searches the workspaces of all the versions of a tale. Returns the matching '
+                    'files and directories, ordered by path, each with the versions containing '
+                    'it. A path that was modified is returned once for each of its contents.')
+        .modelParam('taleId', 'The ID of a tale.', model=Tale, level=AccessType.READ,
+                    destName='tale', paramType='query')
+        .param('name', 'A glob pattern matched against file names, e.g. "*.csv".',
+               required=False)
+        .param('regex', 'A regular expression matched against whole paths relative to the '
+               'workspace, e.g. "data/.*\\.csv".', required=False)
+        .param('minSize', 'The minimum size in bytes.', required=False, dataType='integer')
+        .param('maxSize', 'The maximum size in bytes.', required=False, dataType='integer')
+        .param('modifiedAfter', 'The minimum modification time, in seconds since the epoch.',
+               required=False, dataType='integer')
+        .param('modifiedBefore', 'The maximum modification time, in seconds since the epoch.',
+               required=False, dataType='integer')
+        .pagingParams(defaultSort=None)
+        .errorResponse('Invalid or too long regular expression.', 400)
+        .errorResponse('Access was denied (if current user does not have read access to this '
+                       'tale)', 403)
+    )
+    def searchFiles(
+        self, tale: dict, name: str, regex: str, minSize: int, maxSize: int,
+        modifiedAfter: int, modifiedBefore: int, limit: int, offset: int
+    ) -> list:
+        if regex:
+            if len(regex) > MAX_REGEX_LENGTH:
+                raise RestException(
+                    'Regular expressions are limited to %d characters.' % MAX_REGEX_LENGTH, 400
+                )
+            try:
+                re.compile(regex)
+            except re.error as ex:
+                raise RestException('Invalid regular expression: ' + str(ex), 400)
+        root = Folder().load(tale['versionsRootId'], force=True)
+        return VersionFile().search(
+            root, name=name, regex=regex, minSize=minSize, maxSize=maxSize,
+            modifiedAfter=modifiedAfter, modifiedBefore=modifiedBefore,
+            limit=limit, offset=offset
+        )
 
     @access.public
     @filtermodel("folder")
@@ -102,6 +293,10 @@ class Version(AbstractVRResource):
                dataType='boolean', default=False)
         .param('allowRename', 'Allow to modify "name" if object with the same name'
                'already exists.', required=False, dataType='boolean', default=False)
+        .param('async', 'If set, the version folder is returned immediately in a pending state '
+                        'and the snapshot is taken by a job. The progress can be followed using '
+                        'the version status or the job referenced by meta.jobId.',
+               required=False, dataType='boolean', default=False)
         .errorResponse('Access was denied (if current user does not have write access'
                        ' to this tale)', 403)
         .errorResponse('Another version is being created. Try again later.', 409)
@@ -116,7 +311,8 @@ class Version(AbstractVRResource):
         tale: dict,
         name: str = None,
         force: bool = False,
-        allowRename: bool = False
+        allowRename: bool = False,
+        **kwargs
     ) -> dict:
         if not name:
             name = self.model.generateName()
@@ -127,13 +323,49 @@ class Version(AbstractVRResource):
 
         if not self.model.setCriticalSectionFlag(root):
             raise RestException('Another operation is in progress. Try again later.', 409)
+        rootDir = util.getTaleVersionsDirPath(tale)
+        if kwargs.get('async', False):
+            # The critical section is released by the job once the snapshot is taken
+            try:
+                return self.model.createAsync(tale, name, rootDir, root, user=user, force=force)
+            except Exception:
+                self.model.resetCriticalSectionFlag(root)
+                raise
         try:
-            rootDir = util.getTaleVersionsDirPath(tale)
             return self.model.create(tale, name, rootDir, root, user=user, force=force)
         finally:
             # probably need a better way to deal with hard crashes here
             self.model.resetCriticalSectionFlag(root)
-            Tale().updateTale(tale)
+            TimestampCoalescer().touchTale(tale['_id'])
+
+    @access.user(TokenScope.DATA_WRITE)
+    @autoDescribeRoute(
+        Description('Imports the versions stored in an archive into a tale. Returns the job '
+                    'doing the import.')
+        .notes('The archive is a tar file, optionally compressed, with one top level directory '
+               'per version, containing its manifest.json, environment.json and workspace, as '
+               'produced by GET /version/:id/archive. Versions must be stored in chronological '
+               'order.')
+        .modelParam('taleId', 'The tale to import the versions into.', model=Tale,
+                    level=AccessType.WRITE, destName='tale', paramType='query')
+        .modelParam('fileId', 'The file containing the archive.', model=File,
+                    level=AccessType.READ, destName='archive', paramType='query')
+        .errorResponse('Access was denied (if current user does not have write access'
+                       ' to this tale)', 403)
+        .errorResponse('Another operation is in progress. Try again later.', 409)
+    )
+    def importVersions(self, tale: dict, archive: dict) -> dict:
+        user = self.getCurrentUser()
+        root = self.model.getRootFromTale(tale, user=user, level=AccessType.WRITE)
+        if not self.model.setCriticalSectionFlag(root):
+            raise RestException('Another operation is in progress. Try again later.', 409)
+        # The critical section is released by the job once the import is done
+        try:
+            job = self.model.importVersions(tale, archive, user=user)
+        except Exception:
+            self.model.resetCriticalSectionFlag(root)
+            raise
+        return Job().filter(job, user=user)
 
     @access.user(TokenScope.DATA_WRITE)
     @filtermodel(model="tale", plugin="wholetale")
@@ -195,7 +427,7 @@ class Version(AbstractVRResource):
         event.preventDefault().addResponse(tale)
 
     def _restoreView(self, tale: dict, version: dict):
-        version = Folder().load(version["_id"], force=True, fields=["fsPath"])
+        version = Folder().load(version["_id"], force=True, fields=self.model.manifest_fields)
         tale.update(self.model.restoreTaleFromVersion(version))
         tale["workspaceId"] = VirtualObject().generate_id(
             Path(version["fsPath"]) / "workspace", version["_id"]
@@ -209,24 +441,69 @@ class Version(AbstractVRResource):
                     destName='version')
         .errorResponse('Access was denied (if current user does not have write access to this '
                        'tale)', 403)
+        .errorResponse('Version is not ready, or another operation is in progress.', 409)
         .errorResponse('Version is in use by a run and cannot be deleted.', 461)
     )
     def delete(self, version: dict) -> None:
         self.model.remove(version, self.getCurrentUser())
 
+    @access.user(TokenScope.DATA_OWN)
+    @autoDescribeRoute(
+        Description('Deletes several versions at once. Returns the ids of the deleted versions and '
+                    'of the ones that were skipped because they are in use by runs or are still '
+                    'being created.')
+        .jsonParam('ids', 'A JSON list of version ids.', required=False, requireArray=True)
+        .modelParam('taleId', 'Delete all versions of this tale instead.', model=Tale,
+                    plugin='wholetale', level=AccessType.ADMIN, destName='tale',
+                    paramType='query', required=False)
+        .errorResponse('Either ids or taleId must be specified.', 400)
+        .errorResponse('Access was denied (if current user does not have admin access to the '
+                       'versions)', 403)
+        .errorResponse('Another operation is in progress. Try again later.', 409)
+    )
+    def deleteMany(self, ids: list = None, tale: dict = None) -> dict:
+        return super().deleteMany(ids=ids, tale=tale)
+
     @access.public
-    @filtermodel('folder')
     @autoDescribeRoute(
         Description('Lists versions.')
+        .notes('If fields is set, an object is returned with the requested fields of the '
+               'versions in "items" and the cursor to pass in order to get the next page in '
+               '"cursor", which is null on the last page.')
         .modelParam('taleId', 'The ID of a tale for which versions are to be listed.',
                     model=Tale, plugin='wholetale', level=AccessType.READ,
                     destName='tale', paramType='query')
+        .param('fields', 'A comma separated list of fields to return, e.g. '
+                         '"_id,name,created,updated".', required=False)
+        .param('cursor', 'The cursor returned with the previous page. Requires fields.',
+               required=False)
         .pagingParams(defaultSort='created')
+        .errorResponse('Invalid fields, sort or cursor.', 400)
+        .errorResponse('Access was denied (if current user does not have read access to this tale)',
+                       403)
+    )
+    def list(self, tale: dict, fields, cursor, limit, offset, sort):
+        return super().list(
+            tale, user=self.getCurrentUser(), limit=limit, offset=offset, sort=sort,
+            fields=fields, cursor=cursor
+        )
+
+    @access.public
+    @filtermodel('folder')
+    @autoDescribeRoute(
+        Description('Returns the most recent version of a tale that is ready, or null if there '
+                    'is none.')
+        .notes('The versions root folder of the tale points to its latest version in '
+               'latestVersionId and counts its versions in versionCount, so this does not '
+               'query the versions.')
+        .modelParam('taleId', 'The ID of a tale.', model=Tale, plugin='wholetale',
+                    level=AccessType.READ, destName='tale', paramType='query')
         .errorResponse('Access was denied (if current user does not have read access to this tale)',
                        403)
     )
-    def list(self, tale: dict, limit, offset, sort):
-        return super().list(tale, user=self.getCurrentUser(), limit=limit, offset=offset, sort=sort)
+    def getLatestVersion(self, tale: dict):
+        root = self.model.getRootFromTale(tale, user=self.getCurrentUser(), level=AccessType.READ)
+        return self.model.getLastVersion(root)
 
     @access.user(TokenScope.DATA_READ)
     @autoDescribeRoute(
@@ -248,7 +525,8 @@ class Version(AbstractVRResource):
         version_id = params.get("versionId")
         if not version_id:
             try:
-                version = self.create(taleId=taleId, allowRename=True, params={})
+                with TreeOperationScheduler().background():
+                    version = self.create(taleId=taleId, allowRename=True, params={})
                 # Above obj is filtered model so we need to reload it...
                 version = Folder().load(version["_id"], force=True)
             except RestException as exc:
@@ -259,3 +537,9 @@ class Version(AbstractVRResource):
             # We're using 'updated' field to bump the version to the top of
             # Folder().list(). We're gonna update it either way later on.
             Folder().updateFolder(version)
+        elif ObjectId.is_valid(version_id):
+            version = Folder().load(version_id, force=True)
+        else:
+            version = None  # left to the export
+        if version is not None:
+            self.model.materializeManifest(version)
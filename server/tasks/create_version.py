@@ -0,0 +1,87 @@
+import shutil
+from pathlib import Path
+
+from girder.exceptions import RestException
+from girder.models.folder import Folder
+from girder.models.notification import Notification, ProgressState
+from girder.models.user import User
+from girder.plugins.jobs.constants import JobStatus
+from girder.plugins.jobs.models.job import Job
+from girder.plugins.wholetale.models.tale import Tale
+
+from ..constants import CREATE_VERSION_STEP_TOTAL, VersionStatus
+from ..lib.coalesce import TimestampCoalescer
+from ..lib.metrics import Metrics, timedOperation
+from ..lib.scheduler import TreeOperationScheduler
+from ..lib.version_hierarchy import VersionHierarchyModel
+
+
+@timedOperation("version_create")
+def run(job):
+    """Takes the snapshot of a version reserved by VersionHierarchyModel.createAsync()."""
+    jobModel = Job()
+    jobModel.updateJob(job, status=JobStatus.RUNNING)
+
+    tale_id, version_id = job["args"]
+    force = job["kwargs"]["force"]
+    user = User().load(job["userId"], force=True)
+    tale = Tale().load(tale_id, force=True)
+    version = Folder().load(version_id, force=True)
+    root = Folder().load(version["parentId"], force=True)
+    notification = Notification().load(job["wt_notification_id"])
+    model = VersionHierarchyModel()
+    Metrics().annotate(taleId=tale_id, versionId=version_id, notModified=False)
+
+    def progress(step, message, state=ProgressState.ACTIVE):
+        Notification().updateProgress(
+            notification, state=state, current=step, total=CREATE_VERSION_STEP_TOTAL,
+            message=message
+        )
+
+    try:
+        with TreeOperationScheduler().admit("version_create"):
+            last = model.getLastVersion(root)
+            if not force:
+                progress(1, "Comparing with the last version")
+                with Metrics().phase("check_modified"):
+                    model.checkModified(tale, last, user)
+            progress(2, "Taking snapshot")
+            with Metrics().phase("snapshot"):
+                model.snapshot(last, tale, version, user=user, force=force)
+        model.setStatus(version, VersionStatus.READY)
+        model.recordLatest(version)
+        progress(CREATE_VERSION_STEP_TOTAL, "Version created", state=ProgressState.SUCCESS)
+        jobModel.updateJob(job, status=JobStatus.SUCCESS, log="Version created\n")
+    except RestException as exc:
+        if exc.code != 303:
+            _fail(job, version, progress, exc)
+            raise
+        # Nothing changed since the last version, drop the reserved one
+        shutil.rmtree(version["fsPath"], ignore_errors=True)
+        Folder().remove(version)
+        progress(CREATE_VERSION_STEP_TOTAL, "Not modified", state=ProgressState.SUCCESS)
+        jobModel.updateJob(
+            job,
+            status=JobStatus.SUCCESS,
+            log="Not modified, see version {}\n".format(exc.extra),
+            otherFields={"versionId": exc.extra},
+        )
+    except Exception as exc:
+        _fail(job, version, progress, exc)
+        raise
+    finally:
+        model.resetCriticalSectionFlag(root)
+        TimestampCoalescer().touchTale(tale["_id"])
+
+
+def _fail(job, version, progress, exc):
+    # Keep the (empty) version directory around so that the failed version can be removed
+    # through the regular DELETE call.
+    path = Path(version["fsPath"])
+    shutil.rmtree(path, ignore_errors=True)
+    # ...unless it is already gone, in which case there is nothing left to mark
+    if Folder().load(version["_id"], force=True) is not None:
+        path.mkdir(parents=True, exist_ok=True)
+        VersionHierarchyModel().setStatus(version, VersionStatus.FAILED)
+    progress(CREATE_VERSION_STEP_TOTAL, str(exc), state=ProgressState.ERROR)
+    Job().updateJob(job, status=JobStatus.ERROR, log="Version creation failed: {}\n".format(exc))
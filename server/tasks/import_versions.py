@@ -0,0 +1,51 @@
+from girder.models.file import File
+from girder.models.folder import Folder
+from girder.models.user import User
+from girder.plugins.jobs.constants import JobStatus
+from girder.plugins.jobs.models.job import Job
+from girder.plugins.wholetale.models.tale import Tale
+
+from ..lib import util
+from ..lib.coalesce import TimestampCoalescer
+from ..lib.importer import VersionImporter
+from ..lib.scheduler import TreeOperationScheduler
+from ..lib.version_hierarchy import VersionHierarchyModel
+
+
+def run(job):
+    """Imports the versions of an archive, scheduled by VersionHierarchyModel.importVersions()."""
+    jobModel = Job()
+    jobModel.updateJob(job, status=JobStatus.RUNNING)
+
+    tale_id, file_id = job["args"]
+    user = User().load(job["userId"], force=True)
+    tale = Tale().load(tale_id, force=True)
+    archive = File().load(file_id, force=True)
+    model = VersionHierarchyModel()
+    root = model.getRootFromTale(tale)
+
+    def progress(message):
+        jobModel.updateJob(job, log=message + "\n")
+
+    try:
+        importer = VersionImporter(
+            tale, root, util.getTaleVersionsDirPath(tale), user, progress=progress
+        )
+        scheduler = TreeOperationScheduler()
+        with scheduler.background(), scheduler.admit("version_import"):
+            with File().open(archive) as fp:
+                folders = importer.run(fp)
+        # imported versions keep their creation times, so any of them may be the latest
+        model.refreshLatest(root)
+        jobModel.updateJob(
+            job,
+            status=JobStatus.SUCCESS,
+            log="Imported {} versions\n".format(len(folders)),
+            otherFields={"versionIds": [str(_["_id"]) for _ in folders]},
+        )
+    except Exception as exc:
+        jobModel.updateJob(job, status=JobStatus.ERROR, log="Import failed: {}\n".format(exc))
+        raise
+    finally:
+        model.resetCriticalSectionFlag(Folder().load(root["_id"], force=True))
+        TimestampCoalescer().touchTale(tale["_id"])
@@ -0,0 +1,21 @@
+from girder.plugins.jobs.constants import JobStatus
+from girder.plugins.jobs.models.job import Job
+
+from ..lib.accounting import StorageAccounting
+
+
+def run(job):
+    jobModel = Job()
+    jobModel.updateJob(job, status=JobStatus.RUNNING)
+
+    def progress(message):
+        jobModel.updateJob(job, log=message + "\n")
+
+    try:
+        count = StorageAccounting().rescan(workers=job["kwargs"]["workers"], progress=progress)
+        jobModel.updateJob(
+            job, status=JobStatus.SUCCESS, log="Scanned {} tale directories\n".format(count)
+        )
+    except Exception as exc:
+        jobModel.updateJob(job, status=JobStatus.ERROR, log="Rescan failed: {}\n".format(exc))
+        raise